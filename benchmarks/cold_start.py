@@ -0,0 +1,81 @@
+"""
+Measure how long a fresh worker process takes to become useful: importing
+the app, running its startup hooks, serving its first and second request,
+and its first registration (the first bcrypt). Each run is a new
+interpreter, like a gunicorn worker being (re)started.
+
+    python -m benchmarks.cold_start --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+WORKER = """
+import json, sys, time, random
+clock = time.time()
+started = time.perf_counter()
+import src.reservation.main as main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(main.app) as client:
+    warmed = time.perf_counter()
+    first = client.get("/reservation/", params={"limit": 1})
+    first_done = time.perf_counter()
+    client.get("/reservation/", params={"limit": 1})
+    second_done = time.perf_counter()
+    # the first request that needs bcrypt
+    client.post("/user/", json={
+        "name": "cold", "surname": "start", "citizen_id": str(random.randrange(10**12, 10**13)),
+        "birth_date": "1990-01-01", "occupation": "tester", "address": "bangkok", "password": "cold_start",
+    })
+    register_done = time.perf_counter()
+print(json.dumps({
+    "status": first.status_code,
+    "import": imported - started,
+    "startup_hooks": warmed - imported,
+    "first_request": first_done - warmed,
+    "second_request": second_done - first_done,
+    "first_register": register_done - second_done,
+    "to_first_response": first_done - started,
+    "clock": clock,
+}))
+"""
+
+PHASES = [
+    "process_start", "import", "startup_hooks", "first_request", "second_request",
+    "first_register", "to_first_response",
+]
+
+
+def run_once():
+    spawned = time.time()
+    output = subprocess.run(
+        [sys.executable, "-c", WORKER], capture_output=True, text=True, check=True, env=os.environ.copy()
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    # interpreter start-up, from spawning the process until the app import began
+    result["process_start"] = result["clock"] - spawned
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="write every run and the medians to this JSON file")
+    args = parser.parse_args(argv)
+    runs = [run_once() for _ in range(args.runs)]
+    medians = {phase: statistics.median(run[phase] for run in runs) for phase in PHASES}
+    print(f"{'phase':20} {'median ms':>10}")
+    for phase in PHASES:
+        print(f"{phase:20} {medians[phase] * 1000:>10.1f}")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"runs": runs, "median": medians}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Compare two result files of `benchmarks.load` and flag the endpoints whose
+tail latency or throughput got worse by more than the threshold.
+
+    python -m benchmarks.compare baseline.json candidate.json --threshold 0.10
+
+Exits with 1 when there is a regression, so it can gate a CI job.
+"""
+import argparse
+import json
+import sys
+
+# metric, whether a higher value is better
+METRICS = [("p50_ms", False), ("p95_ms", False), ("p99_ms", False), ("rps", True)]
+
+
+def load(path: str):
+    with open(path) as result:
+        return json.load(result)
+
+
+def change(before, after):
+    if before in (None, 0) or after is None:
+        return None
+    return (after - before) / before
+
+
+def compare(baseline: dict, candidate: dict, threshold: float):
+    """Rows of (endpoint, metric, before, after, relative change, regressed)."""
+    rows = []
+    baseline_endpoints = {**baseline["endpoints"], "total": baseline["total"]}
+    candidate_endpoints = {**candidate["endpoints"], "total": candidate["total"]}
+    for endpoint in sorted(set(baseline_endpoints) & set(candidate_endpoints)):
+        for metric, higher_is_better in METRICS:
+            before = baseline_endpoints[endpoint][metric]
+            after = candidate_endpoints[endpoint][metric]
+            relative = change(before, after)
+            worse = relative is not None and (-relative if higher_is_better else relative) > threshold
+            rows.append((endpoint, metric, before, after, relative, worse))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative change, e.g. 0.10")
+    args = parser.parse_args(argv)
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    for key in ("scenario", "users", "seed", "target"):
+        if baseline["meta"].get(key) != candidate["meta"].get(key):
+            print(f"warning: {key} differs: {baseline['meta'].get(key)} != {candidate['meta'].get(key)}")
+    rows = compare(baseline, candidate, args.threshold)
+    print(f"{'endpoint':48} {'metric':>7} {'before':>9} {'after':>9} {'change':>8}")
+    for endpoint, metric, before, after, relative, worse in rows:
+        relative = f"{'-':>8}" if relative is None else f"{relative:>+8.1%}"
+        print(
+            f"{endpoint:48} {metric:>7} {_fmt(before)} {_fmt(after)} {relative}"
+            f"{' REGRESSION' if worse else ''}"
+        )
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+def _fmt(value):
+    return f"{'-':>9}" if value is None else f"{value:>9.1f}"
+
+
+if __name__ == "__main__":
+    sys.exit(main())
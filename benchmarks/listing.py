@@ -0,0 +1,88 @@
+"""
+CPU time and memory per listed reservation: the ORM path the list endpoints
+used to take (Reservation instances with their owners, then pydantic and
+FastAPI's JSON encoding) against the projected rows rendered by
+`src.reservation.listing`.
+
+    python -m benchmarks.listing --rows 1000 --repeat 20
+
+Runs on a throwaway SQLite database filled by `benchmarks.seed`.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from typing import List
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import parse_obj_as
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks import seed
+from src.reservation import listing, models
+from src.reservation.repository import reservation
+from src.reservation.repository.loaders import RESERVATION_WITH_OWNER
+from src.reservation.schemas import ShowReservation
+
+
+def orm_page(db, limit: int):
+    query = db.query(models.Reservation).options(*RESERVATION_WITH_OWNER)
+    rows = reservation.by_id(query, limit, None).all()[:limit]
+    content = jsonable_encoder(parse_obj_as(List[ShowReservation], rows))
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def projected_page(db, limit: int):
+    rows = db.execute(reservation.by_id(reservation.listing(), limit, None)).all()[:limit]
+    return listing.render(rows)
+
+
+def measure(render, SessionLocal, rows: int, repeat: int):
+    """Mean seconds and peak traced bytes of rendering one page of `rows`."""
+    db = SessionLocal()
+    try:
+        body = render(db, rows)
+        db.expunge_all()
+        started = time.process_time()
+        for _ in range(repeat):
+            render(db, rows)
+            db.expunge_all()
+        seconds = (time.process_time() - started) / repeat
+        tracemalloc.start()
+        render(db, rows)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        db.close()
+    return seconds, peak, body
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000, help="reservations per page")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'listing.db')}"
+    seed.seed(seed.parse_args(["--users", str(args.rows), "--database-url", url]))
+    engine = create_engine(url)
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    results = {}
+    for name, render in (("orm", orm_page), ("projection", projected_page)):
+        results[name] = measure(render, SessionLocal, args.rows, args.repeat)
+    assert json.loads(results["orm"][2]) == json.loads(results["projection"][2])
+
+    print(f"{'path':12} {'us/row':>8} {'bytes/row':>10}")
+    for name, (seconds, peak, _) in results.items():
+        print(f"{name:12} {seconds / args.rows * 1e6:>8.1f} {peak / args.rows:>10.0f}")
+    (orm_seconds, orm_peak, _), (seconds, peak, _) = results["orm"], results["projection"]
+    print(f"projection is {orm_seconds / seconds:.1f}x less CPU and {orm_peak / peak:.1f}x less memory per row")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
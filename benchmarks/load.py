@@ -0,0 +1,308 @@
+"""
+Scenario-driven HTTP load generator. Every virtual user registers, logs in
+and then keeps picking actions from the scenario's weighted mix until the
+run ends. Latency percentiles and throughput are reported per endpoint and
+can be written as JSON for `benchmarks.compare`.
+
+In-process, against the ASGI app and a throwaway SQLite database:
+
+    python -m benchmarks.load --scenario mixed --users 20 --duration 30 --output run.json
+
+Against a running server, e.g. started with
+`uvicorn src.reservation.main:app` or `gunicorn -k uvicorn.workers.UvicornWorker src.reservation.main:app`:
+
+    python -m benchmarks.load --url http://localhost:8000 --scenario site --output run.json
+
+The same --seed gives every virtual user the same sequence of actions, so two
+runs differ only in the code or environment under test. SQLite in-process
+numbers are for comparing commits with each other, not for sizing production.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import httpx
+
+# relative weights of the actions each virtual user repeats after logging in
+SCENARIOS = {
+    # citizens booking and checking their own reservations
+    "booking": {"create": 6, "get_user": 3, "list_new": 1},
+    # Service Sites polling the day's bookings and reporting vaccinations
+    "site": {"list_new": 5, "list_day": 3, "list_all": 1, "report_taken": 2},
+    "mixed": {"create": 3, "get_user": 2, "list_new": 3, "list_day": 2, "list_all": 1, "report_taken": 2},
+}
+
+PASSWORD = "benchmark_password"
+
+
+def percentile(ordered: list, fraction: float):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    rank = max(1, round(fraction * len(ordered) + 0.5))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(latencies: list, statuses: Counter, seconds: float):
+    ordered = sorted(latencies)
+    errors = sum(count for status, count in statuses.items() if status == "error" or int(status) >= 500)
+    return {
+        "count": len(ordered),
+        "errors": errors,
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        "rps": len(ordered) / seconds if seconds > 0 else 0.0,
+        "mean_ms": sum(ordered) / len(ordered) * 1000 if ordered else None,
+        "p50_ms": _ms(percentile(ordered, 0.50)),
+        "p95_ms": _ms(percentile(ordered, 0.95)),
+        "p99_ms": _ms(percentile(ordered, 0.99)),
+        "max_ms": _ms(ordered[-1] if ordered else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+class Recorder():
+    """Latency and status of every request, by endpoint, after the warm-up."""
+
+    def __init__(self, warmup_until: float):
+        self.warmup_until = warmup_until
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    async def request(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError:
+            response = None
+            status = "error"
+        if start >= self.warmup_until:
+            self.latencies[endpoint].append(time.perf_counter() - start)
+            self.statuses[endpoint][status] += 1
+        return response
+
+    def report(self, seconds: float):
+        endpoints = {
+            endpoint: summarize(self.latencies[endpoint], self.statuses[endpoint], seconds)
+            for endpoint in sorted(self.statuses)
+        }
+        every_latency = [latency for latencies in self.latencies.values() for latency in latencies]
+        every_status = sum(self.statuses.values(), Counter())
+        return endpoints, summarize(every_latency, every_status, seconds)
+
+
+class VirtualUser():
+    def __init__(self, citizen_id: str, mix: dict, recorder: Recorder, rng: random.Random, think: float):
+        self.citizen_id = citizen_id
+        self.actions = list(mix)
+        self.weights = list(mix.values())
+        self.recorder = recorder
+        self.rng = rng
+        self.think = think
+        self.headers = {}
+        self.reservation_ids = []
+
+    def request(self, client, endpoint, method, url, **kwargs):
+        return self.recorder.request(client, endpoint, method, url, headers=self.headers, **kwargs)
+
+    async def run(self, client: httpx.AsyncClient, deadline: float):
+        await self.register(client)
+        await self.login(client)
+        while time.perf_counter() < deadline:
+            action = self.rng.choices(self.actions, self.weights)[0]
+            await getattr(self, action)(client)
+            if self.think:
+                await asyncio.sleep(self.rng.expovariate(1 / self.think))
+
+    async def register(self, client):
+        await self.request(client, "POST /user/", "POST", "/user/", json={
+            "name": "bench",
+            "surname": "mark",
+            "citizen_id": self.citizen_id,
+            "birth_date": "1990-01-01",
+            "occupation": "tester",
+            "address": "bangkok",
+            "password": PASSWORD,
+        })
+
+    async def login(self, client):
+        response = await self.request(
+            client, "POST /login", "POST", "/login",
+            data={"username": self.citizen_id, "password": PASSWORD},
+        )
+        if response is not None and response.status_code == 200:
+            self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def create(self, client):
+        timestamp = datetime.utcnow() + timedelta(minutes=self.rng.randrange(-600, 600))
+        response = await self.request(
+            client, "POST /reservation/", "POST", "/reservation/",
+            json={"register_timestamp": timestamp.isoformat()},
+        )
+        if response is not None and response.status_code == 201:
+            self.reservation_ids.append(response.json()["reservation_id"])
+
+    async def get_user(self, client):
+        await self.request(client, "GET /user/{citizen_id}", "GET", f"/user/{self.citizen_id}")
+
+    async def list_all(self, client):
+        await self.request(client, "GET /reservation/", "GET", "/reservation/", params={"limit": 100})
+
+    async def list_new(self, client):
+        await self.request(client, "GET /reservation/new/", "GET", "/reservation/new/", params={"limit": 100})
+
+    async def list_day(self, client):
+        day = datetime.utcnow().date() - timedelta(days=self.rng.randrange(0, 2))
+        await self.request(
+            client, "GET /reservation/{year}/{month}/{day}", "GET",
+            f"/reservation/{day.year}/{day.month}/{day.day}", params={"limit": 100},
+        )
+
+    async def report_taken(self, client):
+        if not self.reservation_ids:
+            await self.create(client)
+            return
+        reservation_id = self.rng.choice(self.reservation_ids)
+        await self.request(
+            client, "PUT /reservation/report-taken/{reservation_id}", "PUT",
+            f"/reservation/report-taken/{reservation_id}",
+        )
+
+
+def in_process_app():
+    """The app on a fresh SQLite database in a temporary directory."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from src.reservation.main import app
+    from src.reservation.database import Base, get_db
+
+    path = os.path.join(tempfile.mkdtemp(), "load.db")
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False, "timeout": 30})
+    Base.metadata.create_all(bind=engine)
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def override_get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    return app
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    if args.url:
+        transport = None
+        base_url = args.url
+    else:
+        transport = httpx.ASGITransport(app=in_process_app())
+        base_url = "http://benchmark"
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    # ids must not collide with an earlier run against the same database
+    run_id = args.run_id if args.run_id is not None else int(time.time()) % 1_000_000
+    start = time.perf_counter()
+    recorder = Recorder(warmup_until=start + args.warmup)
+    deadline = start + args.warmup + args.duration
+    async with httpx.AsyncClient(
+        base_url=base_url, transport=transport, limits=limits, timeout=args.timeout
+    ) as client:
+        users = [
+            VirtualUser(
+                citizen_id=f"{run_id:06d}{index:07d}",
+                mix=SCENARIOS[args.scenario],
+                recorder=recorder,
+                rng=random.Random(f"{args.seed}:{index}"),
+                think=args.think,
+            )
+            for index in range(args.users)
+        ]
+        await asyncio.gather(*(user.run(client, deadline) for user in users))
+    measured = time.perf_counter() - (start + args.warmup)
+    endpoints, total = recorder.report(measured)
+    return {
+        "meta": {
+            "scenario": args.scenario,
+            "mix": SCENARIOS[args.scenario],
+            "users": args.users,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "think": args.think,
+            "seed": args.seed,
+            "target": args.url or "in-process",
+            "measured_seconds": measured,
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "started": datetime.utcnow().isoformat() + "Z",
+        },
+        "endpoints": endpoints,
+        "total": total,
+    }
+
+
+def print_report(result):
+    print(f"{'endpoint':48} {'count':>7} {'err':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    rows = list(result["endpoints"].items()) + [("total", result["total"])]
+    for endpoint, stats in rows:
+        print(
+            f"{endpoint:48} {stats['count']:>7} {stats['errors']:>5} {stats['rps']:>8.1f} "
+            f"{_fmt(stats['p50_ms'])} {_fmt(stats['p95_ms'])} {_fmt(stats['p99_ms'])}"
+        )
+
+
+def _fmt(value):
+    return f"{'-':>8}" if value is None else f"{value:>8.1f}"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed")
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument(
+        "--warmup", type=float, default=5,
+        help="seconds run before measuring; 0 also measures registration and login",
+    )
+    parser.add_argument("--think", type=float, default=0, help="mean pause between actions in seconds")
+    parser.add_argument("--seed", default="0", help="seed of the action sequences")
+    parser.add_argument("--run-id", type=int, help="six-digit prefix of the citizen ids")
+    parser.add_argument("--url", help="base URL of a running server instead of the in-process app")
+    parser.add_argument("--timeout", type=float, default=30, help="per-request timeout in seconds")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+    return 0 if result["total"]["count"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+Fill an empty database with a synthetic population of citizens and their
+reservations, at production scale.
+
+    python -m benchmarks.seed --users 1000000 --seed 0
+    python -m benchmarks.seed --users 200000 --database-url sqlite:////tmp/seed.db
+
+PostgreSQL is loaded with COPY, SQLite with batched executemany in one
+transaction per block. The schema is the app's, from bootstrap.upgrade,
+indexes and change feed sequence included. Every user gets the same bcrypt
+hash of --password, made with a fixed salt (precomputed for the default
+password), so seeding costs at most one bcrypt instead of millions; the seeded
+citizens can log in with it. The same --seed and arguments always produce the
+same rows, so benchmark runs on seeded databases are comparable.
+"""
+import argparse
+import csv
+import io
+import random
+import sys
+import time
+from bisect import bisect
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+
+from passlib.hash import bcrypt
+from sqlalchemy import create_engine, func, select
+
+from src.reservation import bootstrap
+from src.reservation.config import settings
+from src.reservation.models import Reservation, User, next_change_seq
+from src.reservation.repository import report
+
+DEFAULT_PASSWORD = "benchmark_password"
+# bcrypt's salt for every seeded password, so the rows do not change between runs
+PASSWORD_SALT = "benchmarkseedpassword."
+# bcrypt of DEFAULT_PASSWORD with PASSWORD_SALT at the app's cost of 12
+DEFAULT_PASSWORD_HASH = "$2b$12$benchmarkseedpassword.l9UohzEgo8oTiHsEx7PDK4ffY3L.KUK"
+
+# users generated from one random stream; fixed so the output does not
+# depend on how the rows are batched
+BLOCK = 10_000
+
+# spreads consecutive indexes over the 11 middle digits of the citizen id;
+# coprime with 10**11, so distinct indexes give distinct ids
+ID_MULTIPLIER = 7_919_000_003
+
+FIRST_NAMES = [
+    "Somchai", "Somsak", "Sompong", "Prasert", "Wichai", "Anan", "Kittipong", "Nattapong",
+    "Malee", "Somsri", "Sunisa", "Pranee", "Kanya", "Wanida", "Siriporn", "Nattaya",
+]
+SURNAMES = [
+    "Saetang", "Srisuk", "Wongsawat", "Chaiyaporn", "Rattanakosin", "Thongdee",
+    "Kaewmanee", "Boonmee", "Sukjai", "Phromma", "Jaidee", "Suwannarat",
+]
+PROVINCES = [
+    ("Bangkok", 30), ("Nonthaburi", 6), ("Samut Prakan", 6), ("Chiang Mai", 5),
+    ("Khon Kaen", 4), ("Nakhon Ratchasima", 5), ("Chon Buri", 5), ("Songkhla", 4),
+    ("Udon Thani", 3), ("Phuket", 2),
+]
+OCCUPATIONS = [
+    ("office worker", 22), ("farmer", 16), ("merchant", 12), ("student", 10),
+    ("laborer", 10), ("retired", 9), ("civil servant", 7), ("driver", 5),
+    ("teacher", 4), ("nurse", 2), ("doctor", 1), ("unemployed", 2),
+]
+# (youngest, oldest, weight) of the adult population
+AGE_BANDS = [(18, 29, 19), (30, 44, 27), (45, 59, 26), (60, 74, 20), (75, 95, 8)]
+# share of bookings per hour of the day, following clinic opening hours
+HOUR_WEIGHTS = [0, 0, 0, 0, 0, 0, 1, 4, 9, 12, 12, 10, 5, 8, 10, 9, 6, 4, 2, 1, 1, 1, 0, 0]
+# reservations per user
+RESERVATION_COUNTS = [(0, 15), (1, 55), (2, 30)]
+
+
+def password_hash(password: str):
+    if password == DEFAULT_PASSWORD:
+        return DEFAULT_PASSWORD_HASH
+    return bcrypt.using(salt=PASSWORD_SALT, rounds=12, ident="2b").hash(password)
+
+
+def citizen_id(index: int, first_digit: int):
+    """A 13-digit citizen id with a valid Thai checksum, unique per `index`."""
+    body = f"{first_digit}{index * ID_MULTIPLIER % 10**11:011d}"
+    total = sum(int(digit) * (13 - position) for position, digit in enumerate(body))
+    return body + str((11 - total % 11) % 10)
+
+
+def weighted(pairs):
+    values, weights = zip(*pairs)
+    return list(values), list(accumulate(weights))
+
+
+def pick(rng: random.Random, table):
+    values, cumulative = table
+    return rng.choices(values, cum_weights=cumulative)[0]
+
+
+class Population():
+    """Deterministic generator of user and reservation rows."""
+
+    def __init__(self, seed: str, start: date, days: int, peak_days: int, password_hash: str, as_of: date):
+        self.seed = seed
+        self.password_hash = password_hash
+        self.as_of = as_of
+        rng = random.Random(f"{seed}:calendar")
+        self.days = [start + timedelta(days=offset) for offset in range(days)]
+        peaks = set(rng.sample(range(days), min(peak_days, days)))
+        # weekends are quieter, campaign days are several times busier
+        day_weights = [
+            (5.0 if offset in peaks else 1.0) * (0.6 if day.weekday() >= 5 else 1.0)
+            for offset, day in enumerate(self.days)
+        ]
+        self.day_weights = list(accumulate(day_weights))
+        self.hour_weights = list(accumulate(HOUR_WEIGHTS))
+        self.provinces = weighted(PROVINCES)
+        self.occupations = weighted(OCCUPATIONS)
+        self.age_bands = weighted([((young, old), weight) for young, old, weight in AGE_BANDS])
+        self.reservation_counts = weighted(RESERVATION_COUNTS)
+
+    def block(self, number: int, first_user_id: int, size: int):
+        """Users `number * BLOCK` up to `+ size` and their reservations, as tuples."""
+        rng = random.Random(f"{self.seed}:{number}")
+        users = []
+        reservations = []
+        for offset in range(size):
+            index = number * BLOCK + offset
+            user_id = first_user_id + index
+            young, old = pick(rng, self.age_bands)
+            birth_date = self.as_of - timedelta(days=rng.randrange(young * 365, (old + 1) * 365))
+            users.append((
+                user_id,
+                rng.choice(FIRST_NAMES),
+                rng.choice(SURNAMES),
+                citizen_id(index, rng.randrange(1, 9)),
+                birth_date,
+                pick(rng, self.occupations),
+                f"{rng.randrange(1, 999)}/{rng.randrange(1, 99)} {pick(rng, self.provinces)}",
+                self.password_hash,
+                0,
+            ))
+            for _ in range(pick(rng, self.reservation_counts)):
+                day = self.days[bisect(self.day_weights, rng.random() * self.day_weights[-1])]
+                hour = bisect(self.hour_weights, rng.random() * self.hour_weights[-1])
+                timestamp = datetime(day.year, day.month, day.day, hour) + timedelta(
+                    seconds=rng.randrange(3600), microseconds=rng.randrange(1_000_000)
+                )
+                # most bookings older than a week have been honoured by now
+                vaccinated = rng.random() < (0.85 if (self.as_of - day).days > 7 else 0.2)
+                reservations.append((timestamp, user_id, vaccinated, timestamp.date(), 0))
+        return users, reservations
+
+
+USER_COLUMNS = [
+    "user_id", "name", "surname", "citizen_id", "birth_date",
+    "occupation", "address", "password", "token_version",
+]
+RESERVATION_COLUMNS = ["register_timestamp", "user_id", "vaccinated", "reservation_date", "priority"]
+
+
+def _copy_rows(cursor, table: str, columns: list, rows: list):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def load_postgresql(connection, users: list, reservations: list):
+    cursor = connection.cursor()
+    _copy_rows(cursor, "users", USER_COLUMNS, users)
+    _copy_rows(cursor, "reservations", RESERVATION_COLUMNS, reservations)
+    connection.commit()
+
+
+def _insert_many(cursor, table: str, columns: list, rows: list, placeholder: str):
+    placeholders = ", ".join([placeholder] * len(columns))
+    cursor.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+
+
+def load_executemany(connection, users: list, reservations: list, placeholder: str):
+    cursor = connection.cursor()
+    _insert_many(cursor, "users", USER_COLUMNS, users, placeholder)
+    _insert_many(cursor, "reservations", RESERVATION_COLUMNS, reservations, placeholder)
+    connection.commit()
+
+
+def seed(args):
+    engine = create_engine(args.database_url)
+    bootstrap.upgrade(engine)
+    with engine.connect() as connection:
+        if connection.execute(select(func.count()).select_from(User.__table__)).scalar():
+            sys.exit("The users table is not empty; seed into an empty database so runs are comparable.")
+    population = Population(
+        args.seed, args.start, args.days, args.peak_days, password_hash(args.password), args.as_of
+    )
+    dialect = engine.dialect.name
+    raw = engine.raw_connection()
+    try:
+        if dialect == "sqlite":
+            # a throwaway benchmark database does not need to survive a power cut
+            raw.cursor().execute("PRAGMA synchronous = OFF")
+        started = time.perf_counter()
+        user_count = reservation_count = 0
+        for number in range((args.users + BLOCK - 1) // BLOCK):
+            size = min(BLOCK, args.users - number * BLOCK)
+            users, reservations = population.block(number, 1, size)
+            if dialect == "postgresql":
+                load_postgresql(raw, users, reservations)
+            else:
+                placeholder = "?" if engine.dialect.paramstyle == "qmark" else "%s"
+                load_executemany(raw, users, reservations, placeholder)
+            user_count += len(users)
+            reservation_count += len(reservations)
+            elapsed = time.perf_counter() - started
+            print(
+                f"\r{user_count:>10} users {reservation_count:>10} reservations "
+                f"{(user_count + reservation_count) / elapsed:>10.0f} rows/s",
+                end="", flush=True,
+            )
+        if dialect == "postgresql":
+            # user ids were given explicitly, move the serial past them
+            cursor = raw.cursor()
+            cursor.execute("SELECT setval(pg_get_serial_sequence('users', 'user_id'), (SELECT max(user_id) FROM users))")
+            cursor.execute("ANALYZE users")
+            cursor.execute("ANALYZE reservations")
+            raw.commit()
+        print()
+    finally:
+        raw.close()
+    # the rows went in behind the app's back, so count them into the report
+    # and number them for the change feed
+    with engine.begin() as connection:
+        for statement in report.reconcile_statements(dialect):
+            connection.execute(statement)
+        if dialect == "sqlite":
+            connection.execute(bootstrap.backfill(Reservation.__table__, change_seq=next_change_seq()))
+    bootstrap.sequence_changes(engine)
+    engine.dispose()
+    return user_count, reservation_count
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--seed", default="0")
+    parser.add_argument("--database-url", default=settings.database_url)
+    parser.add_argument("--start", type=date.fromisoformat, default=date(2021, 10, 1),
+                        help="first day of the booking window")
+    parser.add_argument("--days", type=int, default=90, help="length of the booking window")
+    parser.add_argument("--peak-days", type=int, default=6, help="campaign days with five times the bookings")
+    parser.add_argument("--as-of", type=date.fromisoformat, default=date(2022, 1, 15),
+                        help="the day ages and vaccinations are computed for")
+    # same as benchmarks.load, so the load generator could log seeded users in
+    parser.add_argument("--password", default=DEFAULT_PASSWORD)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    seed(parse_args())
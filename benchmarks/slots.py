@@ -0,0 +1,145 @@
+"""
+Booking surge against a handful of slots: many concurrent clients book
+through `repository.slot` at once, far more of them than there are seats.
+Reports the booking throughput and checks that no slot was overbooked and
+that every seat taken belongs to exactly one reservation.
+
+    python -m benchmarks.slots --clients 32 --attempts 20000 --slots 10 --capacity 500
+    python -m benchmarks.slots --mode slot --database-url postgresql://localhost/bench
+
+--mode day books the earliest free slot of the day (FOR UPDATE SKIP LOCKED on
+PostgreSQL), --mode slot books a randomly chosen slot by id every time. Without
+--database-url it runs on a throwaway SQLite database.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from src.reservation.database import Base
+from src.reservation.models import Reservation, Slot
+from src.reservation.repository import slot
+from src.reservation.schemas import Principal
+
+SITE = "benchmark"
+DAY = datetime(2021, 10, 22)
+
+
+def open_slots(SessionLocal, count: int, capacity: int):
+    db = SessionLocal()
+    slots = [
+        Slot(site=SITE, start=DAY + timedelta(hours=8, minutes=15 * index), capacity=capacity, booked=0)
+        for index in range(count)
+    ]
+    db.add_all(slots)
+    db.commit()
+    slot_ids = [new_slot.slot_id for new_slot in slots]
+    db.close()
+    return slot_ids
+
+
+def check(SessionLocal, slot_ids: list, booked_ok: int):
+    """Problems found in the database after the run, none when it is consistent."""
+    db = SessionLocal()
+    try:
+        slots = {row.slot_id: row for row in db.query(Slot).filter(Slot.slot_id.in_(slot_ids))}
+        seats = dict(
+            db.execute(
+                select(Reservation.slot_id, func.count())
+                .where(Reservation.slot_id.in_(slot_ids))
+                .group_by(Reservation.slot_id)
+            ).all()
+        )
+    finally:
+        db.close()
+    problems = []
+    for slot_id, row in slots.items():
+        if row.booked > row.capacity:
+            problems.append(f"slot {slot_id} overbooked: {row.booked} > {row.capacity}")
+        if seats.get(slot_id, 0) != row.booked:
+            problems.append(f"slot {slot_id} counts {row.booked} seats but has {seats.get(slot_id, 0)} reservations")
+    if sum(seats.values()) != booked_ok:
+        problems.append(f"{booked_ok} bookings succeeded but {sum(seats.values())} reservations exist")
+    return problems
+
+
+def run(args):
+    if args.database_url:
+        engine = create_engine(args.database_url, pool_size=args.clients, max_overflow=0)
+    else:
+        url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'slots.db')}"
+        # writers wait for SQLite's lock instead of failing
+        engine = create_engine(url, connect_args={"check_same_thread": False, "timeout": 60})
+    Base.metadata.create_all(bind=engine)
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    slot_ids = open_slots(SessionLocal, args.slots, args.capacity)
+
+    outcomes = Counter()
+    latencies = []
+    lock = threading.Lock()
+    rng = random.Random(args.seed)
+    targets = [rng.choice(slot_ids) for _ in range(args.attempts)]
+
+    def attempt(index: int):
+        user = Principal(user_id=index + 1, citizen_id=f"{index:013d}")
+        db = SessionLocal()
+        started = time.perf_counter()
+        try:
+            if args.mode == "slot":
+                slot.book(targets[index], db, user)
+            else:
+                slot.book_any(SITE, DAY.year, DAY.month, DAY.day, db, user)
+            outcome = "booked"
+        except HTTPException as error:
+            outcome = str(error.status_code)
+        finally:
+            db.close()
+        with lock:
+            outcomes[outcome] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        list(pool.map(attempt, range(args.attempts)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    problems = check(SessionLocal, slot_ids, outcomes["booked"])
+    engine.dispose()
+    seats = args.slots * args.capacity
+    print(f"{engine.dialect.name}, mode {args.mode}: {args.attempts} attempts by {args.clients} clients "
+          f"for {seats} seats in {args.slots} slots")
+    print(f"{args.attempts / elapsed:.0f} attempts/s, p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+    print("outcomes: " + ", ".join(f"{name} {count}" for name, count in sorted(outcomes.items())))
+    for problem in problems:
+        print(problem)
+    if not problems:
+        print("consistent: no slot overbooked, one reservation per seat taken")
+    return problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["day", "slot"], default="day")
+    parser.add_argument("--clients", type=int, default=32, help="concurrent booking clients")
+    parser.add_argument("--attempts", type=int, default=5000, help="bookings tried in total")
+    parser.add_argument("--slots", type=int, default=10)
+    parser.add_argument("--capacity", type=int, default=200, help="seats per slot")
+    parser.add_argument("--seed", default="0")
+    parser.add_argument("--database-url", help="an empty database to run on instead of a temporary SQLite file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(1 if run(parse_args()) else 0)
@@ -0,0 +1,20 @@
+import os
+import shutil
+import tempfile
+from prometheus_client import multiprocess
+
+# Workers write their metrics to files in this directory and /metrics merges
+# them, so every scrape sees the totals of all workers. It must be set before
+# the workers import the app.
+multiproc_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "reservation-metrics")
+)
+
+
+def on_starting(server):
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,116 @@
+"""
+Create the database schema, or bring an existing one up to date, outside the
+app's import path. Run it once per deploy before the workers start (the
+Procfile release step) and after pulling changes in development:
+
+    python -m src.reservation.bootstrap
+"""
+from sqlalchemy import func, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn, DDL
+
+from . import models  # registers the tables on Base.metadata
+from .database import Base, engine
+from .repository import changes, report
+
+
+
+def backfill(table, **values):
+    # filling in a column is not a change to the rows: leave the columns a
+    # write's onupdate would set (the change feed's) as they are
+    unchanged = {column.name: column for column in table.columns if column.onupdate is not None}
+    return table.update().values({**unchanged, **values})
+
+
+# values for the existing rows of a column added by `upgrade`, where NULL
+# would be wrong; keyed by (table, column) and run once all of the table's
+# new columns are there
+BACKFILLS = {
+    # the UTC day of the stored wall clock; DATE() does that on SQLite and PostgreSQL
+    ("reservations", "reservation_date"): lambda table: backfill(
+        table, reservation_date=func.date(table.c.register_timestamp)
+    ),
+    # the existing rows come first in the change feed, in id order on SQLite;
+    # PostgreSQL numbers them at the end of `upgrade` (see models.next_change_seq)
+    ("reservations", "change_seq"): lambda table: backfill(
+        table, change_seq=models.next_change_seq()
+    ),
+}
+
+SEQUENCES = [models.CHANGE_SEQUENCE]
+
+# statements that fill a table created by `upgrade` from the existing data
+FILLS = {
+    "daily_reports": report.reconcile_statements,
+}
+
+
+def upgrade(bind):
+    """
+    Create the missing tables, and the columns and indexes added to the models
+    since an existing table was created. Returns what was done.
+    """
+    done = []
+    # run last, once every table they read from is up to date
+    fills = []
+    with bind.begin() as connection:
+        if connection.dialect.supports_sequences:
+            for sequence in SEQUENCES:
+                if not connection.dialect.has_sequence(connection, sequence.name):
+                    sequence.create(connection)
+                    done.append(f"created sequence {sequence.name}")
+        inspector = inspect(connection)
+        existing = set(inspector.get_table_names())
+        preparer = connection.dialect.identifier_preparer
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                table.create(connection)
+                done.append(f"created table {table.name}")
+                if table.name in FILLS:
+                    fills.append(table.name)
+                continue
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            added = [column for column in table.columns if column.name not in columns]
+            for column in added:
+                definition = CreateColumn(column).compile(dialect=connection.dialect)
+                connection.execute(DDL(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {definition}"))
+                done.append(f"added column {table.name}.{column.name}")
+            for (table_name, column_name), fill_in in BACKFILLS.items():
+                if table_name == table.name and column_name in {column.name for column in added}:
+                    connection.execute(fill_in(table))
+                    done.append(f"filled in {table.name}.{column_name}")
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    done.append(f"created index {index.name}")
+        for name in fills:
+            for statement in FILLS[name](connection.dialect.name):
+                connection.execute(statement)
+            done.append(f"filled in {name}")
+    # what the upgrade left unnumbered, rather than leave it to the feed's first readers
+    numbered = sequence_changes(bind)
+    if numbered:
+        done.append(f"numbered {numbered} changes")
+    return done
+
+
+def sequence_changes(bind):
+    """
+    Number every change PostgreSQL left without a change_seq, batch by
+    batch (see repository.changes.sequence_pending). Returns how many.
+    """
+    numbered = 0
+    if bind.dialect.name != "postgresql":
+        return numbered
+    with Session(bind) as db:
+        while True:
+            batch = changes.sequence_pending(db)
+            if not batch:
+                return numbered
+            numbered += batch
+
+
+if __name__ == "__main__":
+    for step in upgrade(engine) or ["schema is up to date"]:
+        print(step)
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import threading
+from typing import Optional
+
+from .config import settings
+from .database import engine
+
+# Tells every worker's stream hub (stream.Hub) that reservations changed. A
+# message carries nothing: the hub reads what changed from the change feed,
+# which is also where a reconnecting client resumes from, so a lost or
+# coalesced message only delays events until the next one. Writers call
+# `announce_changes` after they commit.
+#
+# "memory" reaches the hubs of this process only; "postgres" reaches every
+# worker through LISTEN/NOTIFY; "polling" is the stand-in for more than one
+# worker without PostgreSQL: each hub also wakes every STREAM_POLL_INTERVAL
+# seconds and looks for changes itself.
+
+CHANNEL = "reservation_changes"
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBroker():
+    """Wakes the listeners of this process; `publish` may be called from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = set()
+
+    def publish(self):
+        with self._lock:
+            listeners = list(self._listeners)
+        for loop, event in listeners:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # the listener's loop is closed
+                pass
+
+    async def listen(self):
+        """Yield once per wake-up; wake-ups while the listener is busy collapse into one."""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self._lock:
+            self._listeners.add((loop, event))
+        task = self.start_listening(loop, event)
+        try:
+            while True:
+                await self.wait(event)
+                event.clear()
+                yield
+        finally:
+            with self._lock:
+                self._listeners.discard((loop, event))
+            if task is not None:
+                task.cancel()
+
+    def start_listening(self, loop, event: asyncio.Event) -> Optional[asyncio.Task]:
+        # a task that sets `event` on messages from other processes
+        return None
+
+    async def wait(self, event: asyncio.Event):
+        await event.wait()
+
+    def close(self):
+        pass
+
+
+class PollingBroker(MemoryBroker):
+    """`MemoryBroker` whose listeners also wake every `interval` seconds."""
+
+    def __init__(self, interval: float):
+        super().__init__()
+        self.interval = interval
+
+    async def wait(self, event: asyncio.Event):
+        try:
+            await asyncio.wait_for(event.wait(), self.interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+class PostgresBroker(MemoryBroker):
+    """
+    NOTIFY on CHANNEL after commits, LISTEN on it for the hubs of this
+    process. Publishing only flags a notifier thread, so writers never wait
+    for the NOTIFY and a burst of commits sends one.
+    """
+
+    # seconds before listening again after the connection dropped
+    reconnect_delay = 1.0
+
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+        self._pending = threading.Event()
+        self._closed = False
+        self._notifier: Optional[threading.Thread] = None
+
+    def publish(self):
+        super().publish()
+        with self._lock:
+            if self._notifier is None:
+                self._notifier = threading.Thread(target=self._notify, name="broker-notify", daemon=True)
+                self._notifier.start()
+        self._pending.set()
+
+    def _notify(self):
+        while True:
+            self._pending.wait()
+            if self._closed:
+                return
+            self._pending.clear()
+            try:
+                connection = self.engine.raw_connection()
+                try:
+                    connection.cursor().execute("SELECT pg_notify(%s, '')", (CHANNEL,))
+                    connection.commit()
+                finally:
+                    connection.close()
+            except Exception:
+                logger.exception("NOTIFY %s failed", CHANNEL)
+
+    def start_listening(self, loop, event: asyncio.Event):
+        return loop.create_task(self._listen(loop, event))
+
+    def _connect(self):
+        # a connection of its own, taken out of the pool: it stays in LISTEN for good
+        pooled = self.engine.raw_connection()
+        pooled.detach()
+        connection = pooled.connection
+        connection.autocommit = True
+        connection.cursor().execute(f"LISTEN {CHANNEL}")
+        return connection
+
+    async def _listen(self, loop, event: asyncio.Event):
+        while True:
+            connection = None
+            try:
+                connection = await loop.run_in_executor(None, self._connect)
+                descriptor = connection.fileno()
+                lost = loop.create_future()
+
+                def on_readable():
+                    try:
+                        connection.poll()
+                    except Exception as error:
+                        if not lost.done():
+                            lost.set_result(error)
+                        return
+                    if connection.notifies:
+                        connection.notifies.clear()
+                        event.set()
+
+                loop.add_reader(descriptor, on_readable)
+                # whatever was committed while nobody listened is in the feed
+                event.set()
+                try:
+                    error = await lost
+                finally:
+                    loop.remove_reader(descriptor)
+                logger.warning("LISTEN %s connection lost: %s", CHANNEL, error)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("LISTEN %s failed", CHANNEL)
+            finally:
+                if connection is not None and not connection.closed:
+                    connection.close()
+            await asyncio.sleep(self.reconnect_delay)
+
+    def close(self):
+        self._closed = True
+        self._pending.set()
+
+
+def create_broker(kind: str, bind=None):
+    if kind == "memory":
+        return MemoryBroker()
+    if kind == "polling":
+        return PollingBroker(settings.stream_poll_interval)
+    if kind == "postgres":
+        return PostgresBroker(bind)
+    raise ValueError(f"Unknown STREAM_BROKER {kind!r}, expected memory, polling or postgres")
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """This process's broker, made from STREAM_BROKER on first use."""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                kind = settings.stream_broker
+                if kind == "auto":
+                    kind = "postgres" if engine.dialect.name == "postgresql" else "polling"
+                _broker = create_broker(kind, engine)
+    return _broker
+
+
+def announce_changes():
+    """Called by the repository after it committed a reservation write."""
+    get_broker().publish()
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, timezone
+from typing import Optional
+
+from fastapi import Request, Response, status
+from fastapi.routing import APIRoute
+
+from .config import settings
+from .database import reads_pinned
+from .metrics import RESPONSE_CACHE_LOOKUPS
+
+# Serialized GET responses of the endpoints Service Sites poll, kept per
+# worker process. Every entry is tagged with what it shows (a day, a user,
+# each reservation in it) and the write paths in repository/reservation.py
+# drop exactly the entries carrying the tags they touch. A write served by
+# another worker is only seen here once RESPONSE_CACHE_TTL has passed.
+
+
+def day_tag(day: date):
+    return f"day:{day.isoformat()}"
+
+
+def user_tag(user_id: int):
+    return f"user:{user_id}"
+
+
+def reservation_tag(reservation_id: int):
+    return f"reservation:{reservation_id}"
+
+
+def timestamp_day(register_timestamp: datetime):
+    # the day a timestamp is listed under, see repository.reservation.day_bounds
+    if register_timestamp.tzinfo is not None:
+        register_timestamp = register_timestamp.astimezone(timezone.utc)
+    return register_timestamp.date()
+
+
+def written_tags(reservation_id: Optional[int], user_id: int, register_timestamp: datetime):
+    """Tags of the entries a reservation written with these values may appear in."""
+    tags = [day_tag(timestamp_day(register_timestamp)), user_tag(user_id)]
+    if reservation_id is not None:
+        tags.append(reservation_tag(reservation_id))
+    return tags
+
+
+class CachedResponse():
+    __slots__ = ("body", "headers", "etag", "expires", "tags")
+
+    def __init__(self, body: bytes, headers: dict, expires: float, tags: set):
+        self.body = body
+        self.etag = 'W/"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.headers = {**headers, "etag": self.etag}
+        self.expires = expires
+        self.tags = tags
+
+
+class ResponseCache():
+    """LRU cache of `CachedResponse` with a TTL and tag-based invalidation."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_by_tag = defaultdict(set)
+        # bumped by every invalidation so a read that raced a write is not stored
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl > 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, body: bytes, headers: dict, tags, generation: int):
+        """
+        Store a response that was computed while the cache was at `generation`
+        and return its entry; it is not stored if something was invalidated since.
+        """
+        entry = CachedResponse(body, headers, time.monotonic() + self.ttl, set(tags))
+        with self._lock:
+            if generation != self.generation:
+                return entry
+            self._remove(key)
+            self._entries[key] = entry
+            for tag in entry.tags:
+                self._keys_by_tag[tag].add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+        return entry
+
+    def invalidate(self, *tags: str):
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in self._keys_by_tag.pop(tag, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._keys_by_tag.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry.tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+
+response_cache = ResponseCache(settings.response_cache_size, settings.response_cache_ttl)
+
+
+def cached(tags):
+    """
+    Mark a GET endpoint as cacheable by `CachedRoute`. `tags(request, payload)`
+    returns the tags of a response from its request and decoded JSON body.
+    """
+    def mark(endpoint):
+        endpoint.cache_tags = tags
+        return endpoint
+    return mark
+
+
+def reservation_tags(reservations: list):
+    return [reservation_tag(item["reservation_id"]) for item in reservations]
+
+
+def day_listing(request: Request, payload: list):
+    params = request.path_params
+    day = date(int(params["year"]), int(params["month"]), int(params["day"]))
+    return [day_tag(day), *reservation_tags(payload)]
+
+
+def today_listing(request: Request, payload: list):
+    # the UTC day, the one written_tags invalidates
+    return [day_tag(datetime.utcnow().date()), *reservation_tags(payload)]
+
+
+def user_detail(request: Request, payload: dict):
+    return [user_tag(payload["user_id"]), *reservation_tags(payload["reservations"])]
+
+
+def cache_key(request: Request):
+    query = sorted(request.query_params.multi_items())
+    return f"{request.url.path}?{query}"
+
+
+def etag_matches(if_none_match: Optional[str], etag: str):
+    # weak comparison: W/"x" and "x" are the same validator
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:]
+    return any(
+        candidate.strip() in (etag, opaque) for candidate in if_none_match.split(",")
+    )
+
+
+class CachedRoute(APIRoute):
+    """
+    Route that serves endpoints marked with `cached` from `response_cache`
+    and answers a matching If-None-Match with 304 Not Modified.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        tags = getattr(self.endpoint, "cache_tags", None)
+        if tags is None:
+            return handler
+        hits = RESPONSE_CACHE_LOOKUPS.labels(self.path, "hit")
+        misses = RESPONSE_CACHE_LOOKUPS.labels(self.path, "miss")
+
+        async def cached_handler(request: Request):
+            # a client reading its own write must not get a response cached from a replica
+            if not response_cache.enabled or reads_pinned(request):
+                return await handler(request)
+            key = cache_key(request)
+            entry = response_cache.get(key)
+            if entry is None:
+                misses.inc()
+                generation = response_cache.generation
+                response = await handler(request)
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+                headers = {
+                    name: value for name, value in response.headers.items()
+                    if name != "content-length"
+                }
+                entry = response_cache.put(
+                    key, response.body, headers, tags(request, json.loads(response.body)), generation
+                )
+            else:
+                hits.inc()
+            if etag_matches(request.headers.get("if-none-match"), entry.etag):
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"etag": entry.etag})
+            return Response(entry.body, headers=entry.headers)
+
+        return cached_handler
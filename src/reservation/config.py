@@ -3,13 +3,89 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+def env_flag(name: str, default: str = "false", environ=os.environ):
+    return environ.get(name, default).lower() in ("1", "true", "yes")
+
+def sqlalchemy_url(url: str):
+    # Heroku hands out postgres:// URLs, which SQLAlchemy 1.4 no longer accepts
+    if url and url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql://", 1)
+    return url
+
+def required(environ, *names: str):
+    """Fail with the names of the variables among `names` that are unset or empty."""
+    missing = [name for name in names if not environ.get(name)]
+    if missing:
+        raise RuntimeError(
+            f"Missing required environment variable(s): {', '.join(missing)}; "
+            "set them in the environment or in .env"
+        )
+
+def env_urls(name: str, environ=os.environ):
+    # comma separated database URLs
+    return [sqlalchemy_url(url.strip()) for url in environ.get(name, "").split(",") if url.strip()]
+
 class Settings():
-    secret_key: str = os.environ.get("SECRET_KEY")
-    algorithm: str = os.environ.get("ALGORITHM")
-    access_token_expire_minutes: int = int(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES"))
-    if 'postgres' in os.environ.get('DATABASE_URL'):
-        database_url: str = os.environ.get('DATABASE_URL').replace("://", "ql://", 1)
-    else:
-        database_url: str = os.environ.get('DATABASE_URL')
-
-settings = Settings()
\ No newline at end of file
+    """
+    The configuration, read from `environ` (the process environment and .env)
+    when the instance is created rather than when this module is imported.
+    """
+
+    def __init__(self, environ=os.environ):
+        required(environ, "DATABASE_URL", "SECRET_KEY", "ALGORITHM")
+        self.secret_key: str = environ.get("SECRET_KEY")
+        self.algorithm: str = environ.get("ALGORITHM")
+        self.access_token_expire_minutes: int = int(environ.get("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
+        self.database_url: str = sqlalchemy_url(environ.get("DATABASE_URL"))
+        self.token_cache_size: int = int(environ.get("TOKEN_CACHE_SIZE", 10000))
+        self.token_version_ttl: int = int(environ.get("TOKEN_VERSION_TTL", 30))
+        self.default_page_size: int = int(environ.get("DEFAULT_PAGE_SIZE", 100))
+        self.max_page_size: int = int(environ.get("MAX_PAGE_SIZE", 1000))
+        self.hash_workers: int = int(environ.get("HASH_WORKERS", os.cpu_count() or 1))
+        self.hash_queue_limit: int = int(environ.get("HASH_QUEUE_LIMIT", 64))
+        self.hash_retry_after: int = int(environ.get("HASH_RETRY_AFTER", 1))
+        self.max_bulk_size: int = int(environ.get("MAX_BULK_SIZE", 5000))
+        self.database_async: bool = env_flag("DATABASE_ASYNC", environ=environ)
+        # connection pool, per worker process (ignored for SQLite)
+        self.db_pool_size: int = int(environ.get("DB_POOL_SIZE", 5))
+        self.db_max_overflow: int = int(environ.get("DB_MAX_OVERFLOW", 10))
+        self.db_pool_timeout: float = float(environ.get("DB_POOL_TIMEOUT", 30))
+        self.db_pool_recycle: int = int(environ.get("DB_POOL_RECYCLE", 1800))
+        self.db_pool_pre_ping: bool = env_flag("DB_POOL_PRE_PING", "true", environ)
+        # PostgreSQL statement_timeout in milliseconds, 0 disables it
+        self.db_statement_timeout_ms: int = int(environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+        # connections each worker opens at startup, before it reports ready
+        self.db_pool_warm: int = int(environ.get("DB_POOL_WARM", 1))
+        # read replicas for GET endpoints, none means every read goes to the primary
+        self.database_replica_urls: list = env_urls("DATABASE_REPLICA_URLS", environ)
+        # seconds a replica that failed to connect is left out of the rotation
+        self.replica_retry_after: float = float(environ.get("REPLICA_RETRY_AFTER", 30))
+        # seconds a client's reads stay on the primary after it wrote, to cover replica lag
+        self.read_your_writes_seconds: float = float(environ.get("READ_YOUR_WRITES_SECONDS", 5))
+        # cached GET responses per worker process, 0 disables the cache
+        self.response_cache_size: int = int(environ.get("RESPONSE_CACHE_SIZE", 1024))
+        self.response_cache_ttl: float = float(environ.get("RESPONSE_CACHE_TTL", 5))
+        # seconds an Idempotency-Key and its stored response are kept
+        self.idempotency_ttl: float = float(environ.get("IDEMPOTENCY_TTL", 86400))
+        # seconds a duplicate waits for the first request with its key before a 409
+        self.idempotency_wait: float = float(environ.get("IDEMPOTENCY_WAIT", 10))
+        # seconds after which a key whose request never finished may be taken over
+        self.idempotency_lock_timeout: float = float(environ.get("IDEMPOTENCY_LOCK_TIMEOUT", 60))
+        # how GET /reservation/stream hears of writes made by other workers:
+        # memory, polling or postgres; auto is postgres on PostgreSQL, else polling
+        self.stream_broker: str = environ.get("STREAM_BROKER", "auto")
+        # seconds between looks at the change feed with the polling broker
+        self.stream_poll_interval: float = float(environ.get("STREAM_POLL_INTERVAL", 1))
+        # seconds of quiet before a stream sends a heartbeat comment
+        self.stream_heartbeat: float = float(environ.get("STREAM_HEARTBEAT", 15))
+        # events a stream may fall behind by before it is closed (the client resumes from the feed)
+        self.stream_queue_size: int = int(environ.get("STREAM_QUEUE_SIZE", 1000))
+        # answer PUT /reservation/report-taken/{id} once journaled, and update the database in batches
+        self.report_write_behind: bool = env_flag("REPORT_WRITE_BEHIND", environ=environ)
+        # where each worker keeps its journal; replayed at startup after a crash
+        self.report_journal_dir: str = environ.get("REPORT_JOURNAL_DIR", "report-journal")
+        # milliseconds the journaled reports wait to be flushed together, unless the batch fills first
+        self.report_flush_interval_ms: float = float(environ.get("REPORT_FLUSH_INTERVAL_MS", 5))
+        self.report_flush_batch: int = int(environ.get("REPORT_FLUSH_BATCH", 500))
+
+settings = Settings()
@@ -1,11 +1,87 @@
-from sqlalchemy import create_engine
+import itertools
+import time
+from fastapi import Depends, Request, Response
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from .config import settings
+from . import metrics
 
 SQLALCHEMY_DATABASE_URL = settings.database_url
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# async drivers used when DATABASE_ASYNC is enabled
+ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+
+class _InstrumentedPool():
+    """Records checkout wait time and live pool usage in the metrics."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            metrics.DB_POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            metrics.DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+            self._report_usage()
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        self._report_usage()
+
+    def _report_usage(self):
+        metrics.DB_POOL_CHECKED_OUT.set(self.checkedout())
+        metrics.DB_POOL_OVERFLOW.set(self.overflow())
+
+
+class InstrumentedQueuePool(_InstrumentedPool, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(_InstrumentedPool, AsyncAdaptedQueuePool):
+    pass
+
+
+def engine_options(url: str, use_async: bool = False):
+    """Pool and timeout arguments for `create_engine` from the settings."""
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    options = {
+        "poolclass": InstrumentedAsyncQueuePool if use_async else InstrumentedQueuePool,
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+    }
+    if settings.db_statement_timeout_ms:
+        if use_async:
+            options["connect_args"] = {
+                "server_settings": {"statement_timeout": str(settings.db_statement_timeout_ms)}
+            }
+        else:
+            options["connect_args"] = {
+                "options": f"-c statement_timeout={settings.db_statement_timeout_ms}"
+            }
+    return options
+
+
+def pool_status(engine):
+    """Live usage of the engine's pool; pools without a fixed size report what they can."""
+    pool = engine.pool
+    status = {"pool": type(pool).__name__}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        if hasattr(pool, name):
+            status[name] = getattr(pool, name)()
+    return status
+
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL))
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -16,4 +92,176 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+def async_database_url(url: str):
+    """Same database as `url`, reached through the async driver of its dialect."""
+    url = make_url(url)
+    return str(url.set(drivername=f"{url.get_backend_name()}+{ASYNC_DRIVERS[url.get_backend_name()]}"))
+
+
+class Replica():
+    def __init__(self, url: str):
+        self.url = url
+        self.engine = create_engine(url, **engine_options(url))
+        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self._async_sessions = None
+        # time.monotonic() before which the replica is skipped
+        self.down_until = 0.0
+
+    def AsyncSessionLocal(self):
+        # made on first use: only the async routes of DATABASE_ASYNC read through it
+        if self._async_sessions is None:
+            async_engine = create_async_engine(
+                async_database_url(self.url), **engine_options(self.url, use_async=True)
+            )
+            self._async_sessions = sessionmaker(
+                async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+            )
+        return self._async_sessions()
+
+    def status(self):
+        return {
+            "url": repr(self.engine.url),
+            "healthy": self.down_until <= time.monotonic(),
+            **pool_status(self.engine),
+        }
+
+
+class ReplicaSet():
+    """
+    Round-robin over the read replicas. A replica that cannot be connected to
+    is left out for `retry_after` seconds and then tried again.
+    """
+
+    def __init__(self, urls: list, retry_after: float):
+        self.replicas = [Replica(url) for url in urls]
+        self.retry_after = retry_after
+        self._turn = itertools.count()
+
+    def _rotation(self):
+        # the healthy replicas, starting from the next one's turn
+        start = next(self._turn)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if replica.down_until <= time.monotonic():
+                yield replica
+
+    def _failed(self, replica: Replica):
+        replica.down_until = time.monotonic() + self.retry_after
+        metrics.DB_REPLICA_FAILURES.inc()
+
+    def session(self):
+        """A connected session on the next healthy replica, or None if none answers."""
+        if not self.replicas:
+            return None
+        for replica in self._rotation():
+            db = replica.SessionLocal()
+            try:
+                db.connection()
+            except exc.DBAPIError:
+                db.close()
+                self._failed(replica)
+                continue
+            return db
+        return None
+
+    async def async_session(self):
+        """`session` for the async routes: a connected AsyncSession, or None."""
+        if not self.replicas:
+            return None
+        for replica in self._rotation():
+            db = replica.AsyncSessionLocal()
+            try:
+                await db.connection()
+            except exc.DBAPIError:
+                await db.close()
+                self._failed(replica)
+                continue
+            return db
+        return None
+
+
+replicas = ReplicaSet(settings.database_replica_urls, settings.replica_retry_after)
+
+# set on write responses: until the time it holds, the client reads from the primary
+READ_PRIMARY_COOKIE = "read_primary_until"
+
+
+def pin_reads_to_primary(response: Response):
+    """
+    Dependency of the write routes: the client's next reads go to the primary
+    so it sees its own write even while the replicas lag behind.
+    """
+    if replicas.replicas:
+        seconds = settings.read_your_writes_seconds
+        response.set_cookie(
+            READ_PRIMARY_COOKIE,
+            str(time.time() + seconds),
+            max_age=int(seconds) + 1,
+            httponly=True,
+            samesite="lax",
+        )
+
+
+def reads_pinned(request: Request):
+    try:
+        return float(request.cookies[READ_PRIMARY_COOKIE]) > time.time()
+    except (KeyError, ValueError):
+        return False
+
+
+def get_read_db(request: Request, primary: Session = Depends(get_db)):
+    """
+    Session for read-only endpoints: a replica when one is configured and
+    answering, otherwise the primary session of `get_db`.
+    """
+    db = None if reads_pinned(request) else replicas.session()
+    if db is None:
+        metrics.DB_READ_SESSIONS.labels("primary").inc()
+        yield primary
+        return
+    metrics.DB_READ_SESSIONS.labels("replica").inc()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def supports_returning(db):
+    """Whether writes on this session can use INSERT/UPDATE/DELETE ... RETURNING."""
+    return db.get_bind().dialect.name == "postgresql"
+
+
+async_engine = None
+AsyncSessionLocal = None
+
+if settings.database_async:
+    async_engine = create_async_engine(
+        async_database_url(SQLALCHEMY_DATABASE_URL),
+        **engine_options(SQLALCHEMY_DATABASE_URL, use_async=True),
+    )
+    # objects must stay readable after commit: an async session cannot lazy-load on access
+    AsyncSessionLocal = sessionmaker(
+        async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+    )
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_async_read_db(request: Request, primary: AsyncSession = Depends(get_async_db)):
+    """`get_read_db` for the async routes."""
+    db = None if reads_pinned(request) else await replicas.async_session()
+    if db is None:
+        metrics.DB_READ_SESSIONS.labels("primary").inc()
+        yield primary
+        return
+    metrics.DB_READ_SESSIONS.labels("replica").inc()
+    try:
+        yield db
+    finally:
+        await db.close()
@@ -0,0 +1,86 @@
+import csv
+import io
+import json
+import zlib
+from enum import Enum
+
+# Rows are buffered into chunks of roughly this many bytes before they are
+# handed to the response, so a large export is not sent one tiny write per row.
+CHUNK_SIZE = 64 * 1024
+
+COLUMNS = (
+    "reservation_id",
+    "register_timestamp",
+    "vaccinated",
+    "citizen_id",
+    "name",
+    "surname",
+    "birth_date",
+    "occupation",
+    "address",
+)
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.csv: "text/csv",
+}
+
+
+def _values(row):
+    return [
+        value.isoformat() if hasattr(value, "isoformat") else value
+        for value in row
+    ]
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(COLUMNS, _values(row)))) + "\n"
+
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for row in rows:
+        writer.writerow(_values(row))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def chunked(lines):
+    """Join encoded lines into chunks of about CHUNK_SIZE bytes."""
+    chunk = []
+    size = 0
+    for line in lines:
+        data = line.encode()
+        chunk.append(data)
+        size += len(data)
+        if size >= CHUNK_SIZE:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(rows, export_format: ExportFormat, compress: bool = False):
+    lines = csv_lines(rows) if export_format == ExportFormat.csv else ndjson_lines(rows)
+    chunks = chunked(lines)
+    return gzipped(chunks) if compress else chunks
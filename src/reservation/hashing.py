@@ -1,11 +1,100 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
+from .config import settings
+from . import metrics
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt of "warm-up" at the minimum cost, verified to load the backend
+WARM_UP_HASH = "$2b$04$vDzK0M9tyHzCLYcD4xmPiOLEolpxzngeA44FhUaKCufOgn9SdHHD."
+
 class Hash():
     def bcrypt(password: str):
         return pwd_context.hash(password)
 
     def verify_password(plain_password, hashed_password):
         return pwd_context.verify(plain_password, hashed_password)
-        
\ No newline at end of file
+
+
+def _timed(function, *args):
+    # runs in the hashing process, so the duration excludes the time spent queued
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+class HashExecutor():
+    """
+    Runs bcrypt in a dedicated process pool so hashing bursts do not starve
+    the request worker. At most `workers + queue_limit` jobs may be pending;
+    past that callers get a 503 with Retry-After straight away instead of
+    queueing without bound. With `workers=0` jobs run in the event loop's
+    default thread pool instead (useful for development).
+    """
+
+    def __init__(self, workers: int, queue_limit: int, retry_after: int):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.retry_after = retry_after
+        self.pending = 0
+        self._pool = None
+
+    def _executor(self):
+        if self.workers and self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    async def run(self, operation: str, function, *args):
+        if self.pending >= self.workers + self.queue_limit:
+            metrics.HASH_REJECTED.labels(operation).inc()
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many password requests, try again later",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        self.pending += 1
+        submitted = time.perf_counter()
+        try:
+            result, hash_seconds = await asyncio.get_running_loop().run_in_executor(
+                self._executor(), _timed, function, *args
+            )
+        finally:
+            self.pending -= 1
+        metrics.HASH_SECONDS.labels(operation).observe(hash_seconds)
+        metrics.HASH_QUEUE_WAIT_SECONDS.labels(operation).observe(
+            max(time.perf_counter() - submitted - hash_seconds, 0)
+        )
+        return result
+
+    async def bcrypt(self, password: str):
+        return await self.run("hash", Hash.bcrypt, password)
+
+    async def verify_password(self, plain_password, hashed_password):
+        return await self.run("verify", Hash.verify_password, plain_password, hashed_password)
+
+    async def warm_up(self):
+        """
+        Start every hashing process and load the bcrypt backend in each, so
+        the first logins do not wait for it.
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(self._executor(), Hash.verify_password, "warm-up", WARM_UP_HASH)
+            for _ in range(max(self.workers, 1))
+        ))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+hash_executor = HashExecutor(
+    settings.hash_workers, settings.hash_queue_limit, settings.hash_retry_after
+)
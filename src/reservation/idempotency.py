@@ -0,0 +1,297 @@
+import asyncio
+import hashlib
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Optional
+from uuid import UUID
+
+from fastapi import HTTPException, Request, Response, status
+from sqlalchemy import exc
+from starlette.concurrency import run_in_threadpool
+
+from .cache import CachedRoute
+from .config import settings
+from .database import get_db
+from .metrics import IDEMPOTENT_REQUESTS
+from .models import IdempotencyKey
+
+# A POST marked with `idempotent` and sent with an Idempotency-Key header is
+# handled at most once per key. The first request claims the key by
+# inserting its row; the response is stored on that row for
+# IDEMPOTENCY_TTL and replayed to every retry. A duplicate arriving while
+# the first is still running waits for its response, whichever worker it
+# lands on, instead of repeating the work. Server errors and exceptions
+# release the key so the client's retry is handled afresh.
+#
+# Keys are scoped by route and caller: the Authorization header, or on an
+# unauthenticated route the body's citizen_id. An anonymous request without
+# one shares its scope with every other client, so its key must be a UUID.
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+# the body field telling unauthenticated callers apart
+ANONYMOUS_CALLER_FIELD = "citizen_id"
+
+# backoff between looks at a key whose first request is still running
+FIRST_POLL_SECONDS = 0.05
+MAX_POLL_SECONDS = 0.5
+
+
+def idempotent(endpoint):
+    """Mark a POST endpoint as honouring the Idempotency-Key header in `IdempotentRoute`."""
+    endpoint.idempotent = True
+    return endpoint
+
+
+def replayable(status_code: int):
+    # the outcome of a request the client should not simply retry
+    return status_code < 500 and status_code != status.HTTP_429_TOO_MANY_REQUESTS
+
+
+def digest(value: str):
+    return hashlib.sha256(value.encode()).hexdigest()[:32]
+
+
+def request_caller(request: Request, body: bytes) -> Optional[str]:
+    """
+    Who a key belongs to: the credentials, or on an unauthenticated route the
+    citizen id in the body (a registration is its citizen's); None when
+    neither tells the callers apart.
+    """
+    credentials = request.headers.get("authorization", "")
+    if credentials:
+        return digest(credentials)
+    try:
+        citizen_id = json.loads(body).get(ANONYMOUS_CALLER_FIELD)
+    except (ValueError, AttributeError):
+        citizen_id = None
+    if isinstance(citizen_id, str) and citizen_id:
+        return digest(f"{ANONYMOUS_CALLER_FIELD}:{citizen_id}")
+    return None
+
+
+def request_scope(request: Request, path: str, caller: Optional[str]):
+    """The route and caller a key belongs to."""
+    return f"{request.method} {path} {caller or 'anonymous'}"
+
+
+def is_uuid(key: str):
+    try:
+        UUID(key)
+    except ValueError:
+        return False
+    return True
+
+
+@contextmanager
+def store_session(request: Request):
+    # the database the endpoints write to, through the same (overridable) dependency
+    provider = request.app.dependency_overrides.get(get_db, get_db)
+    sessions = provider()
+    try:
+        yield next(sessions)
+    finally:
+        sessions.close()
+
+
+def claim(db, scope: str, key: str, fingerprint: str, now: Optional[datetime] = None):
+    """
+    Claim `key` for a new request and return None, or return the row of the
+    request that already holds it. Expired keys and keys abandoned for longer
+    than IDEMPOTENCY_LOCK_TIMEOUT are claimed anew.
+    """
+    now = now or datetime.utcnow()
+    while True:
+        db.add(IdempotencyKey(
+            scope=scope,
+            key=key,
+            fingerprint=fingerprint,
+            created_at=now,
+            expires_at=now + timedelta(seconds=settings.idempotency_ttl),
+        ))
+        try:
+            db.commit()
+            return None
+        except exc.IntegrityError:
+            db.rollback()
+        held = (
+            db.query(IdempotencyKey)
+            .filter(IdempotencyKey.scope == scope, IdempotencyKey.key == key)
+            .populate_existing()
+            .first()
+        )
+        if held is None:
+            # released between the INSERT and the SELECT
+            continue
+        db.expunge(held)
+        same_row = (
+            (IdempotencyKey.scope == scope)
+            & (IdempotencyKey.key == key)
+            & (IdempotencyKey.created_at == held.created_at)
+        )
+        if held.expires_at <= now:
+            db.query(IdempotencyKey).filter(same_row).delete(synchronize_session=False)
+            db.commit()
+            continue
+        abandoned = now - timedelta(seconds=settings.idempotency_lock_timeout)
+        if held.status_code is None and held.created_at <= abandoned:
+            taken = (
+                db.query(IdempotencyKey)
+                .filter(same_row, IdempotencyKey.status_code.is_(None))
+                .update(
+                    {"fingerprint": fingerprint, "created_at": now},
+                    synchronize_session=False,
+                )
+            )
+            db.commit()
+            if taken:
+                return None
+            continue
+        return held
+
+
+def complete(db, scope: str, key: str, response: Response):
+    db.query(IdempotencyKey).filter(
+        IdempotencyKey.scope == scope, IdempotencyKey.key == key
+    ).update(
+        {
+            "status_code": response.status_code,
+            "content_type": response.headers.get("content-type"),
+            "body": bytes(response.body),
+        },
+        synchronize_session=False,
+    )
+    db.commit()
+
+
+def release(db, scope: str, key: str):
+    db.query(IdempotencyKey).filter(
+        IdempotencyKey.scope == scope,
+        IdempotencyKey.key == key,
+        IdempotencyKey.status_code.is_(None),
+    ).delete(synchronize_session=False)
+    db.commit()
+
+
+def purge_expired(db, now: Optional[datetime] = None):
+    deleted = (
+        db.query(IdempotencyKey)
+        .filter(IdempotencyKey.expires_at <= (now or datetime.utcnow()))
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return deleted
+
+
+class KeyStore():
+    """The `claim`/`complete`/`release` calls of one request, each in its own short session."""
+
+    # expired keys are deleted by whichever request comes first after this many seconds
+    purge_every = 60.0
+
+    def __init__(self):
+        self.next_purge = 0.0
+
+    def _run(self, request: Request, operation, *args):
+        with store_session(request) as db:
+            if time.monotonic() >= self.next_purge:
+                self.next_purge = time.monotonic() + self.purge_every
+                purge_expired(db)
+            return operation(db, *args)
+
+    async def claim(self, request: Request, scope: str, key: str, fingerprint: str):
+        return await run_in_threadpool(self._run, request, claim, scope, key, fingerprint)
+
+    async def complete(self, request: Request, scope: str, key: str, response: Response):
+        await run_in_threadpool(self._run, request, complete, scope, key, response)
+
+    async def release(self, request: Request, scope: str, key: str):
+        await run_in_threadpool(self._run, request, release, scope, key)
+
+
+key_store = KeyStore()
+
+
+def replay(held: IdempotencyKey):
+    headers = {REPLAYED_HEADER: "true"}
+    if held.content_type:
+        headers["content-type"] = held.content_type
+    return Response(held.body or b"", status_code=held.status_code, headers=headers)
+
+
+class IdempotentRoute(CachedRoute):
+    """
+    `CachedRoute` that also handles the endpoints marked with `idempotent`
+    at most once per Idempotency-Key.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        if not getattr(self.endpoint, "idempotent", False):
+            return handler
+        path = self.path
+        outcomes = {
+            outcome: IDEMPOTENT_REQUESTS.labels(path, outcome)
+            for outcome in ("handled", "replayed", "waited", "mismatch", "in_progress")
+        }
+
+        async def idempotent_handler(request: Request):
+            key = request.headers.get(IDEMPOTENCY_HEADER)
+            if key is None:
+                return await handler(request)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail=f"{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters",
+                )
+            body = await request.body()
+            caller = request_caller(request, body)
+            if caller is None and not is_uuid(key):
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail=f"{IDEMPOTENCY_HEADER} must be a UUID on an unauthenticated request",
+                )
+            scope = request_scope(request, path, caller)
+            fingerprint = hashlib.sha256(body).hexdigest()
+            deadline = time.monotonic() + settings.idempotency_wait
+            delay = FIRST_POLL_SECONDS
+            waited = False
+            while True:
+                held = await key_store.claim(request, scope, key, fingerprint)
+                if held is None:
+                    break
+                if held.fingerprint != fingerprint:
+                    outcomes["mismatch"].inc()
+                    raise HTTPException(
+                        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        detail=f"This {IDEMPOTENCY_HEADER} was already used for a different request",
+                    )
+                if held.status_code is not None:
+                    outcomes["waited" if waited else "replayed"].inc()
+                    return replay(held)
+                if time.monotonic() >= deadline:
+                    outcomes["in_progress"].inc()
+                    raise HTTPException(
+                        status_code=status.HTTP_409_CONFLICT,
+                        detail=f"A request with this {IDEMPOTENCY_HEADER} is still in progress",
+                        headers={"Retry-After": str(max(1, round(settings.idempotency_wait)))},
+                    )
+                waited = True
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_POLL_SECONDS)
+            outcomes["handled"].inc()
+            try:
+                response = await handler(request)
+            except BaseException:
+                await key_store.release(request, scope, key)
+                raise
+            if replayable(response.status_code):
+                await key_store.complete(request, scope, key, response)
+            else:
+                await key_store.release(request, scope, key)
+            return response
+
+        return idempotent_handler
@@ -0,0 +1,362 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional, Set
+
+from .config import settings
+from .database import SessionLocal
+
+try:
+    import fcntl
+except ImportError:  # Windows: no locks, so run a single worker there
+    fcntl = None
+
+# Write-behind for PUT /reservation/report-taken/{id} (REPORT_WRITE_BEHIND).
+# The request is answered once the id is appended to this worker's journal
+# and synced to disk; a flusher thread marks the journaled ids vaccinated
+# with one bulk UPDATE every REPORT_FLUSH_INTERVAL_MS milliseconds, or as
+# soon as REPORT_FLUSH_BATCH ids are waiting. Until then reads of the
+# reservation show it vaccinated, in every worker: a worker knows its own
+# pending ids and reads the other workers' from their journals.
+#
+# Marking a reservation vaccinated twice changes nothing, so the journal only
+# has to be replayed at least once: at startup every journal left behind by a
+# worker that is gone (its lock file is free) is applied and removed.
+#
+# A lock file is only ever removed by whoever holds its lock, so a worker
+# that locks one checks afterwards that it is still the file at that name.
+#
+# A flush that fails is retried with an exponential backoff, up to
+# MAX_RETRY_SECONDS apart, and logged at most every LOG_FAILURES_EVERY seconds.
+#
+# A worker's files in REPORT_JOURNAL_DIR, by process id:
+#   report-taken-<pid>.lock               held for the life of the worker
+#   report-taken-<pid>.journal            ids appended since the last flush
+#   report-taken-<pid>.journal.flushing   the ids of the flush in progress
+
+PREFIX = "report-taken-"
+
+MAX_RETRY_SECONDS = 30.0
+LOG_FAILURES_EVERY = 60.0
+
+logger = logging.getLogger(__name__)
+
+# fdatasync skips the metadata an appended line does not need
+sync = getattr(os, "fdatasync", os.fsync)
+
+
+def sync_directory(directory: str):
+    # makes a created or renamed file's name durable
+    if os.name != "posix":
+        return
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def read_ids(path: str):
+    """The ids journaled in `path`; a line cut short by a crash was never acknowledged."""
+    try:
+        with open(path, "rb") as journal:
+            content = journal.read()
+    except FileNotFoundError:
+        return []
+    return [int(line) for line in content.split(b"\n")[:-1] if line.strip().isdigit()]
+
+
+def lock(path: str, create: bool = True, blocking: bool = True):
+    """
+    The open lock file at `path`, locked, or None if it is missing or (not
+    `blocking`) held by a live worker.
+    """
+    while True:
+        try:
+            lock_file = open(path, "a" if create else "r")
+        except FileNotFoundError:
+            return None
+        if fcntl is None:
+            return lock_file
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            lock_file.close()
+            return None
+        try:
+            linked = os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path))
+        except FileNotFoundError:
+            linked = False
+        if linked:
+            return lock_file
+        # recovered and removed by another worker while we waited for it
+        lock_file.close()
+        if not create:
+            return None
+
+
+def retry_delay(interval: float, failures: int):
+    """How long to wait before the next flush after `failures` failed ones in a row."""
+    return min(interval * 2 ** min(failures, 32), MAX_RETRY_SECONDS)
+
+
+def chunks(ids, size: int):
+    ids = sorted(set(ids))
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+class WriteBehind():
+    """
+    One worker's journal and flusher. `apply(ids, db)` marks the reservations
+    `ids` vaccinated and commits (repository.reservation.report_taken_many).
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        apply: Callable,
+        sessions=SessionLocal,
+        interval: float = 0.005,
+        batch_size: int = 500,
+        worker=None,
+    ):
+        self.directory = directory
+        self.apply = apply
+        self.sessions = sessions
+        self.interval = interval
+        self.batch_size = batch_size
+        name = os.path.join(directory, f"{PREFIX}{worker or os.getpid()}")
+        self.lock_path = name + ".lock"
+        self.path = name + ".journal"
+        self.flushing_path = self.path + ".flushing"
+        # _lock guards the journal file and the pending set, _sync_lock the syncs
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closing = False
+        self._written = 0
+        self._synced = 0
+        self._pending: Set[int] = set()
+        self._flushing: Set[int] = set()
+        self._lock_file = None
+        self._journal = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = lock(self.lock_path)
+        # a worker that had this process id before is gone: its journal too
+        self.recover()
+        self._journal = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        sync_directory(self.directory)
+        self._thread = threading.Thread(target=self._run, name="report-flusher", daemon=True)
+        self._thread.start()
+
+    def recover(self):
+        """Apply the journals of the workers that are gone, then remove them."""
+        for entry in sorted(os.listdir(self.directory)):
+            if not (entry.startswith(PREFIX) and entry.endswith(".lock")):
+                continue
+            lock_path = os.path.join(self.directory, entry)
+            if lock_path == self.lock_path:
+                self._replay(lock_path)
+                continue
+            lock_file = lock(lock_path, create=False, blocking=False)
+            if lock_file is None:
+                # its worker is alive, or another worker recovered it
+                continue
+            with lock_file:
+                self._replay(lock_path)
+                # removed while still locked, so no other worker replays it again
+                os.remove(lock_path)
+
+    def _replay(self, lock_path: str):
+        path = lock_path[:-len(".lock")] + ".journal"
+        ids = read_ids(path + ".flushing") + read_ids(path)
+        if ids:
+            logger.info("Replaying %d vaccination reports from %s", len(ids), path)
+            self._apply(ids)
+        for leftover in (path + ".flushing", path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    def _apply(self, ids):
+        db = self.sessions()
+        try:
+            for chunk in chunks(ids, min(self.batch_size, settings.max_bulk_size)):
+                self.apply(chunk, db)
+        finally:
+            db.close()
+
+    def append(self, reservation_id: int):
+        """Journal `reservation_id`; returns once the line is on disk."""
+        with self._lock:
+            if self._journal is None:
+                raise RuntimeError("the report journal is closed")
+            os.write(self._journal, b"%d\n" % reservation_id)
+            self._written += 1
+            written = self._written
+            # pending in the same step as the line, so a flush takes both or neither
+            self._pending.add(reservation_id)
+            # the first wakes the idle flusher, a full batch has it flush now
+            wake = len(self._pending) in (1, self.batch_size)
+        self._sync(written)
+        if wake:
+            self._wake.set()
+
+    def _sync(self, written: int):
+        # group commit: one sync covers every line written before it started
+        if self._synced >= written:
+            return
+        with self._sync_lock:
+            if self._synced >= written:
+                return
+            with self._lock:
+                target = self._written
+                journal = self._journal
+            sync(journal)
+            self._synced = target
+
+    def is_pending(self, reservation_id: int):
+        """Whether this worker or another one journaled a report of the reservation not flushed yet."""
+        if reservation_id in self._pending or reservation_id in self._flushing:
+            return True
+        return any(reservation_id in ids for ids in self.journaled_elsewhere())
+
+    def journaled_elsewhere(self):
+        """The ids in the other workers' journals, each journal's as one list."""
+        for entry in sorted(os.listdir(self.directory)):
+            if not (entry.startswith(PREFIX) and entry.endswith(".lock")):
+                continue
+            lock_path = os.path.join(self.directory, entry)
+            if lock_path == self.lock_path:
+                continue
+            path = lock_path[:-len(".lock")] + ".journal"
+            # the journal before the flush it turns into, and the flush's file
+            # is only removed after its commit, so an id on its way from one
+            # to the other or to the database is never missed
+            yield read_ids(path)
+            yield read_ids(path + ".flushing")
+
+    def _rotate(self):
+        """Move the journal aside as the next flush and start a new one."""
+        with self._sync_lock, self._lock:
+            if not self._pending:
+                return set()
+            sync(self._journal)
+            self._synced = self._written
+            os.close(self._journal)
+            os.replace(self.path, self.flushing_path)
+            self._journal = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            sync_directory(self.directory)
+            # flushing first: a read checking both sets never misses the id
+            self._flushing = self._pending
+            self._pending = set()
+            return self._flushing
+
+    def flush(self):
+        """Write the journaled ids to the database; a failed flush is retried whole."""
+        batch = self._flushing or self._rotate()
+        if not batch:
+            return
+        self._apply(batch)
+        os.remove(self.flushing_path)
+        self._flushing = set()
+
+    def _run(self):
+        failures = 0
+        logged = None
+        while True:
+            if not (self._pending or self._flushing or self._closing):
+                self._wake.wait()
+                self._wake.clear()
+            if failures:
+                # the database is likely down: a full batch does not cut this short
+                self._wait(retry_delay(self.interval, failures))
+            elif not self._closing:
+                # the reports arriving meanwhile go in the same UPDATE
+                self._wake.wait(self.interval)
+                self._wake.clear()
+            closing = self._closing
+            try:
+                self.flush()
+            except Exception:
+                failures += 1
+                now = time.monotonic()
+                if logged is None or now - logged >= LOG_FAILURES_EVERY:
+                    logged = now
+                    logger.exception(
+                        "Flushing vaccination reports failed (%d in a row), retrying in %.3gs",
+                        failures, retry_delay(self.interval, failures),
+                    )
+            else:
+                if failures:
+                    logger.info("Flushed vaccination reports after %d failed attempts", failures)
+                failures = 0
+                logged = None
+            if closing:
+                # what is left is replayed at the next start
+                return
+
+    def _wait(self, seconds: float):
+        # sleeps `seconds` unless the worker stops meanwhile
+        deadline = time.monotonic() + seconds
+        while not self._closing:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._wake.wait(remaining)
+            self._wake.clear()
+
+    def stop(self):
+        """Flush what is left and close the journal."""
+        self._closing = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._sync_lock, self._lock:
+            if self._journal is not None:
+                sync(self._journal)
+                self._synced = self._written
+                os.close(self._journal)
+                self._journal = None
+        if not self._pending and not self._flushing:
+            os.remove(self.path)
+            os.remove(self.lock_path)
+        if self._lock_file is not None:
+            self._lock_file.close()
+
+
+write_behind: Optional[WriteBehind] = None
+
+
+def start(apply: Callable, sessions=SessionLocal, directory: Optional[str] = None):
+    """Replay what crashed workers left and journal this worker's reports."""
+    global write_behind
+    writer = WriteBehind(
+        directory or settings.report_journal_dir,
+        apply,
+        sessions,
+        settings.report_flush_interval_ms / 1000,
+        settings.report_flush_batch,
+    )
+    writer.start()
+    write_behind = writer
+
+
+def stop():
+    global write_behind
+    if write_behind is not None:
+        writer, write_behind = write_behind, None
+        writer.stop()
+
+
+def is_pending(reservation_id: int):
+    """
+    Whether a journaled vaccination report of the reservation is not in the
+    database yet. Ask before reading the reservation: a report flushed in
+    between is then in what the read sees.
+    """
+    return write_behind is not None and write_behind.is_pending(reservation_id)
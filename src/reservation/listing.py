@@ -0,0 +1,39 @@
+import orjson
+from fastapi import Response
+
+from .pagination import NEXT_CURSOR_HEADER
+
+# The list endpoints skip the ORM and pydantic: their rows come from
+# repository.reservation.listing() in the column order of LISTING_COLUMNS and
+# are written straight to JSON here, in the same shape and field order as
+# List[ShowReservation] (which stays their documented response_model).
+
+
+def render(rows):
+    """JSON array of ShowReservation objects, one per listing row."""
+    return orjson.dumps([
+        {
+            "reservation_id": reservation_id,
+            "register_timestamp": register_timestamp,
+            "vaccinated": vaccinated,
+            "priority": priority,
+            "owner": {
+                "name": name,
+                "surname": surname,
+                "birth_date": birth_date,
+                "citizen_id": citizen_id,
+                "occupation": occupation,
+                "address": address,
+            },
+        }
+        for (
+            reservation_id, register_timestamp, vaccinated, priority,
+            name, surname, birth_date, citizen_id, occupation, address,
+        ) in rows
+    ])
+
+
+def response(rows, next_cursor):
+    """A page of listing rows with the cursor of the next page, if any."""
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor is not None else None
+    return Response(render(rows), media_type="application/json", headers=headers)
@@ -1,8 +1,13 @@
-from fastapi import FastAPI
+from fastapi import APIRouter, FastAPI, Response
+from fastapi.dependencies.utils import get_parameterless_sub_dependant
 from fastapi.middleware.cors import CORSMiddleware
-from . import models
-from .database import engine
-from .routers import reservation, user, authentication
+from . import journal, metrics, startup, stream
+from .broker import get_broker
+from .config import settings
+from .hashing import hash_executor
+from .idempotency import REPLAYED_HEADER
+from .pagination import NEXT_CURSOR_HEADER
+from .routers import reservation, user, slot, report, authentication, monitoring, health, reservation_async, user_async
 
 app = FastAPI(title="Flamby")
 
@@ -14,10 +19,80 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, REPLAYED_HEADER],
 )
-
-models.Base.metadata.create_all(engine)
+app.add_middleware(metrics.MetricsMiddleware, routes=app.router.routes)
 
 app.include_router(reservation.router)
 app.include_router(user.router)
-app.include_router(authentication.router)
\ No newline at end of file
+app.include_router(slot.router)
+app.include_router(report.router)
+app.include_router(authentication.router)
+app.include_router(monitoring.router)
+app.include_router(health.router)
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    content, media_type = metrics.exposition()
+    return Response(content, media_type=media_type)
+
+
+@app.on_event("startup")
+async def warm_up():
+    await startup.warm_up()
+
+
+@app.on_event("shutdown")
+def stop_hash_executor():
+    hash_executor.shutdown()
+
+
+@app.on_event("shutdown")
+def flush_report_journal():
+    journal.stop()
+
+
+@app.on_event("shutdown")
+async def stop_stream_hub():
+    await stream.hub.stop()
+    get_broker().close()
+
+
+def use_async_routes(app: FastAPI, *routers: APIRouter):
+    """
+    Swap each already included route for the async route with the same path
+    and methods. The route keeps its place in the routing order, its
+    documentation and its route dependencies (pin_reads_to_primary etc.).
+    """
+    # include them first so the copies are bound to the app (dependency overrides etc.)
+    included = len(app.router.routes)
+    for router in routers:
+        app.include_router(router)
+    replacements = {
+        (route.path, frozenset(route.methods)): route
+        for route in app.router.routes[included:]
+    }
+    del app.router.routes[included:]
+    for index, route in enumerate(app.router.routes):
+        replacement = replacements.pop((route.path, frozenset(getattr(route, "methods", None) or ())), None)
+        if replacement is None:
+            continue
+        replacement.summary = route.summary
+        replacement.description = route.description
+        replacement.responses = route.responses
+        for depends in route.dependencies[::-1]:
+            if depends in replacement.dependencies:
+                continue
+            # what APIRoute does with the dependencies it is created with
+            replacement.dependant.dependencies.insert(
+                0, get_parameterless_sub_dependant(depends=depends, path=replacement.path_format)
+            )
+            replacement.dependencies.insert(0, depends)
+        app.router.routes[index] = replacement
+    if replacements:
+        raise RuntimeError(f"async routes without a sync counterpart: {sorted(replacements)}")
+
+
+if settings.database_async:
+    use_async_routes(app, reservation_async.router, user_async.router)
@@ -0,0 +1,212 @@
+import os
+import time
+from contextvars import ContextVar
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Under gunicorn every worker writes its samples to files in
+# PROMETHEUS_MULTIPROC_DIR (see gunicorn.conf.py) and /metrics merges them.
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time to serve a request, by route template and response status",
+    ["method", "route", "status"],
+    buckets=REQUEST_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds",
+    "Time spent executing database statements while serving a request",
+    ["method", "route"],
+    buckets=REQUEST_BUCKETS,
+)
+
+HASH_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HASH_SECONDS = Histogram(
+    "password_hash_seconds",
+    "Time spent computing a bcrypt hash or verification in the hashing pool",
+    ["operation"],
+    buckets=HASH_BUCKETS,
+)
+HASH_QUEUE_WAIT_SECONDS = Histogram(
+    "password_hash_queue_wait_seconds",
+    "Time a bcrypt job waited for a free hashing process",
+    ["operation"],
+    buckets=HASH_BUCKETS,
+)
+HASH_REJECTED = Counter(
+    "password_hash_rejected_total",
+    "bcrypt jobs turned away with 503 because the hashing queue was full",
+    ["operation"],
+)
+
+RESPONSE_CACHE_LOOKUPS = Counter(
+    "response_cache_lookups_total",
+    "Lookups of cacheable GET responses, by route template and hit or miss",
+    ["route", "result"],
+)
+
+IDEMPOTENT_REQUESTS = Counter(
+    "idempotent_requests_total",
+    "Requests sent with an Idempotency-Key, by route template and whether they "
+    "were handled, replayed, or refused",
+    ["route", "outcome"],
+)
+
+DB_READ_SESSIONS = Counter(
+    "db_read_sessions_total",
+    "Sessions handed to read-only endpoints, by the database serving them",
+    ["target"],
+)
+DB_REPLICA_FAILURES = Counter(
+    "db_replica_failures_total",
+    "Read replicas taken out of the rotation because they could not be reached",
+)
+
+DB_POOL_WAIT_SECONDS = Histogram(
+    "db_pool_wait_seconds",
+    "Time spent waiting to check a connection out of the pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 30.0),
+)
+DB_POOL_TIMEOUTS = Counter(
+    "db_pool_timeouts_total",
+    "Checkouts that gave up after DB_POOL_TIMEOUT seconds",
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out",
+    "Connections currently checked out of the pool",
+    multiprocess_mode="livesum",
+)
+DB_POOL_OVERFLOW = Gauge(
+    "db_pool_overflow",
+    "Connections open beyond DB_POOL_SIZE (negative while the pool is not full)",
+    multiprocess_mode="livesum",
+)
+
+
+def histogram_snapshot(histogram: Histogram):
+    """Cumulative bucket counts, count and sum of an unlabelled histogram."""
+    snapshot = {"buckets": {}, "count": 0, "sum": 0.0}
+    for metric in histogram.collect():
+        for sample in metric.samples:
+            if sample.name.endswith("_bucket"):
+                snapshot["buckets"][sample.labels["le"]] = sample.value
+            elif sample.name.endswith("_count"):
+                snapshot["count"] = sample.value
+            elif sample.name.endswith("_sum"):
+                snapshot["sum"] = sample.value
+    return snapshot
+
+
+# database seconds of the request being served; a one-item list so that
+# threadpool copies of the context add to the same total
+_request_db_seconds = ContextVar("request_db_seconds", default=None)
+
+
+def _add_statement_time(context):
+    # kept on the statement's execution context, which goes away with it
+    # whether the statement succeeds or raises
+    started = getattr(context, "_metrics_started", None)
+    if started is None:
+        return
+    context._metrics_started = None
+    total = _request_db_seconds.get()
+    if total is not None:
+        total[0] += time.perf_counter() - started
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    _add_statement_time(context)
+
+
+@event.listens_for(Engine, "handle_error")
+def _stop_failed_statement_timer(exception_context):
+    # after_cursor_execute does not run for a statement that raised
+    _add_statement_time(exception_context.execution_context)
+
+
+class MetricsMiddleware():
+    """
+    ASGI middleware recording the latency and database time of every HTTP
+    request, labelled with the route template rather than the raw path.
+    """
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+        self._paths = {}
+        self._children = {}
+
+    def _route(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "<unmatched>"
+        path = self._paths.get(endpoint)
+        if path is None:
+            self._paths = {
+                route.endpoint: route.path for route in self.routes if hasattr(route, "endpoint")
+            }
+            path = self._paths.get(endpoint, "<unmatched>")
+        return path
+
+    def _observe(self, method, route, status_code, seconds, db_seconds):
+        key = (method, route, status_code)
+        children = self._children.get(key)
+        if children is None:
+            children = self._children[key] = (
+                REQUEST_SECONDS.labels(method, route, status_code),
+                REQUEST_DB_SECONDS.labels(method, route),
+            )
+        children[0].observe(seconds)
+        children[1].observe(db_seconds)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+        db_seconds = [0.0]
+        token = _request_db_seconds.set(db_seconds)
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - start
+            _request_db_seconds.reset(token)
+            self._observe(scope["method"], self._route(scope), status_code, seconds, db_seconds[0])
+
+
+def exposition():
+    """The metrics in Prometheus text format, merged across worker processes."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
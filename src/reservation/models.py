@@ -1,6 +1,55 @@
+from datetime import datetime, timezone
 from .database import Base
-from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, Date, DateTime, ForeignKey, Boolean, Index, CheckConstraint, LargeBinary, Sequence, false
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql.expression import FunctionElement
+
+
+def queue_day(register_timestamp):
+    """The UTC day a reservation is queued under (the day it is listed under too)."""
+    if register_timestamp is None:
+        return None
+    if register_timestamp.tzinfo is not None:
+        register_timestamp = register_timestamp.astimezone(timezone.utc)
+    return register_timestamp.date()
+
+
+def _default_queue_day(context):
+    return queue_day(context.get_current_parameters().get("register_timestamp"))
+
+
+# Every write to a reservation, and every delete through its tombstone, takes
+# the next change_seq; GET /reservation/changes pages through them in that
+# order. A client must never see a change after one with a higher number,
+# so the numbers have to follow commit order. SQLite runs one write
+# transaction at a time, so the largest number so far plus one does. A
+# PostgreSQL sequence value taken at write time could commit after a larger
+# one, so there the writes leave change_seq NULL and
+# repository.changes.sequence_pending numbers the committed rows, one run at
+# a time and a bounded batch per run, before the feed is read.
+CHANGE_SEQUENCE = Sequence("reservation_change_seq", metadata=Base.metadata)
+
+
+class next_change_seq(FunctionElement):
+    """The change_seq of a write: `default` and `onupdate` of the change_seq columns."""
+    type = BigInteger()
+    name = "next_change_seq"
+    inherit_cache = True
+
+
+@compiles(next_change_seq)
+def _next_change_seq(element, compiler, **kw):
+    return (
+        "(SELECT coalesce(max(seq), 0) + 1 FROM ("
+        "SELECT max(change_seq) AS seq FROM reservations "
+        "UNION ALL SELECT max(change_seq) FROM reservation_tombstones))"
+    )
+
+
+@compiles(next_change_seq, "postgresql")
+def _pending_change_seq(element, compiler, **kw):
+    return "CAST(NULL AS BIGINT)"
 
 
 class Reservation(Base):
@@ -10,9 +59,74 @@ class Reservation(Base):
     register_timestamp = Column(DateTime)
     user_id = Column(Integer, ForeignKey("users.user_id"))
     vaccinated = Column(Boolean, default=False)
+    # the seat this reservation holds, if it was booked through a slot
+    slot_id = Column(Integer, ForeignKey("slots.slot_id"), nullable=True)
+    # the Service Site of that slot, copied so the site's queue has its own index
+    site = Column(String, nullable=True)
+    # served first when higher; ties go to the earlier registration
+    priority = Column(Integer, default=0, server_default="0", nullable=False)
+    # register_timestamp's day; its own column so the queue index can order a
+    # day by priority (a timestamp range cannot)
+    reservation_date = Column(Date, default=_default_queue_day)
+    # the change feed's position of the row's last write, with its time and
+    # whether it created the row ("insert") or changed it ("update")
+    change_seq = Column(BigInteger, default=next_change_seq(), onupdate=next_change_seq())
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    change_op = Column(String, default="insert", onupdate="update", server_default="insert", nullable=False)
 
     owner = relationship("User", back_populates="reservations")
 
+    __table_args__ = (
+        # serves date-range filters and the (register_timestamp, reservation_id) keyset order
+        Index("ix_reservations_register_timestamp", "register_timestamp", "reservation_id"),
+        # the queues: a day's (or a site's day's) pending reservations in
+        # serving order, so taking the next batch reads only that batch.
+        # Partial, so vaccinated reservations leave the index.
+        Index(
+            "ix_reservations_queue",
+            reservation_date, priority.desc(), register_timestamp, reservation_id,
+            postgresql_where=vaccinated == false(),
+            sqlite_where=vaccinated == false(),
+        ),
+        Index(
+            "ix_reservations_site_queue",
+            site, reservation_date, priority.desc(), register_timestamp, reservation_id,
+            postgresql_where=vaccinated == false(),
+            sqlite_where=vaccinated == false(),
+        ),
+        # the change feed's keyset order
+        Index("ix_reservations_change_seq", change_seq, reservation_id),
+        # the rows PostgreSQL has yet to number (see next_change_seq)
+        Index(
+            "ix_reservations_unsequenced",
+            reservation_id,
+            postgresql_where=change_seq.is_(None),
+            sqlite_where=change_seq.is_(None),
+        ),
+    )
+
+
+class ReservationTombstone(Base):
+    """A deleted reservation, kept for the change feed."""
+    __tablename__ = "reservation_tombstones"
+
+    tombstone_id = Column(Integer, primary_key=True)
+    reservation_id = Column(Integer, nullable=False)
+    user_id = Column(Integer)
+    site = Column(String, nullable=True)
+    change_seq = Column(BigInteger, default=next_change_seq())
+    deleted_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_reservation_tombstones_change_seq", change_seq, reservation_id),
+        Index(
+            "ix_reservation_tombstones_unsequenced",
+            tombstone_id,
+            postgresql_where=change_seq.is_(None),
+            sqlite_where=change_seq.is_(None),
+        ),
+    )
+
 
 class User(Base):
     __tablename__ = "users"
@@ -25,5 +139,57 @@ class User(Base):
     occupation = Column(String)
     address = Column(String)
     password = Column(String)
+    # bumped to revoke every access token issued to the user so far
+    token_version = Column(Integer, default=0, server_default="0", nullable=False)
 
     reservations = relationship("Reservation", back_populates="owner")
+
+
+class Slot(Base):
+    __tablename__ = "slots"
+
+    slot_id = Column(Integer, primary_key=True, index=True)
+    site = Column(String, nullable=False)
+    start = Column(DateTime, nullable=False)
+    capacity = Column(Integer, nullable=False)
+    booked = Column(Integer, default=0, server_default="0", nullable=False)
+
+    __table_args__ = (
+        # the database refuses an overbooking even if a write path gets it wrong
+        CheckConstraint("booked >= 0 AND booked <= capacity", name="ck_slots_booked_within_capacity"),
+        # one slot per site and start time; serves a site's slots of a day in order
+        Index("ix_slots_site_start", "site", "start", unique=True),
+    )
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    # the route and caller the key was sent to, so keys of different clients never meet
+    scope = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    # hash of the request body; reusing a key for a different request is refused
+    fingerprint = Column(String, nullable=False)
+    # NULL while the first request with the key is still being handled
+    status_code = Column(Integer, nullable=True)
+    content_type = Column(String, nullable=True)
+    body = Column(LargeBinary, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_idempotency_keys_expires_at", "expires_at"),
+    )
+
+
+class DailyReport(Base):
+    __tablename__ = "daily_reports"
+
+    day = Column(Date, primary_key=True)
+    # "" for the reservations not booked at a site
+    site = Column(String, primary_key=True)
+    # reservations of the day that still exist, how many of them are
+    # vaccinated, and how many were deleted
+    booked = Column(Integer, default=0, server_default="0", nullable=False)
+    vaccinated = Column(Integer, default=0, server_default="0", nullable=False)
+    cancelled = Column(Integer, default=0, server_default="0", nullable=False)
@@ -1,21 +1,143 @@
+import threading
+import time
+from collections import OrderedDict
 from fastapi import Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from fastapi.security import OAuth2PasswordBearer
-from . import token, database, models
+from typing import Optional
+from . import token, database, models, schemas
+from .config import settings
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+
+class TokenCache():
+    """
+    Per-process cache of decoded access tokens and of each user's current
+    token version. A token is accepted while its `ver` claim matches the
+    cached version; versions are re-read from the database at most once per
+    `version_ttl` seconds per user, so a bump made by another worker takes
+    effect within that window (immediately in the worker that made it).
+    """
+
+    def __init__(self, max_tokens: int, version_ttl: int):
+        self.max_tokens = max_tokens
+        self.version_ttl = version_ttl
+        self._tokens = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, data: str) -> Optional[schemas.TokenData]:
+        with self._lock:
+            token_data = self._tokens.get(data)
+            if token_data is None:
+                return None
+            if token_data.expires_at is not None and token_data.expires_at <= time.time():
+                del self._tokens[data]
+                return None
+            self._tokens.move_to_end(data)
+            return token_data
+
+    def put_token(self, data: str, token_data: schemas.TokenData):
+        with self._lock:
+            self._tokens[data] = token_data
+            if len(self._tokens) > self.max_tokens:
+                self._tokens.popitem(last=False)
+
+    def get_version(self, user_id: int) -> Optional[int]:
+        with self._lock:
+            cached = self._versions.get(user_id)
+        if cached is None or cached[1] <= time.monotonic():
+            return None
+        return cached[0]
+
+    def set_version(self, user_id: int, version: int):
+        with self._lock:
+            self._versions[user_id] = (version, time.monotonic() + self.version_ttl)
+
+    def forget_version(self, user_id: int):
+        with self._lock:
+            self._versions.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+            self._versions.clear()
+
+
+token_cache = TokenCache(settings.token_cache_size, settings.token_version_ttl)
+
+
 def get_user(citizen_id: str, db: Session):
     return db.query(models.User).filter(models.User.citizen_id == citizen_id).first()
 
+
+def get_token_version(user_id: int, db: Session):
+    version = token_cache.get_version(user_id)
+    if version is None:
+        version = (
+            db.query(models.User.token_version)
+            .filter(models.User.user_id == user_id)
+            .scalar()
+        )
+        if version is not None:
+            token_cache.set_version(user_id, version)
+    return version
+
+
+def revoke_tokens(user_id: int, db: Session):
+    """Invalidate every access token issued to the user so far."""
+    db.query(models.User).filter(models.User.user_id == user_id).update(
+        {models.User.token_version: models.User.token_version + 1},
+        synchronize_session=False,
+    )
+    db.commit()
+    token_cache.forget_version(user_id)
+
+
 def get_current_user(data: str=Depends(oauth2_scheme), db: Session=Depends(database.get_db)):
+    """
+    The caller as a lightweight principal read from the token claims. The
+    user row is not loaded; depend on `get_current_user_model` for that.
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    token_data = token.verify_token(data, credentials_exception)
-    user = get_user(token_data.citizen_id, db)
-    if user is None:
+    token_data = token_cache.get_token(data)
+    if token_data is None:
+        token_data = token.verify_token(data, credentials_exception)
+        token_cache.put_token(data, token_data)
+    # a token issued before the claims carried a version has the one every
+    # user starts at, so the user's first logout revokes it like any other
+    token_version = token_data.token_version if token_data.token_version is not None else 0
+    if token_data.user_id is None:
+        # token issued before the claims carried the user id
+        user = get_user(token_data.citizen_id, db)
+        if user is None or user.token_version != token_version:
+            raise credentials_exception
+        return schemas.Principal(
+            user_id=user.user_id, citizen_id=user.citizen_id, token_version=user.token_version
+        )
+    if get_token_version(token_data.user_id, db) != token_version:
         raise credentials_exception
+    return schemas.Principal(
+        user_id=token_data.user_id,
+        citizen_id=token_data.citizen_id,
+        token_version=token_version,
+    )
+
+
+def get_current_user_model(
+    principal: schemas.Principal=Depends(get_current_user), db: Session=Depends(database.get_db)
+):
+    """The full `User` row of the caller, for handlers that need more than the id."""
+    user = db.query(models.User).filter(models.User.user_id == principal.user_id).first()
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return user
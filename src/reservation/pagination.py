@@ -0,0 +1,46 @@
+import base64
+import json
+from datetime import datetime
+from fastapi import HTTPException, status
+from .config import settings
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def page_size(limit: int):
+    """Clamp the requested page size to the server-side maximum."""
+    return max(1, min(limit, settings.max_page_size))
+
+
+def encode_cursor(*values):
+    """Pack the keyset values of the last row of a page into an opaque token."""
+    raw = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(raw).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *types):
+    """Unpack a token made by `encode_cursor`, converting each value to `types`."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(raw, list) or len(raw) != len(types):
+            raise ValueError
+        return tuple(
+            datetime.fromisoformat(value) if kind is datetime else kind(value)
+            for kind, value in zip(types, raw)
+        )
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid cursor"
+        )
+
+
+def paginate(rows: list, limit: int, key):
+    """
+    Split `rows` (fetched with `limit + 1`) into the page and the cursor of the
+    next page, or None when this is the last page.
+    """
+    if len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    return page, encode_cursor(*key(page[-1]))
@@ -0,0 +1,29 @@
+"""
+Rebuild the booked and vaccinated counts of the daily report from the
+reservations, for one day or all of them. The write paths keep the report up
+to date on their own; run this after loading data behind the app's back or
+on a schedule as a safety net:
+
+    python -m src.reservation.reconcile [--day 2021-10-22]
+"""
+import argparse
+from datetime import date
+
+from .database import SessionLocal
+from .repository import report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--day", type=date.fromisoformat, help="only this day, e.g. 2021-10-22")
+    args = parser.parse_args(argv)
+    db = SessionLocal()
+    try:
+        report.reconcile(db, args.day)
+    finally:
+        db.close()
+    print(f"reconciled {args.day or 'every day'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+from heapq import merge
+from typing import Optional
+from sqlalchemy import func, literal, select
+from sqlalchemy.orm import Session
+from .. import models, pagination, schemas
+from ..database import supports_returning
+from .reservation import LISTING_COLUMNS
+
+# The change feed: every reservation whose last write is after the client's
+# cursor, then every reservation deleted after it, merged in change_seq
+# order. Both come from a (change_seq, reservation_id) index, so a sync reads
+# only what changed since the client's last page. A reservation written
+# several times shows once, at its latest change.
+
+# the advisory lock key of sequence_pending, arbitrary but unique in the app
+SEQUENCER_LOCK = 5_214_001
+
+# rows of each table numbered per run, so a run inside a read stays short
+# however many rows a bulk import or an upgrade left unnumbered
+SEQUENCE_BATCH = 1000
+
+
+def sequence_pending(db: Session):
+    """
+    Number the committed writes PostgreSQL left without a change_seq (see
+    models.next_change_seq), the first SEQUENCE_BATCH of each table, in one
+    transaction per run and one run at a time. Rows still locked by a write
+    in flight, and the ones past the batch, are numbered by a later run.
+    Returns how many rows were numbered.
+    """
+    if not supports_returning(db):
+        return 0
+    if not db.execute(select(func.pg_try_advisory_xact_lock(SEQUENCER_LOCK))).scalar():
+        # another request is numbering; what it numbers shows on the next read
+        db.rollback()
+        return 0
+    numbered = 0
+    for table, key in (
+        (models.Reservation.__table__, "reservation_id"),
+        (models.ReservationTombstone.__table__, "tombstone_id"),
+    ):
+        pending = (
+            select(table.c[key])
+            .where(table.c.change_seq.is_(None))
+            .order_by(table.c[key])
+            .limit(SEQUENCE_BATCH)
+            .with_for_update(skip_locked=True)
+        )
+        values = {"change_seq": models.CHANGE_SEQUENCE.next_value()}
+        if table.name == "reservations":
+            # numbering is not a change: keep the row's own onupdate columns
+            values.update(updated_at=table.c.updated_at, change_op=table.c.change_op)
+        numbered += db.execute(table.update().where(table.c[key].in_(pending)).values(values)).rowcount
+    db.commit()
+    return numbered
+
+
+def seek(db: Session, statement, table, cursor, limit: int):
+    """
+    The first `limit + 1` rows of `statement` after `cursor` in feed order.
+    A statement writing many rows gives them one change_seq, and a
+    (change_seq, reservation_id) > cursor comparison would scan all of them
+    on SQLite, so the rest of the cursor's change_seq and the later ones are
+    two index seeks, already in order one after the other.
+    """
+    def page(*criteria):
+        return db.execute(
+            statement.where(*criteria)
+            .order_by(table.c.change_seq, table.c.reservation_id)
+            .limit(limit + 1)
+        ).all()
+
+    if cursor is None:
+        return page(table.c.change_seq.isnot(None))
+    change_seq, reservation_id = cursor
+    rows = page(table.c.change_seq == change_seq, table.c.reservation_id > reservation_id)
+    if len(rows) <= limit:
+        rows += page(table.c.change_seq > change_seq)
+    return rows[:limit + 1]
+
+
+def change_key(row):
+    return (row.change_seq, row.reservation_id)
+
+
+def read(db: Session, limit: int, cursor: Optional[tuple] = None):
+    """
+    The next `limit` changes after `cursor`, a (change_seq, reservation_id)
+    key (from the start without one), as (key, ReservationChange) pairs, and
+    whether more changes are waiting.
+    """
+    sequence_pending(db)
+    reservations = models.Reservation.__table__
+    written = seek(
+        db,
+        select(
+            reservations.c.change_seq,
+            reservations.c.change_op.label("op"),
+            reservations.c.updated_at.label("changed_at"),
+            reservations.c.site,
+            *LISTING_COLUMNS,
+        ).join(models.User, reservations.c.user_id == models.User.user_id),
+        reservations,
+        cursor,
+        limit,
+    )
+    tombstones = models.ReservationTombstone.__table__
+    deleted = seek(
+        db,
+        select(
+            tombstones.c.change_seq,
+            literal("delete").label("op"),
+            tombstones.c.deleted_at.label("changed_at"),
+            tombstones.c.site,
+            tombstones.c.reservation_id,
+        ),
+        tombstones,
+        cursor,
+        limit,
+    )
+    rows = list(merge(written, deleted, key=change_key))
+    changes = [
+        (change_key(row), schemas.ReservationChange(
+            op=row.op,
+            reservation_id=row.reservation_id,
+            site=row.site,
+            changed_at=row.changed_at,
+            reservation=None if row.op == "delete" else schemas.ShowReservation(
+                reservation_id=row.reservation_id,
+                register_timestamp=row.register_timestamp,
+                vaccinated=row.vaccinated,
+                priority=row.priority,
+                owner=schemas.ShowUserInfo(
+                    name=row.name,
+                    surname=row.surname,
+                    birth_date=row.birth_date,
+                    citizen_id=row.citizen_id,
+                    occupation=row.occupation,
+                    address=row.address,
+                ),
+            ),
+        ))
+        for row in rows[:limit]
+    ]
+    return changes, len(rows) > limit
+
+
+def latest(db: Session):
+    """The key of the last change so far, where a reader wanting only new changes starts."""
+    sequence_pending(db)
+    last = (0, 0)
+    for table in (models.Reservation.__table__, models.ReservationTombstone.__table__):
+        change_seq = select(func.max(table.c.change_seq)).scalar_subquery()
+        row = db.execute(
+            select(table.c.change_seq, func.max(table.c.reservation_id))
+            .where(table.c.change_seq == change_seq)
+            .group_by(table.c.change_seq)
+        ).first()
+        if row is not None:
+            last = max(last, tuple(row))
+    return last
+
+
+def get_changes(db: Session, limit: int, since: Optional[str] = None):
+    """
+    The next `limit` changes after the cursor `since` (from the start without
+    one), the cursor to continue from and whether more changes are waiting.
+    """
+    cursor = pagination.decode_cursor(since, int, int) if since is not None else None
+    changes, has_more = read(db, limit, cursor)
+    if changes:
+        next_cursor = pagination.encode_cursor(*changes[-1][0])
+    else:
+        next_cursor = since or pagination.encode_cursor(0, 0)
+    return schemas.ChangePage(
+        changes=[change for _, change in changes], next_cursor=next_cursor, has_more=has_more
+    )
@@ -0,0 +1,11 @@
+from sqlalchemy.orm import joinedload, selectinload
+from .. import models
+
+# Eager-load exactly what each response schema serializes so listing N rows
+# costs a fixed number of queries instead of N + 1 lazy loads.
+
+# ShowReservation.owner (many-to-one): join it into the same SELECT.
+RESERVATION_WITH_OWNER = (joinedload(models.Reservation.owner),)
+
+# ShowUser.reservations (one-to-many): one extra SELECT ... WHERE user_id IN (...).
+USER_WITH_RESERVATIONS = (selectinload(models.User.reservations),)
@@ -0,0 +1,98 @@
+from datetime import date
+from typing import Optional
+from sqlalchemy import false, func, or_, select
+from sqlalchemy.orm import Session
+from .. import models, schemas
+from ..broker import announce_changes
+from ..cache import day_tag, reservation_tag, response_cache
+from ..database import supports_returning
+from .reservation import BULK_INSERT_CHUNK, listing
+from fastapi import status, HTTPException
+
+# Each day's pending reservations form a priority queue: highest priority
+# first, then first registered. ix_reservations_queue (and, per site,
+# ix_reservations_site_queue) holds the pending rows in exactly that order,
+# so enqueueing or reprioritizing a reservation is one B-tree update and
+# taking the next batch reads only that batch, however long the queue is.
+
+
+def pending():
+    # the predicate of the partial queue indexes; keep the two in step
+    return models.Reservation.vaccinated == false()
+
+
+def queue_order():
+    return (
+        models.Reservation.priority.desc(),
+        models.Reservation.register_timestamp,
+        models.Reservation.reservation_id,
+    )
+
+
+def next_batch(day: date, db: Session, limit: int, site: Optional[str] = None):
+    """The next `limit` pending reservations of `day` (at `site`), as listing rows."""
+    statement = listing().where(models.Reservation.reservation_date == day, pending())
+    if site is not None:
+        statement = statement.where(models.Reservation.site == site)
+    return db.execute(statement.order_by(*queue_order()).limit(limit)).all()
+
+
+def born_on_or_before(age: int, today: date):
+    """The latest birth date of someone who is at least `age` years old on `today`."""
+    try:
+        return today.replace(year=today.year - age)
+    except ValueError:
+        # today is 29 February and that year has none
+        return today.replace(year=today.year - age, day=28)
+
+
+def bump(request: schemas.BulkPriority, db: Session):
+    """
+    Raise every pending reservation of the users matching any of the request's
+    criteria to at least `priority`, with one set-based UPDATE (on SQLite
+    preceded by a SELECT of their ids, for the cache). Returns how many
+    reservations changed.
+    """
+    criteria = []
+    if request.min_age is not None:
+        criteria.append(models.User.birth_date <= born_on_or_before(request.min_age, date.today()))
+    if request.occupations:
+        occupations = [occupation.lower() for occupation in request.occupations]
+        criteria.append(func.lower(models.User.occupation).in_(occupations))
+    if not criteria:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Give min_age or occupations to choose whose priority changes",
+        )
+    table = models.Reservation.__table__
+    bumped = (
+        table.c.vaccinated == false(),
+        # rows already at or above the priority are left alone, index and all
+        table.c.priority < request.priority,
+        table.c.user_id.in_(select(models.User.user_id).where(or_(*criteria))),
+    )
+    if request.day is not None:
+        bumped += (table.c.reservation_date == request.day,)
+    bump_rows = table.update().values(priority=request.priority)
+    if supports_returning(db):
+        changed = db.execute(
+            bump_rows.where(*bumped).returning(table.c.reservation_id)
+        ).scalars().all()
+        updated = len(changed)
+    else:
+        # the UPDATE checks the criteria again, so `changed` may hold a few
+        # more ids than were written: the cache only drops a little more
+        changed = db.execute(select(table.c.reservation_id).where(*bumped)).scalars().all()
+        updated = 0
+        for start in range(0, len(changed), BULK_INSERT_CHUNK):
+            chunk = changed[start:start + BULK_INSERT_CHUNK]
+            updated += db.execute(bump_rows.where(*bumped, table.c.reservation_id.in_(chunk))).rowcount
+    db.commit()
+    if updated:
+        # priority shows on every listing and user these rows are cached in
+        tags = [reservation_tag(reservation_id) for reservation_id in changed]
+        if request.day is not None:
+            tags.append(day_tag(request.day))
+        response_cache.invalidate(*tags)
+        announce_changes()
+    return schemas.BulkPriorityResult(updated=updated)
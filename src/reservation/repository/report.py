@@ -0,0 +1,189 @@
+from collections import defaultdict
+from datetime import date
+from typing import Optional
+from sqlalchemy import case, func, literal, or_, select, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from .. import models, schemas
+
+# daily_reports counts, per day and Service Site, the reservations booked
+# (still existing), vaccinated and cancelled (deleted). Every write path adds
+# its deltas to the rows it touches in the write's own transaction, so a
+# report is a primary key lookup whatever the size of reservations, and
+# `reconcile` rebuilds the counts from the reservations if they ever drift.
+#
+# The deltas must come from the reservations' state under the write's lock,
+# or two concurrent writes could both count the same change. PostgreSQL reads
+# it with SELECT ... FOR UPDATE or from the write's RETURNING; on SQLite the
+# INSERT ... SELECT holds the database's write lock while it reads.
+
+# the site of the reservations not booked at one
+NO_SITE = ""
+COUNTS = ("booked", "vaccinated", "cancelled")
+
+
+def dialect_name(db):
+    return db.get_bind().dialect.name
+
+
+def upsert(dialect: str):
+    """The dialect's INSERT into daily_reports, which has ON CONFLICT (see `adding`)."""
+    table = models.DailyReport.__table__
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    return insert(table)
+
+
+def adding(statement):
+    table = models.DailyReport.__table__
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.day, table.c.site],
+        set_={name: table.c[name] + statement.excluded[name] for name in COUNTS},
+    )
+
+
+def record(db: Session, deltas):
+    """
+    Add `deltas`, (day, site, booked, vaccinated, cancelled) tuples whose
+    values the caller already knows, with one statement.
+    """
+    totals = defaultdict(lambda: [0, 0, 0])
+    for day, site, *counts in deltas:
+        if day is None:
+            continue
+        total = totals[(day, site or NO_SITE)]
+        for index, count in enumerate(counts):
+            total[index] += count
+    if not totals:
+        return
+    # a fixed order, so concurrent writers lock report rows in the same order
+    rows = [
+        {"day": day, "site": site, "booked": booked, "vaccinated": vaccinated, "cancelled": cancelled}
+        for (day, site), (booked, vaccinated, cancelled) in sorted(totals.items())
+    ]
+    db.execute(adding(upsert(dialect_name(db)).values(rows)))
+
+
+def vaccinated_count(vaccinated):
+    return case((vaccinated.is_(True), 1), else_=0)
+
+
+def deltas_of(source, booked=0, vaccinated=0, cancelled=0):
+    """
+    The (day, site, booked, vaccinated, cancelled) rows of the reservations
+    in `source` (the reservations table or a CTE returning its columns),
+    summed per day and site.
+    """
+    day = source.c.reservation_date
+    site = func.coalesce(source.c.site, NO_SITE)
+    return (
+        select(
+            day,
+            site,
+            func.sum(literal(booked) if isinstance(booked, int) else booked),
+            func.sum(literal(vaccinated) if isinstance(vaccinated, int) else vaccinated),
+            func.sum(literal(cancelled) if isinstance(cancelled, int) else cancelled),
+        )
+        .where(day.isnot(None))
+        .group_by(day, site)
+    )
+
+
+def moved(source):
+    """
+    The deltas of the reservations in `source`, an UPDATE ... RETURNING CTE
+    that also returns their previous reservation_date, site and vaccinated
+    as previous_reservation_date, previous_site and previous_vaccinated: each
+    leaves its previous day and site and joins its new ones. Days and sites
+    whose counts do not change are left out, so their rows are not locked.
+    """
+    both = union_all(
+        select(
+            source.c.previous_reservation_date.label("reservation_date"),
+            source.c.previous_site.label("site"),
+            literal(-1).label("booked"),
+            (-vaccinated_count(source.c.previous_vaccinated)).label("vaccinated"),
+        ),
+        select(
+            source.c.reservation_date,
+            source.c.site,
+            literal(1).label("booked"),
+            vaccinated_count(source.c.vaccinated).label("vaccinated"),
+        ),
+    ).subquery("moved")
+    return deltas_of(both, both.c.booked, both.c.vaccinated, 0).having(
+        or_(func.sum(both.c.booked) != 0, func.sum(both.c.vaccinated) != 0)
+    )
+
+
+def record_from(db: Session, rows):
+    """Add the deltas selected by `rows` (see `deltas_of`) with one INSERT ... SELECT."""
+    statement = upsert(dialect_name(db)).from_select(["day", "site", *COUNTS], rows)
+    db.execute(adding(statement))
+
+
+def record_one(db: Session, reservation_id: int, *criteria, booked=0, vaccinated=0, cancelled=0):
+    """
+    Add the deltas of one reservation from its current state, locking it on
+    PostgreSQL until the transaction ends.
+    """
+    table = models.Reservation.__table__
+    if dialect_name(db) == "postgresql":
+        # FOR UPDATE rules out GROUP BY; a single row needs none
+        rows = (
+            select(
+                table.c.reservation_date,
+                func.coalesce(table.c.site, NO_SITE),
+                literal(booked) if isinstance(booked, int) else booked,
+                literal(vaccinated) if isinstance(vaccinated, int) else vaccinated,
+                literal(cancelled) if isinstance(cancelled, int) else cancelled,
+            )
+            .where(table.c.reservation_id == reservation_id, table.c.reservation_date.isnot(None), *criteria)
+            .with_for_update()
+        )
+    else:
+        rows = deltas_of(table, booked, vaccinated, cancelled).where(
+            table.c.reservation_id == reservation_id, *criteria
+        )
+    record_from(db, rows)
+
+
+def get_daily(day: date, db: Session, site: Optional[str] = None):
+    query = db.query(models.DailyReport).filter(models.DailyReport.day == day)
+    if site is not None:
+        query = query.filter(models.DailyReport.site == site)
+    return [
+        schemas.DailyReport(
+            day=row.day,
+            site=row.site or None,
+            booked=row.booked,
+            vaccinated=row.vaccinated,
+            cancelled=row.cancelled,
+        )
+        for row in query.order_by(models.DailyReport.site)
+    ]
+
+
+def reconcile_statements(dialect: str, day: Optional[date] = None):
+    """
+    Statements that recount booked and vaccinated from the reservations (of
+    `day`, or every day). Deleted reservations are gone, so cancelled is kept.
+    """
+    report = models.DailyReport.__table__
+    reservations = models.Reservation.__table__
+    reset = report.update().values(booked=0, vaccinated=0)
+    counts = deltas_of(reservations, 1, vaccinated_count(reservations.c.vaccinated), 0)
+    if day is not None:
+        reset = reset.where(report.c.day == day)
+        counts = counts.where(reservations.c.reservation_date == day)
+    recount = upsert(dialect).from_select(["day", "site", *COUNTS], counts)
+    recount = recount.on_conflict_do_update(
+        index_elements=[report.c.day, report.c.site],
+        set_={"booked": recount.excluded.booked, "vaccinated": recount.excluded.vaccinated},
+    )
+    return [reset, recount]
+
+
+def reconcile(db: Session, day: Optional[date] = None):
+    for statement in reconcile_statements(dialect_name(db), day):
+        db.execute(statement)
+    db.commit()
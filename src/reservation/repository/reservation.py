@@ -1,113 +1,565 @@
-from sqlalchemy.orm import Session
-from .. import models, schemas
-from datetime import datetime, date
+from collections import defaultdict
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.orm.attributes import set_committed_value
+from .. import journal, models, schemas, pagination
+from . import report
+from ..broker import announce_changes
+from ..cache import response_cache, reservation_tag, written_tags
+from ..config import settings
+from ..database import supports_returning
+from .loaders import RESERVATION_WITH_OWNER
+from datetime import datetime, date, timedelta, timezone
 from fastapi import status, HTTPException
-from sqlalchemy import func
+from sqlalchemy import DateTime, func, insert, literal, select, text, tuple_
+from typing import List, Optional
 
 
-def get_all(db: Session):
-    reservations = db.query(models.Reservation).all()
-    return reservations
+def by_id(query, limit: int, after: Optional[str]):
+    """Keyset page of `query` (a Query or a select()) ordered by reservation_id."""
+    if after is not None:
+        (last_id,) = pagination.decode_cursor(after, int)
+        query = query.filter(models.Reservation.reservation_id > last_id)
+    return query.order_by(models.Reservation.reservation_id).limit(limit + 1)
 
 
-def create(request: schemas.Reservation, db: Session, current_user: schemas.User):
+def id_key(reservation):
+    return (reservation.reservation_id,)
+
+
+def by_timestamp(query, limit: int, after: Optional[str]):
+    """Keyset page of `query` ordered by (register_timestamp, reservation_id)."""
+    if after is not None:
+        last_timestamp, last_id = pagination.decode_cursor(after, datetime, int)
+        query = query.filter(
+            tuple_(models.Reservation.register_timestamp, models.Reservation.reservation_id)
+            > tuple_(last_timestamp, last_id)
+        )
+    return query.order_by(
+        models.Reservation.register_timestamp, models.Reservation.reservation_id
+    ).limit(limit + 1)
+
+
+def timestamp_key(reservation):
+    return (reservation.register_timestamp, reservation.reservation_id)
+
+
+# exactly the fields of ShowReservation and its ShowUserInfo owner, in that
+# order; the password hash is never selected
+LISTING_COLUMNS = (
+    models.Reservation.reservation_id,
+    models.Reservation.register_timestamp,
+    models.Reservation.vaccinated,
+    models.Reservation.priority,
+    models.User.name,
+    models.User.surname,
+    models.User.birth_date,
+    models.User.citizen_id,
+    models.User.occupation,
+    models.User.address,
+)
+
+
+def listing():
+    """
+    The list endpoints' statement: plain rows of `LISTING_COLUMNS` from one
+    join, so no ORM object is built (rendered by `listing.render`).
+    """
+    return select(*LISTING_COLUMNS).join(
+        models.User, models.Reservation.user_id == models.User.user_id
+    )
+
+
+def get_all(db: Session, limit: int, after: Optional[str] = None):
+    rows = db.execute(by_id(listing(), limit, after)).all()
+    return pagination.paginate(rows, limit, id_key)
+
+
+def export(db: Session, batch_size: int = 1000):
+    """
+    Column-only rows for the export, read through a server-side cursor in
+    batches of `batch_size` so memory stays flat however many rows there are.
+    """
+    return (
+        db.query(
+            models.Reservation.reservation_id,
+            models.Reservation.register_timestamp,
+            models.Reservation.vaccinated,
+            models.User.citizen_id,
+            models.User.name,
+            models.User.surname,
+            models.User.birth_date,
+            models.User.occupation,
+            models.User.address,
+        )
+        .join(models.User, models.Reservation.user_id == models.User.user_id)
+        .order_by(models.Reservation.reservation_id)
+        .execution_options(stream_results=True)
+        .yield_per(batch_size)
+    )
+
+
+def create(request: schemas.Reservation, db: Session, current_user: schemas.Principal):
     request_body = {
         "register_timestamp": request.register_timestamp,
         "user_id": current_user.user_id,
     }
     new_reservation = models.Reservation(**request_body)
     db.add(new_reservation)
+    report.record(db, [(models.queue_day(request.register_timestamp), None, 1, 0, 0)])
     db.commit()
+    response_cache.invalidate(*written_tags(None, current_user.user_id, request.register_timestamp))
+    announce_changes()
     db.refresh(new_reservation)
     return new_reservation
 
 
-def get(reservation_id: int, db: Session):
-    reservation = db.query(models.Reservation).filter(
-        models.Reservation.reservation_id == reservation_id
-    )
-    if not reservation.first():
+# rows per INSERT statement, well under the bind parameter limits of both databases
+BULK_INSERT_CHUNK = 1000
+
+
+def _insert_returning_ids(db: Session, rows: list):
+    """
+    Insert `rows` with one multi-row INSERT ... RETURNING per chunk and
+    return their ids in the order of `rows`.
+    """
+    table = models.Reservation.__table__
+    ids = []
+    for start in range(0, len(rows), BULK_INSERT_CHUNK):
+        chunk = rows[start:start + BULK_INSERT_CHUNK]
+        returned = db.execute(
+            insert(table)
+            .values(chunk)
+            .returning(table.c.reservation_id, table.c.user_id, table.c.register_timestamp)
+        ).fetchall()
+        # RETURNING order is not guaranteed; rows with the same values are
+        # interchangeable, so match ids back by value
+        ids_by_row = defaultdict(list)
+        for reservation_id, user_id, register_timestamp in returned:
+            ids_by_row[(user_id, register_timestamp)].append(reservation_id)
+        for row in chunk:
+            ids.append(ids_by_row[(row["user_id"], row["register_timestamp"])].pop(0))
+    return ids
+
+
+def _insert_many_ids(db: Session, rows: list):
+    """
+    Insert `rows` with one executemany and return their ids. SQLite holds the
+    write lock for the whole statement and hands out rowids as max + 1, so
+    the new ids are the consecutive range ending at last_insert_rowid().
+    """
+    db.execute(insert(models.Reservation.__table__), rows)
+    last_id = db.execute(text("SELECT last_insert_rowid()")).scalar()
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
+def bulk_create(requests: List[schemas.BulkReservation], db: Session):
+    if len(requests) > settings.max_bulk_size:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="No reservation with this id"
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"At most {settings.max_bulk_size} reservations per request",
         )
-    else:
-        return reservation.first()
+    citizen_ids = {request.citizen_id for request in requests}
+    user_ids = dict(
+        db.query(models.User.citizen_id, models.User.user_id)
+        .filter(models.User.citizen_id.in_(citizen_ids))
+        .all()
+    )
+    results = []
+    rows = []
+    for index, request in enumerate(requests):
+        result = schemas.BulkReservationResult(index=index, citizen_id=request.citizen_id)
+        if request.citizen_id in user_ids:
+            rows.append({
+                "register_timestamp": naive_utc(request.register_timestamp),
+                "user_id": user_ids[request.citizen_id],
+            })
+        else:
+            result.detail = "No user with this citizen id"
+        results.append(result)
+    if rows:
+        insert_rows = _insert_returning_ids if supports_returning(db) else _insert_many_ids
+        reservation_ids = iter(insert_rows(db, rows))
+        report.record(db, [(models.queue_day(row["register_timestamp"]), None, 1, 0, 0) for row in rows])
+        db.commit()
+        response_cache.invalidate(*{
+            tag for row in rows
+            for tag in written_tags(None, row["user_id"], row["register_timestamp"])
+        })
+        announce_changes()
+        for result in results:
+            if result.detail is None:
+                result.reservation_id = next(reservation_ids)
+    return results
 
 
-def delete(reservation_id: int, db: Session, current_user: schemas.User):
-    reservation = db.query(models.Reservation).filter(
-        models.Reservation.reservation_id == reservation_id
+def _not_found():
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND, detail="No reservation with this id"
     )
-    if not reservation.first():
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="No reservation with this id"
+
+
+def shown_vaccinated(reservation):
+    """`reservation` as it is once the journaled report of it is flushed."""
+    # not a change of the session's: nothing to write back
+    set_committed_value(reservation, "vaccinated", True)
+    return reservation
+
+
+def get(reservation_id: int, db: Session):
+    pending = journal.is_pending(reservation_id)
+    reservation = (
+        db.query(models.Reservation)
+        .options(*RESERVATION_WITH_OWNER)
+        .filter(models.Reservation.reservation_id == reservation_id)
+        .first()
+    )
+    if not reservation:
+        raise _not_found()
+    return shown_vaccinated(reservation) if pending else reservation
+
+
+def _update_returning(
+    reservation_id: int, values: dict, db: Session, before_commit=None, reported: bool = False
+):
+    """
+    Apply `values` to one reservation and return it with its owner loaded.
+    PostgreSQL does it in one statement: the UPDATE ... RETURNING runs as a
+    CTE joined to its owner. Elsewhere it is an UPDATE followed by the
+    joined SELECT. Raises the 404 when no row matched. `before_commit` is
+    called after the UPDATE, in its transaction.
+
+    With `reported`, PostgreSQL also moves the reservation's counts in the
+    daily report from its previous day, site and vaccinated to the new ones
+    in that same statement; elsewhere the caller records them around the
+    UPDATE (see report.record_one).
+    """
+    table = models.Reservation.__table__
+    matching = table.c.reservation_id == reservation_id
+    if supports_returning(db):
+        statement = table.update().where(matching)
+        returned = list(table.c)
+        if reported:
+            # locked before it is read, so the previous values are the ones replaced
+            previous = (
+                select(table.c.reservation_id, table.c.reservation_date, table.c.site, table.c.vaccinated)
+                .where(matching)
+                .with_for_update()
+                .subquery("previous")
+            )
+            statement = table.update().where(table.c.reservation_id == previous.c.reservation_id)
+            returned += [
+                previous.c.reservation_date.label("previous_reservation_date"),
+                previous.c.site.label("previous_site"),
+                previous.c.vaccinated.label("previous_vaccinated"),
+            ]
+        updated = statement.values(values).returning(*returned).cte("updated")
+        users = models.User.__table__
+        # a Core SELECT mapped back to the entities: one of ORM entities would drop add_cte
+        query = select(updated, users).select_from(
+            updated.outerjoin(users, users.c.user_id == updated.c.user_id)
         )
-    reservation.delete()
+        if reported:
+            query = query.add_cte(report.adding(
+                report.upsert("postgresql").from_select(
+                    ["day", "site", *report.COUNTS], report.moved(updated)
+                )
+            ).cte("reported"))
+        row = db.execute(
+            select(aliased(models.Reservation, updated), models.User)
+            .from_statement(query)
+            .execution_options(populate_existing=True)
+        ).first()
+        if row is None:
+            raise _not_found()
+        reservation, owner = row
+        set_committed_value(reservation, "owner", owner)
+        # the tag of the id covers where it was listed before, the others where it is now
+        tags = written_tags(reservation_id, reservation.user_id, reservation.register_timestamp)
+        if before_commit is not None:
+            before_commit()
+        db.commit()
+        response_cache.invalidate(*tags)
+        announce_changes()
+        return reservation
+    if db.execute(table.update().where(matching).values(values)).rowcount == 0:
+        raise _not_found()
+    if before_commit is not None:
+        before_commit()
     db.commit()
-    return "Delete Successfully"
+    reservation = get(reservation_id, db)
+    response_cache.invalidate(
+        *written_tags(reservation_id, reservation.user_id, reservation.register_timestamp)
+    )
+    announce_changes()
+    return reservation
 
 
-def get_from_specific_date(
-    selected_year: int, selected_month: int, selected_day: int, db: Session
-):
-    try:
-        min_datetime = datetime(selected_year, selected_month, selected_day, 0, 0)
-        max_datetime = datetime(
-            selected_year, selected_month, selected_day, 23, 59, 59, 999999
+def bury(rows):
+    """INSERT of the change feed's tombstones of the reservations in `rows`."""
+    return insert(models.ReservationTombstone.__table__).from_select(
+        ["reservation_id", "user_id", "site", "change_seq", "deleted_at"],
+        select(
+            rows.c.reservation_id,
+            rows.c.user_id,
+            rows.c.site,
+            models.next_change_seq(),
+            literal(datetime.utcnow(), DateTime),
+        ),
+    )
+
+
+def deletes_returning(db: Session):
+    # SQLite has DELETE ... RETURNING from 3.35; SQLAlchemy 1.4 only compiles it for PostgreSQL
+    return db.get_bind().dialect.dbapi.sqlite_version_info >= (3, 35)
+
+
+def delete(reservation_id: int, db: Session, current_user: schemas.Principal):
+    reservations = models.Reservation.__table__
+    slots = models.Slot.__table__
+    matching = reservations.c.reservation_id == reservation_id
+    if supports_returning(db):
+        # one statement: the DELETE as a CTE that also frees the slot's seat,
+        # moves the reservation from booked to cancelled in the report and
+        # leaves its tombstone
+        gone = (
+            reservations.delete()
+            .where(matching)
+            .returning(
+                reservations.c.reservation_id,
+                reservations.c.user_id,
+                reservations.c.slot_id,
+                reservations.c.reservation_date,
+                reservations.c.site,
+                reservations.c.vaccinated,
+            )
+            .cte("gone")
         )
-        reservation = (
-            db.query(models.Reservation)
-            .filter(
-                models.Reservation.register_timestamp.between(min_datetime, max_datetime)
+        freed = (
+            slots.update()
+            .where(slots.c.slot_id.in_(select(gone.c.slot_id)))
+            .values(booked=slots.c.booked - 1)
+            .cte("freed")
+        )
+        reported = report.adding(
+            report.upsert("postgresql").from_select(
+                ["day", "site", *report.COUNTS],
+                report.deltas_of(gone, -1, -report.vaccinated_count(gone.c.vaccinated), 1),
             )
-            .all()
+        ).cte("reported")
+        buried = bury(gone).cte("buried")
+        deleted = db.execute(
+            select(func.count()).select_from(gone).add_cte(freed).add_cte(reported).add_cte(buried)
+        ).scalar()
+    else:
+        # the DELETE first, so a missing id costs one statement; the side
+        # effects follow only when a row was deleted, from the values it had
+        returned = (
+            reservations.c.user_id,
+            reservations.c.slot_id,
+            reservations.c.reservation_date,
+            reservations.c.site,
+            reservations.c.vaccinated,
         )
-        return reservation
-    except ValueError:
+        if deletes_returning(db):
+            gone = db.execute(
+                text(
+                    "DELETE FROM reservations WHERE reservation_id = :reservation_id "
+                    "RETURNING user_id, slot_id, reservation_date, site, vaccinated"
+                ).columns(*returned),
+                {"reservation_id": reservation_id},
+            ).first()
+        else:
+            gone = db.execute(select(*returned).where(matching)).first()
+            if gone is not None and not db.execute(reservations.delete().where(matching)).rowcount:
+                gone = None
+        deleted = gone is not None
+        if deleted:
+            if gone.slot_id is not None:
+                db.execute(
+                    slots.update()
+                    .where(slots.c.slot_id == gone.slot_id)
+                    .values(booked=slots.c.booked - 1)
+                )
+            report.record(db, [(gone.reservation_date, gone.site, -1, -int(bool(gone.vaccinated)), 1)])
+            db.execute(insert(models.ReservationTombstone.__table__).values(
+                reservation_id=reservation_id,
+                user_id=gone.user_id,
+                site=gone.site,
+                change_seq=models.next_change_seq(),
+                deleted_at=datetime.utcnow(),
+            ))
+    if not deleted:
+        db.rollback()
+        raise _not_found()
+    db.commit()
+    response_cache.invalidate(reservation_tag(reservation_id))
+    announce_changes()
+    return "Delete Successfully"
+
+
+def naive_utc(value: datetime):
+    # register_timestamp is stored without a timezone, as the UTC wall clock
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def range_bounds(start: datetime, end: datetime):
+    start, end = naive_utc(start), naive_utc(end)
+    if start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid date range"
+        )
+    return start, end
+
+
+def day_bounds(selected_year: int, selected_month: int, selected_day: int):
+    try:
+        min_datetime = datetime(selected_year, selected_month, selected_day)
+        return min_datetime, min_datetime + timedelta(days=1)
+    except (ValueError, OverflowError):
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid format date"
         )
 
+
+def today_bounds():
+    # the UTC day, like day_bounds and the cache's day tags
+    today = datetime.utcnow().date()
+    return day_bounds(today.year, today.month, today.day)
+
+
+def in_range(start: datetime, end: datetime):
+    """
+    Criteria for `start <= register_timestamp < end`. The bare column
+    comparison lets the (register_timestamp, reservation_id) index serve both
+    the filter and the keyset ordering.
+    """
+    return (
+        models.Reservation.register_timestamp >= start,
+        models.Reservation.register_timestamp < end,
+    )
+
+
+def range_query(start: datetime, end: datetime):
+    return listing().filter(*in_range(start, end))
+
+
+def get_range(
+    start: datetime, end: datetime, db: Session, limit: int, after: Optional[str] = None
+):
+    start, end = range_bounds(start, end)
+    rows = db.execute(by_timestamp(range_query(start, end), limit, after)).all()
+    return pagination.paginate(rows, limit, timestamp_key)
+
+
+def get_from_specific_date(
+    selected_year: int,
+    selected_month: int,
+    selected_day: int,
+    db: Session,
+    limit: int,
+    after: Optional[str] = None,
+):
+    start, end = day_bounds(selected_year, selected_month, selected_day)
+    return get_range(start, end, db, limit, after)
+
+
 def update(
     reservation_id: int,
     request: schemas.Reservation,
     db: Session,
-    current_user: schemas.User,
+    current_user: schemas.Principal,
 ):
-    reservation = db.query(models.Reservation).filter(
-        models.Reservation.reservation_id == reservation_id
-    )
-    if not reservation.first():
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="No reservation with this id"
-        )
     request_body = {
         "register_timestamp": request.register_timestamp,
+        "reservation_date": models.queue_day(request.register_timestamp),
         "user_id": current_user.user_id,
     }
-    reservation.update(request_body)
-    db.commit()
-    return reservation.first()
+    # the new timestamp can move the reservation to another day of the report
+    if supports_returning(db):
+        return _update_returning(reservation_id, request_body, db, reported=True)
+    vaccinated = report.vaccinated_count(models.Reservation.__table__.c.vaccinated)
+    report.record_one(db, reservation_id, booked=-1, vaccinated=-vaccinated)
+    return _update_returning(
+        reservation_id,
+        request_body,
+        db,
+        before_commit=lambda: report.record_one(db, reservation_id, booked=1, vaccinated=vaccinated),
+    )
 
 
-def get_all_new(db: Session):
-    all_new_reservations = (
-        db.query(models.Reservation)
-        .filter(func.DATE(models.Reservation.register_timestamp) == date.today())
-        .all()
-    )
-    return all_new_reservations
+def get_all_new(db: Session, limit: int, after: Optional[str] = None):
+    start, end = today_bounds()
+    return get_range(start, end, db, limit, after)
 
 
 def report_taken(reservation_id: int, db: Session):
-    reservation = db.query(models.Reservation).filter(
-        models.Reservation.reservation_id == reservation_id
-    )
-    if not reservation.first():
+    writer = journal.write_behind
+    if writer is not None:
+        # the 404 still comes from the database; the write waits for the next flush
+        reservation = get(reservation_id, db)
+        writer.append(reservation_id)
+        return shown_vaccinated(reservation)
+    request_body = {"vaccinated": True, "change_op": "vaccinated"}
+    if not supports_returning(db):
+        # counted only when it was not already reported
+        report.record_one(
+            db, reservation_id, models.Reservation.__table__.c.vaccinated.isnot(True), vaccinated=1
+        )
+    return _update_returning(reservation_id, request_body, db, reported=True)
+
+
+def reprioritize(reservation_id: int, request: schemas.Priority, db: Session):
+    # one UPDATE; the queue indexes move the row in O(log n)
+    return _update_returning(reservation_id, {"priority": request.priority}, db)
+
+
+def report_taken_many(reservation_ids: List[int], db: Session):
+    """
+    Mark every reservation in `reservation_ids` as vaccinated and count the
+    newly vaccinated ones in the report. PostgreSQL does it in one statement;
+    elsewhere it takes the report's INSERT ... SELECT, the UPDATE and a SELECT
+    of the matching ids.
+    """
+    if len(reservation_ids) > settings.max_bulk_size:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="No reservation with this id"
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"At most {settings.max_bulk_size} reservations per request",
+        )
+    requested = sorted(set(reservation_ids))
+    table = models.Reservation.__table__
+    matching = table.c.reservation_id.in_(requested)
+    newly_vaccinated = table.c.vaccinated.isnot(True)
+    if supports_returning(db):
+        changed = (
+            table.update()
+            .where(matching, newly_vaccinated)
+            .values(vaccinated=True, change_op="vaccinated")
+            .returning(table.c.reservation_date, table.c.site)
+            .cte("changed")
+        )
+        reported = report.adding(
+            report.upsert("postgresql").from_select(
+                ["day", "site", *report.COUNTS], report.deltas_of(changed, 0, 1, 0)
+            )
+        ).cte("reported")
+        # the outer SELECT sees the rows as they were before the statement:
+        # every requested id that exists, reported before or not
+        updated = db.execute(
+            select(table.c.reservation_id).where(matching).add_cte(changed).add_cte(reported)
+        ).scalars().all()
+    else:
+        report.record_from(db, report.deltas_of(table, 0, 1, 0).where(matching, newly_vaccinated))
+        db.execute(
+            table.update().where(matching, newly_vaccinated).values(vaccinated=True, change_op="vaccinated")
         )
-    request_body = {"vaccinated": True}
-    reservation.update(request_body)
+        updated = db.execute(select(table.c.reservation_id).where(matching)).scalars().all()
     db.commit()
-    return reservation.first()
+    updated = set(updated)
+    response_cache.invalidate(*map(reservation_tag, updated))
+    announce_changes()
+    return schemas.ReportTakenResult(
+        updated=[reservation_id for reservation_id in requested if reservation_id in updated],
+        missing=[reservation_id for reservation_id in requested if reservation_id not in updated],
+    )
@@ -0,0 +1,106 @@
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from .. import journal, models, schemas, pagination
+from . import reservation
+from .loaders import RESERVATION_WITH_OWNER
+from datetime import datetime
+from fastapi import status, HTTPException
+from typing import Optional
+
+# Reads are native async queries. Writes run the sync repository functions
+# through AsyncSession.run_sync, which drives them on the async connection
+# without a thread, so both modes share one implementation of every write.
+
+
+async def get_all(db: AsyncSession, limit: int, after: Optional[str] = None):
+    result = await db.execute(reservation.by_id(reservation.listing(), limit, after))
+    return pagination.paginate(result.all(), limit, reservation.id_key)
+
+
+async def get(reservation_id: int, db: AsyncSession):
+    pending = journal.is_pending(reservation_id)
+    result = await db.execute(
+        select(models.Reservation)
+        .options(*RESERVATION_WITH_OWNER)
+        .filter(models.Reservation.reservation_id == reservation_id)
+    )
+    found = result.scalars().first()
+    if not found:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="No reservation with this id"
+        )
+    return reservation.shown_vaccinated(found) if pending else found
+
+
+async def get_range(
+    start: datetime, end: datetime, db: AsyncSession, limit: int, after: Optional[str] = None
+):
+    start, end = reservation.range_bounds(start, end)
+    statement = reservation.by_timestamp(reservation.range_query(start, end), limit, after)
+    result = await db.execute(statement)
+    return pagination.paginate(result.all(), limit, reservation.timestamp_key)
+
+
+async def get_from_specific_date(
+    selected_year: int,
+    selected_month: int,
+    selected_day: int,
+    db: AsyncSession,
+    limit: int,
+    after: Optional[str] = None,
+):
+    start, end = reservation.day_bounds(selected_year, selected_month, selected_day)
+    return await get_range(start, end, db, limit, after)
+
+
+async def get_all_new(db: AsyncSession, limit: int, after: Optional[str] = None):
+    start, end = reservation.today_bounds()
+    return await get_range(start, end, db, limit, after)
+
+
+def _with_owner(write):
+    """Run `write` and load the owner while still on the sync side of run_sync."""
+    def run(session):
+        written = write(session)
+        if isinstance(written, models.Reservation):
+            written.owner
+        return written
+    return run
+
+
+async def create(request: schemas.Reservation, db: AsyncSession, current_user: schemas.Principal):
+    return await db.run_sync(
+        _with_owner(lambda session: reservation.create(request, session, current_user))
+    )
+
+
+async def update(
+    reservation_id: int,
+    request: schemas.Reservation,
+    db: AsyncSession,
+    current_user: schemas.Principal,
+):
+    return await db.run_sync(
+        _with_owner(
+            lambda session: reservation.update(reservation_id, request, session, current_user)
+        )
+    )
+
+
+async def delete(reservation_id: int, db: AsyncSession, current_user: schemas.Principal):
+    return await db.run_sync(
+        lambda session: reservation.delete(reservation_id, session, current_user)
+    )
+
+
+async def report_taken(reservation_id: int, db: AsyncSession):
+    writer = journal.write_behind
+    if writer is not None:
+        found = await get(reservation_id, db)
+        # the append waits for the disk: off the event loop
+        await run_in_threadpool(writer.append, reservation_id)
+        return reservation.shown_vaccinated(found)
+    return await db.run_sync(
+        _with_owner(lambda session: reservation.report_taken(reservation_id, session))
+    )
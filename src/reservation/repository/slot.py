@@ -0,0 +1,138 @@
+from sqlalchemy import exc, select, update
+from sqlalchemy.orm import Session
+from .. import models, schemas
+from . import report
+from ..broker import announce_changes
+from ..cache import response_cache, written_tags
+from ..database import supports_returning
+from .reservation import day_bounds, naive_utc
+from fastapi import status, HTTPException
+
+# A seat is taken with one conditional UPDATE, booked = booked + 1 WHERE
+# booked < capacity, in the same transaction as the reservation INSERT. The
+# database applies it atomically, so concurrent bookings of the last seat
+# cannot both succeed: PostgreSQL re-checks the condition after waiting for
+# the row lock, SQLite runs one writer at a time. Booking any slot of a day
+# first picks a candidate with FOR UPDATE SKIP LOCKED on PostgreSQL, so a
+# booking surge spreads over the day's slots instead of queueing on one row.
+
+# candidates tried by `book_any` before giving up; only a slot filled between
+# its SELECT and its UPDATE costs another attempt
+ALLOCATION_ATTEMPTS = 3
+
+
+def _not_found():
+    return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No slot with this id")
+
+
+def _fully_booked(detail: str = "This slot is fully booked"):
+    return HTTPException(status_code=status.HTTP_409_CONFLICT, detail=detail)
+
+
+def create(request: schemas.Slot, db: Session):
+    new_slot = models.Slot(
+        site=request.site, start=naive_utc(request.start), capacity=request.capacity, booked=0
+    )
+    db.add(new_slot)
+    try:
+        db.commit()
+    except exc.IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="This site already has a slot at this time"
+        )
+    db.refresh(new_slot)
+    return new_slot
+
+
+def get_from_specific_date(site: str, selected_year: int, selected_month: int, selected_day: int, db: Session):
+    start, end = day_bounds(selected_year, selected_month, selected_day)
+    return (
+        db.query(models.Slot)
+        .filter(models.Slot.site == site, models.Slot.start >= start, models.Slot.start < end)
+        .order_by(models.Slot.start)
+        .all()
+    )
+
+
+def take_seat(slot_id: int, db: Session):
+    """
+    Increment the slot's booked count if it has a free seat, and return the
+    slot's (start, site), or None when it is full or does not exist.
+    """
+    table = models.Slot.__table__
+    statement = (
+        update(table)
+        .where(table.c.slot_id == slot_id, table.c.booked < table.c.capacity)
+        .values(booked=table.c.booked + 1)
+    )
+    if supports_returning(db):
+        return db.execute(statement.returning(table.c.start, table.c.site)).first()
+    if db.execute(statement).rowcount != 1:
+        return None
+    return db.execute(select(table.c.start, table.c.site).where(table.c.slot_id == slot_id)).first()
+
+
+def _reserve(slot_id: int, seat, db: Session, current_user: schemas.Principal):
+    start, site = seat
+    new_reservation = models.Reservation(
+        register_timestamp=start, user_id=current_user.user_id, slot_id=slot_id, site=site
+    )
+    db.add(new_reservation)
+    report.record(db, [(models.queue_day(start), site, 1, 0, 0)])
+    db.commit()
+    response_cache.invalidate(*written_tags(None, current_user.user_id, start))
+    announce_changes()
+    db.refresh(new_reservation)
+    return new_reservation
+
+
+def book(slot_id: int, db: Session, current_user: schemas.Principal):
+    seat = take_seat(slot_id, db)
+    if seat is None:
+        db.rollback()
+        if db.get(models.Slot, slot_id) is None:
+            raise _not_found()
+        raise _fully_booked()
+    return _reserve(slot_id, seat, db, current_user)
+
+
+def book_any(
+    site: str,
+    selected_year: int,
+    selected_month: int,
+    selected_day: int,
+    db: Session,
+    current_user: schemas.Principal,
+):
+    """Book a seat in the earliest slot of the site's day that still has one."""
+    day_start, day_end = day_bounds(selected_year, selected_month, selected_day)
+    table = models.Slot.__table__
+    candidates = (
+        select(table.c.slot_id)
+        .where(
+            table.c.site == site,
+            table.c.start >= day_start,
+            table.c.start < day_end,
+            table.c.booked < table.c.capacity,
+        )
+        .order_by(table.c.start)
+        .limit(1)
+    )
+    locking = supports_returning(db)
+    for _ in range(ALLOCATION_ATTEMPTS):
+        if locking:
+            slot_id = db.execute(candidates.with_for_update(skip_locked=True)).scalar()
+            if slot_id is None:
+                # every open slot is locked by a booking in flight; wait for
+                # one instead of reporting a day that may still have seats
+                slot_id = db.execute(candidates.with_for_update()).scalar()
+        else:
+            slot_id = db.execute(candidates).scalar()
+        if slot_id is None:
+            break
+        seat = take_seat(slot_id, db)
+        if seat is not None:
+            return _reserve(slot_id, seat, db, current_user)
+    db.rollback()
+    raise _fully_booked("No slot with a free seat on this day")
@@ -1,9 +1,12 @@
 from .. import schemas, models
 from ..hashing import Hash
+from .loaders import USER_WITH_RESERVATIONS
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 from fastapi import HTTPException, status
+from typing import Optional
 
-def create(request: schemas.User, db: Session):
+def create(request: schemas.User, db: Session, hashed_password: Optional[str] = None):
     request_body = {
         "name": request.name,
         "surname": request.surname,
@@ -11,16 +14,23 @@ def create(request: schemas.User, db: Session):
         "birth_date": request.birth_date,
         "occupation": request.occupation,
         "address": request.address,
-        "password": Hash.bcrypt(request.password)
+        "password": hashed_password or Hash.bcrypt(request.password)
     }
     new_user = models.User(**request_body)
     db.add(new_user)
     db.commit()
     db.refresh(new_user)
+    # a new user has no reservations yet; mark it loaded so serializing does not lazy-load
+    set_committed_value(new_user, "reservations", [])
     return new_user
 
 def get(citizen_id, db: Session):
-    user = db.query(models.User).filter(models.User.citizen_id == citizen_id).first()
+    user = (
+        db.query(models.User)
+        .options(*USER_WITH_RESERVATIONS)
+        .filter(models.User.citizen_id == citizen_id)
+        .first()
+    )
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No user with this citizen id")
     return user
\ No newline at end of file
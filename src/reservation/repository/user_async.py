@@ -0,0 +1,24 @@
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .. import schemas, models
+from ..hashing import hash_executor
+from . import user
+from .loaders import USER_WITH_RESERVATIONS
+from fastapi import HTTPException, status
+
+async def create(request: schemas.User, db: AsyncSession):
+    hashed_password = await hash_executor.bcrypt(request.password)
+    return await db.run_sync(
+        lambda session: user.create(request, session, hashed_password)
+    )
+
+async def get(citizen_id, db: AsyncSession):
+    result = await db.execute(
+        select(models.User)
+        .options(*USER_WITH_RESERVATIONS)
+        .filter(models.User.citizen_id == citizen_id)
+    )
+    found = result.scalars().first()
+    if not found:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No user with this citizen id")
+    return found
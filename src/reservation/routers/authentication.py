@@ -1,27 +1,38 @@
-from fastapi import APIRouter, Depends, status, HTTPException
+from fastapi import APIRouter, Depends, Response, status, HTTPException
 from fastapi.security import OAuth2PasswordRequestForm
-from .. import schemas, database, models, token
+from .. import schemas, database, token, oauth2
 from sqlalchemy.orm import Session
-from ..hashing import Hash
+from starlette.concurrency import run_in_threadpool
+from ..hashing import hash_executor
 
 
 router = APIRouter(
     tags=['Authentication']
 )
 
-@router.post('/login', responses={status.HTTP_404_NOT_FOUND: {"model": schemas.NotFoundResponse, "description": "Send a request but no object was found"}})
-def login(request: OAuth2PasswordRequestForm=Depends(), db:Session=Depends(database.get_db)):
+@router.post('/login', responses={status.HTTP_404_NOT_FOUND: {"model": schemas.NotFoundResponse, "description": "Send a request but no object was found"}, status.HTTP_503_SERVICE_UNAVAILABLE: {"model": schemas.ServiceUnavailableResponse, "description": "Too many password requests in flight, retry after the Retry-After header"}})
+async def login(request: OAuth2PasswordRequestForm=Depends(), db:Session=Depends(database.get_db)):
     """
     Authenticate the user using this information:
     ### Request Body:
     - **username**: the citizen id of the user (13 digits) as a string e.g., "1134506547512"
     - **password**: the password of the user as a string e.g., "Verystrongpassword"
     """
-    user = db.query(models.User).filter(models.User.citizen_id == request.username).first()
+    user = await run_in_threadpool(oauth2.get_user, request.username, db)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Cannot found {request.username} citizen id")
-    if not Hash.verify_password(request.password, user.password):
+    if not await hash_executor.verify_password(request.password, user.password):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Incorrect password")
     # generate a jwt token
-    access_token = token.create_access_token(data={"sub": user.citizen_id})
-    return {"access_token": access_token, "token_type": "bearer"}
\ No newline at end of file
+    access_token = token.create_access_token(
+        data={"sub": user.citizen_id, "uid": user.user_id, "ver": user.token_version}
+    )
+    return {"access_token": access_token, "token_type": "bearer"}
+
+@router.post('/logout', status_code=status.HTTP_204_NO_CONTENT, responses={status.HTTP_401_UNAUTHORIZED: {"model": schemas.UnauthorizedResponse, "description": "Send a request but not authenticated"}})
+def logout(current_user: schemas.Principal=Depends(oauth2.get_current_user), db: Session=Depends(database.get_db)):
+    """
+    Revoke every access token issued to the current user so far (need to authorize)
+    """
+    oauth2.revoke_tokens(current_user.user_id, db)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
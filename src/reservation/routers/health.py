@@ -0,0 +1,18 @@
+from fastapi import APIRouter, Response, status
+from starlette.concurrency import run_in_threadpool
+from ..startup import readiness, database_answers
+
+router = APIRouter(tags=['Monitoring'])
+
+@router.get('/ready', responses={status.HTTP_503_SERVICE_UNAVAILABLE: {"description": "Still warming up, or the database does not answer"}})
+async def get_readiness(response: Response):
+    """
+    Readiness probe: 200 once this worker has warmed up at startup and the database answers, 503 otherwise.
+    """
+    if not readiness.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "starting"}
+    if not await run_in_threadpool(database_answers):
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "database unavailable"}
+    return {"status": "ready", "warm_up_seconds": readiness.warm_up_seconds}
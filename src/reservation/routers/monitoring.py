@@ -0,0 +1,24 @@
+from fastapi import APIRouter
+from .. import database, metrics
+
+router = APIRouter(
+    prefix="/monitoring",
+    tags=['Monitoring']
+)
+
+@router.get('/pool')
+def get_pool_status():
+    """
+    Live connection pool usage of this worker process:
+    - **primary** / **async**: pool class, configured size, idle (checkedin), in use (checkedout) and overflow connections
+    - **replicas**: the same for every read replica, with its URL and whether it is in the rotation
+    - **wait_seconds**: histogram of the time spent waiting for a connection
+    """
+    status = {
+        "primary": database.pool_status(database.engine),
+        "replicas": [replica.status() for replica in database.replicas.replicas],
+        "wait_seconds": metrics.histogram_snapshot(metrics.DB_POOL_WAIT_SECONDS),
+    }
+    if database.async_engine is not None:
+        status["async"] = database.pool_status(database.async_engine.sync_engine)
+    return status
@@ -0,0 +1,26 @@
+from fastapi import APIRouter, Depends
+from typing import List, Optional
+from datetime import date, datetime
+
+from ..schemas import DailyReport
+from ..database import get_read_db
+from sqlalchemy.orm import Session
+from ..repository import report
+
+router = APIRouter(prefix="/report", tags=["Reports"])
+
+
+@router.get("/daily", response_model=List[DailyReport])
+def get_daily_report(
+    day: Optional[date] = None,
+    site: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+):
+    """
+    Get the number of reservations booked, vaccinated and cancelled per Service Site on a day,
+    read from counts kept up to date by every write (reservations without a site have a null site):
+    ### Parameters:
+    - **day**: the day as an ISO format e.g., "2021-10-22", today (UTC) by default
+    - **site**: only this Service Site as a string e.g., "Bang Sue Grand Station"
+    """
+    return report.get_daily(day or datetime.utcnow().date(), db, site)
@@ -1,28 +1,154 @@
-from fastapi import APIRouter, Depends, status
-from typing import List
+from fastapi import APIRouter, Depends, Header, Query, status
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
+from datetime import datetime
 
 from ..schemas import (
     ShowReservation,
     Reservation,
-    User,
+    BulkReservation,
+    BulkReservationResult,
+    ReportTaken,
+    ReportTakenResult,
+    Priority,
+    BulkPriority,
+    BulkPriorityResult,
+    ChangePage,
+    Principal,
     UnauthorizedResponse,
     NotFoundResponse,
     NoPermissionResponse,
 )
-from ..database import get_db
-from .. import oauth2
+from ..database import get_db, get_read_db, pin_reads_to_primary
+from ..config import settings
+from ..pagination import page_size
+from .. import oauth2, export, listing, pagination, stream
+from ..cache import cached, day_listing, today_listing
+from ..idempotency import IdempotentRoute, idempotent
 from sqlalchemy.orm import Session
-from ..repository import reservation
+from ..repository import reservation, queue, changes
 
-router = APIRouter(prefix="/reservation", tags=["Reservations"])
+router = APIRouter(prefix="/reservation", tags=["Reservations"], route_class=IdempotentRoute)
 
 
 @router.get("/", response_model=List[ShowReservation])
-def get_all_reservations(db: Session = Depends(get_db)):
+def get_all_reservations(
+    limit: int = Query(settings.default_page_size, ge=1),
+    after: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+):
+    """
+    Get all the reservations that are created, one page at a time ordered by reservation id:
+    ### Parameters:
+    - **limit**: the maximum number of reservations in the page as an integer e.g., 100 (capped by the server)
+    - **after**: the cursor from the `X-Next-Cursor` header of the previous page
+    """
+    reservations, next_cursor = reservation.get_all(db, page_size(limit), after)
+    return listing.response(reservations, next_cursor)
+
+
+@router.get("/range", response_model=List[ShowReservation])
+def get_reservations_in_range(
+    start: datetime = Query(..., alias="from"),
+    end: datetime = Query(..., alias="to"),
+    limit: int = Query(settings.default_page_size, ge=1),
+    after: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+):
+    """
+    Get the reservations whose timestamp is in the half-open range [from, to), one page at a time:
+    ### Parameters:
+    - **from**: the first datetime of the range (inclusive) as an ISO format e.g., "2021-10-22T00:00:00"
+    - **to**: the end of the range (exclusive) as an ISO format e.g., "2021-10-23T00:00:00"
+    - **limit**: the maximum number of reservations in the page as an integer e.g., 100 (capped by the server)
+    - **after**: the cursor from the `X-Next-Cursor` header of the previous page
+    """
+    reservations, next_cursor = reservation.get_range(start, end, db, page_size(limit), after)
+    return listing.response(reservations, next_cursor)
+
+
+@router.get("/changes", response_model=ChangePage)
+def get_reservation_changes(
+    since: Optional[str] = None,
+    limit: int = Query(settings.default_page_size, ge=1),
+    db: Session = Depends(get_db),
+):
+    """
+    Get what changed since the last sync: reservations created or updated ("insert", "update",
+    "vaccinated", with the reservation as it is now) and deleted ("delete"), oldest change first. Call again
+    with **next_cursor** while **has_more** is true, then keep it for the next sync:
+    ### Parameters:
+    - **since**: the **next_cursor** of the previous call, or nothing for every change so far
+    - **limit**: the maximum number of changes in the page as an integer e.g., 100 (capped by the server)
+    """
+    return changes.get_changes(db, page_size(limit), since)
+
+
+@router.get(
+    "/stream",
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"text/event-stream": {}},
+            "description": "Server-Sent Events, one per change, for as long as the connection stays open",
+        }
+    },
+)
+async def stream_reservation_changes(
+    site: Optional[str] = None,
+    since: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    Receive reservations as they are created, updated, reported vaccinated and deleted, as
+    Server-Sent Events named "create", "update", "vaccinated" and "delete" whose data is a change
+    of `/reservation/changes`. A comment is sent after a quiet while to keep the connection open.
+    ### Parameters:
+    - **site**: only the reservations of this Service Site as a string e.g., "Bang Sue Grand Station"
+    - **since**: a **next_cursor** of `/reservation/changes` or an event id to start after, instead of only new changes
+    ### Headers:
+    - **Last-Event-ID**: the id of the last event received; sent by EventSource when it reconnects, so no event is missed
     """
-    Get all the reservations that are created
+    resume_from = last_event_id or since
+    position = pagination.decode_cursor(resume_from, int, int) if resume_from else None
+    return StreamingResponse(
+        stream.events(stream.hub, site, position),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get(
+    "/export",
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_200_OK: {
+            "content": {media_type: {} for media_type in export.MEDIA_TYPES.values()},
+            "description": "Every reservation with its owner, streamed",
+        }
+    },
+)
+def export_reservations(
+    format: export.ExportFormat = export.ExportFormat.ndjson,
+    compress: bool = False,
+    db: Session = Depends(get_read_db),
+):
+    """
+    Stream every reservation with its owner's information, ordered by reservation id:
+    ### Parameters:
+    - **format**: `ndjson` (one JSON object per line) or `csv`
+    - **compress**: gzip the stream on the fly as a boolean e.g., true
     """
-    return reservation.get_all(db)
+    headers = {
+        "Content-Disposition": f'attachment; filename="reservations.{format.value}"'
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(
+        export.stream(reservation.export(db), format, compress),
+        media_type=export.MEDIA_TYPES[format],
+        headers=headers,
+    )
 
 
 @router.post(
@@ -40,20 +166,51 @@ def get_all_reservations(db: Session = Depends(get_db)):
             "description": "Send a request but not authenticated",
         },
     },
+    dependencies=[Depends(pin_reads_to_primary)],
 )
+@idempotent
 def create_reservation(
     request: Reservation,
     db: Session = Depends(get_db),
-    current_user: User = Depends(oauth2.get_current_user),
+    current_user: Principal = Depends(oauth2.get_current_user),
 ):
     """
     Create a reservation with this information (need to authorize):
     ### Request Body:
     - **register_timestamp**: the datetime as an ISO format e.g., "2021-10-22T14:52:14.933Z"
+    ### Headers:
+    - **Idempotency-Key** (optional): a unique string per reservation attempt e.g., a UUID; a retry with the same key gets the first response back instead of creating another reservation
     """
     return reservation.create(request, db, current_user)
 
 
+@router.post(
+    "/bulk",
+    response_model=List[BulkReservationResult],
+    responses={
+        status.HTTP_401_UNAUTHORIZED: {
+            "model": UnauthorizedResponse,
+            "description": "Send a request but not authenticated",
+        },
+    },
+    dependencies=[Depends(pin_reads_to_primary)],
+)
+def create_reservations_in_bulk(
+    request: List[BulkReservation],
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(oauth2.get_current_user),
+):
+    """
+    Create many reservations for many citizens in one request (need to authorize).
+    Every item gets a result in the same order: the new **reservation_id**, or a **detail**
+    explaining why that item was not created. The other items are created anyway.
+    ### Request Body (a list, at most `MAX_BULK_SIZE` items):
+    - **citizen_id**: the citizen id of the user (13 digits) as a string e.g., "1134506547512"
+    - **register_timestamp**: the datetime as an ISO format e.g., "2021-10-22T14:52:14.933Z"
+    """
+    return reservation.bulk_create(request, db)
+
+
 @router.get(
     "/{reservation_id}",
     response_model=ShowReservation,
@@ -64,7 +221,7 @@ def create_reservation(
         }
     },
 )
-def get_reservation(reservation_id: int, db: Session = Depends(get_db)):
+def get_reservation(reservation_id: int, db: Session = Depends(get_read_db)):
     """
     Get the specific reservation's detail from reservation's id:
     ### Parameters:
@@ -77,8 +234,14 @@ def get_reservation(reservation_id: int, db: Session = Depends(get_db)):
     "/{year}/{month}/{day}",
     response_model=List[ShowReservation],
 )
+@cached(day_listing)
 def get_reservations_from_specific_date(
-    year: int, month: int, day: int, db: Session = Depends(get_db)
+    year: int,
+    month: int,
+    day: int,
+    limit: int = Query(settings.default_page_size, ge=1),
+    after: Optional[str] = None,
+    db: Session = Depends(get_read_db),
 ):
     """
     Get the specific reservation's detail from the specific year, month, and day:
@@ -86,8 +249,13 @@ def get_reservations_from_specific_date(
     - **year**: the year of the specific reservation as an integer e.g., 2020
     - **month**: the month of the specific reservation as an integer e.g., 10
     - **day**: the day of the specific reservation as an integer e.g., 21
+    - **limit**: the maximum number of reservations in the page as an integer e.g., 100 (capped by the server)
+    - **after**: the cursor from the `X-Next-Cursor` header of the previous page
     """
-    return reservation.get_from_specific_date(year, month, day, db)
+    reservations, next_cursor = reservation.get_from_specific_date(
+        year, month, day, db, page_size(limit), after
+    )
+    return listing.response(reservations, next_cursor)
 
 
 @router.delete(
@@ -102,11 +270,12 @@ def get_reservations_from_specific_date(
             "description": "Send a request but no object was found",
         },
     },
+    dependencies=[Depends(pin_reads_to_primary)],
 )
 def delete_reservation(
     reservation_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(oauth2.get_current_user),
+    current_user: Principal = Depends(oauth2.get_current_user),
 ):
     """
     Delete the specific reservation from reservation's id:
@@ -116,6 +285,102 @@ def delete_reservation(
     return reservation.delete(reservation_id, db, current_user)
 
 
+@router.put(
+    "/report-taken",
+    response_model=ReportTakenResult,
+    dependencies=[Depends(pin_reads_to_primary)],
+)
+def update_report_taken_in_bulk(request: ReportTaken, db: Session = Depends(get_db)):
+    """
+    Update the vaccinated field to true for many reservations at once.
+    Ids that do not match a reservation are listed in **missing**.
+    ### Request Body:
+    - **reservation_ids**: the ids of the reservations as a list of integers e.g., [1, 2, 3] (at most `MAX_BULK_SIZE`)
+    """
+    return reservation.report_taken_many(request.reservation_ids, db)
+
+
+@router.put(
+    "/priority",
+    response_model=BulkPriorityResult,
+    responses={
+        status.HTTP_401_UNAUTHORIZED: {
+            "model": UnauthorizedResponse,
+            "description": "Send a request but not authenticated",
+        },
+    },
+    dependencies=[Depends(pin_reads_to_primary)],
+)
+def update_priority_in_bulk(
+    request: BulkPriority,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(oauth2.get_current_user),
+):
+    """
+    Raise the priority of every pending reservation of the citizens matching any of the criteria,
+    e.g., everyone over 60 or every healthcare worker. Reservations already at or above it are left as they are (need to authorize).
+    ### Request Body:
+    - **priority**: the priority to raise them to as an integer e.g., 10
+    - **min_age**: match citizens at least this old as an integer e.g., 60
+    - **occupations**: match citizens with any of these occupations (case-insensitive) e.g., ["doctor", "nurse"]
+    - **day**: only change the reservations of this day as Date format e.g., "2021-10-22"
+    """
+    return queue.bump(request, db)
+
+
+@router.get("/queue/{year}/{month}/{day}", response_model=List[ShowReservation])
+def get_next_in_queue(
+    year: int,
+    month: int,
+    day: int,
+    site: Optional[str] = None,
+    limit: int = Query(settings.default_page_size, ge=1),
+    db: Session = Depends(get_db),
+):
+    """
+    Get the next pending reservations of the day in serving order: highest priority first, then first registered:
+    ### Parameters:
+    - **year**: the year as an integer e.g., 2021
+    - **month**: the month as an integer e.g., 10
+    - **day**: the day as an integer e.g., 22
+    - **site**: only the reservations booked at this Service Site as a string e.g., "Bang Sue Grand Station"
+    - **limit**: how many reservations to take as an integer e.g., 100 (capped by the server)
+    """
+    start, _ = reservation.day_bounds(year, month, day)
+    return listing.response(queue.next_batch(start.date(), db, page_size(limit), site), None)
+
+
+@router.put(
+    "/{reservation_id}/priority",
+    response_model=ShowReservation,
+    responses={
+        status.HTTP_401_UNAUTHORIZED: {
+            "model": UnauthorizedResponse,
+            "description": "Send a request but not authenticated",
+        },
+        status.HTTP_404_NOT_FOUND: {
+            "model": NotFoundResponse,
+            "description": "Send a request but no object was found",
+        },
+    },
+    dependencies=[Depends(pin_reads_to_primary)],
+)
+def update_priority(
+    reservation_id: int,
+    request: Priority,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(oauth2.get_current_user),
+):
+    """
+    Change the priority of the specific reservation; higher is served first (need to authorize):
+    ### Parameters:
+    - **reservation_id**: the id of the specific reservation as an integer e.g., 1
+    ### Request Body:
+    - **priority**: the new priority as an integer e.g., 10
+    """
+    return reservation.reprioritize(reservation_id, request, db)
+
+
 @router.put(
     "/{reservation_id}",
     response_model=ShowReservation,
@@ -129,12 +394,13 @@ def delete_reservation(
             "description": "Send a request but no object was found",
         },
     },
+    dependencies=[Depends(pin_reads_to_primary)],
 )
 def update_reservation(
     reservation_id: int,
     request: Reservation,
     db: Session = Depends(get_db),
-    current_user: User = Depends(oauth2.get_current_user),
+    current_user: Principal = Depends(oauth2.get_current_user),
 ):
     """
     Update the specific reservation from reservation's id with this information (need to authorize):
@@ -147,11 +413,20 @@ def update_reservation(
 
 
 @router.get("/new/", response_model=List[ShowReservation])
-def get_all_new_reservations(db: Session = Depends(get_db)):
+@cached(today_listing)
+def get_all_new_reservations(
+    limit: int = Query(settings.default_page_size, ge=1),
+    after: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+):
     """
-    Get all reservations that are created today
+    Get all reservations that are created today (UTC), one page at a time:
+    ### Parameters:
+    - **limit**: the maximum number of reservations in the page as an integer e.g., 100 (capped by the server)
+    - **after**: the cursor from the `X-Next-Cursor` header of the previous page
     """
-    return reservation.get_all_new(db)
+    reservations, next_cursor = reservation.get_all_new(db, page_size(limit), after)
+    return listing.response(reservations, next_cursor)
 
 
 @router.put(
@@ -167,6 +442,7 @@ def get_all_new_reservations(db: Session = Depends(get_db)):
             "description": "Send a request but no object was found",
         },
     },
+    dependencies=[Depends(pin_reads_to_primary)],
 )
 def update_report_taken(
     reservation_id: int,
@@ -174,5 +450,9 @@ def update_report_taken(
 ):
     """
     Update the vaccinated field to true in the reservation model.
+    With `REPORT_WRITE_BEHIND` the report is journaled before the answer and
+    written to the database with the others of the next `REPORT_FLUSH_INTERVAL_MS`.
+    ### Parameters:
+    - **reservation_id**: the id of the specific reservation as an integer e.g., 1
     """
     return reservation.report_taken(reservation_id, db)
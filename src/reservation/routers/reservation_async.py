@@ -0,0 +1,109 @@
+from fastapi import APIRouter, Depends, Query, status
+from typing import List, Optional
+from datetime import datetime
+
+from ..schemas import ShowReservation, Reservation, Principal
+from ..database import get_async_db, get_async_read_db
+from ..config import settings
+from ..pagination import page_size
+from .. import oauth2, listing
+from ..cache import cached, day_listing, today_listing
+from ..idempotency import IdempotentRoute, idempotent
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..repository import reservation_async as reservation
+
+# `async def` handlers for DATABASE_ASYNC mode. Each one replaces the sync
+# handler with the same path and method (see main.use_async_routes), which
+# also keeps that handler's documentation; paths without an async handler
+# here stay on the sync implementation.
+router = APIRouter(prefix="/reservation", tags=["Reservations"], route_class=IdempotentRoute)
+
+
+@router.get("/", response_model=List[ShowReservation])
+async def get_all_reservations(
+    limit: int = Query(settings.default_page_size, ge=1),
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_read_db),
+):
+    reservations, next_cursor = await reservation.get_all(db, page_size(limit), after)
+    return listing.response(reservations, next_cursor)
+
+
+@router.get("/range", response_model=List[ShowReservation])
+async def get_reservations_in_range(
+    start: datetime = Query(..., alias="from"),
+    end: datetime = Query(..., alias="to"),
+    limit: int = Query(settings.default_page_size, ge=1),
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_read_db),
+):
+    reservations, next_cursor = await reservation.get_range(
+        start, end, db, page_size(limit), after
+    )
+    return listing.response(reservations, next_cursor)
+
+
+@router.post("/", response_model=ShowReservation, status_code=status.HTTP_201_CREATED)
+@idempotent
+async def create_reservation(
+    request: Reservation,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(oauth2.get_current_user),
+):
+    return await reservation.create(request, db, current_user)
+
+
+@router.get("/{reservation_id}", response_model=ShowReservation)
+async def get_reservation(reservation_id: int, db: AsyncSession = Depends(get_async_read_db)):
+    return await reservation.get(reservation_id, db)
+
+
+@router.get("/{year}/{month}/{day}", response_model=List[ShowReservation])
+@cached(day_listing)
+async def get_reservations_from_specific_date(
+    year: int,
+    month: int,
+    day: int,
+    limit: int = Query(settings.default_page_size, ge=1),
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_read_db),
+):
+    reservations, next_cursor = await reservation.get_from_specific_date(
+        year, month, day, db, page_size(limit), after
+    )
+    return listing.response(reservations, next_cursor)
+
+
+@router.delete("/{reservation_id}")
+async def delete_reservation(
+    reservation_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(oauth2.get_current_user),
+):
+    return await reservation.delete(reservation_id, db, current_user)
+
+
+@router.put("/{reservation_id}", response_model=ShowReservation)
+async def update_reservation(
+    reservation_id: int,
+    request: Reservation,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(oauth2.get_current_user),
+):
+    return await reservation.update(reservation_id, request, db, current_user)
+
+
+@router.get("/new/", response_model=List[ShowReservation])
+@cached(today_listing)
+async def get_all_new_reservations(
+    limit: int = Query(settings.default_page_size, ge=1),
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_read_db),
+):
+    reservations, next_cursor = await reservation.get_all_new(db, page_size(limit), after)
+    return listing.response(reservations, next_cursor)
+
+
+@router.put("/report-taken/{reservation_id}", response_model=ShowReservation)
+async def update_report_taken(reservation_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await reservation.report_taken(reservation_id, db)
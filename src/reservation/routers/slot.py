@@ -0,0 +1,123 @@
+from fastapi import APIRouter, Depends, status
+from typing import List
+
+from ..schemas import (
+    Slot,
+    ShowSlot,
+    ShowReservation,
+    Principal,
+    UnauthorizedResponse,
+    FullyBookedResponse,
+)
+from ..database import get_db, get_read_db, pin_reads_to_primary
+from .. import oauth2
+from sqlalchemy.orm import Session
+from ..repository import slot
+
+router = APIRouter(prefix="/slot", tags=["Slots"])
+
+
+@router.post(
+    "/",
+    response_model=ShowSlot,
+    status_code=status.HTTP_201_CREATED,
+    responses={
+        status.HTTP_401_UNAUTHORIZED: {
+            "model": UnauthorizedResponse,
+            "description": "Send a request but not authenticated",
+        },
+    },
+    dependencies=[Depends(pin_reads_to_primary)],
+)
+def create_slot(
+    request: Slot,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(oauth2.get_current_user),
+):
+    """
+    Open a time slot at a Service Site (need to authorize):
+    ### Request Body:
+    - **site**: the name of the Service Site as a string e.g., "Bang Sue Grand Station"
+    - **start**: the start of the slot as an ISO format e.g., "2021-10-22T09:00:00Z"
+    - **capacity**: how many citizens can be vaccinated in the slot as an integer e.g., 50
+    """
+    return slot.create(request, db)
+
+
+@router.get("/{site}/{year}/{month}/{day}", response_model=List[ShowSlot])
+def get_slots_from_specific_date(
+    site: str, year: int, month: int, day: int, db: Session = Depends(get_read_db)
+):
+    """
+    Get the slots of a Service Site on a specific day with how many seats are booked:
+    ### Parameters:
+    - **site**: the name of the Service Site as a string e.g., "Bang Sue Grand Station"
+    - **year**: the year as an integer e.g., 2021
+    - **month**: the month as an integer e.g., 10
+    - **day**: the day as an integer e.g., 22
+    """
+    return slot.get_from_specific_date(site, year, month, day, db)
+
+
+@router.post(
+    "/{slot_id}/book",
+    response_model=ShowReservation,
+    status_code=status.HTTP_201_CREATED,
+    responses={
+        status.HTTP_401_UNAUTHORIZED: {
+            "model": UnauthorizedResponse,
+            "description": "Send a request but not authenticated",
+        },
+        status.HTTP_409_CONFLICT: {
+            "model": FullyBookedResponse,
+            "description": "Every seat of the slot is taken",
+        },
+    },
+    dependencies=[Depends(pin_reads_to_primary)],
+)
+def book_slot(
+    slot_id: int,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(oauth2.get_current_user),
+):
+    """
+    Reserve a seat in a specific slot (need to authorize):
+    ### Parameters:
+    - **slot_id**: the id of the slot as an integer e.g., 1
+    """
+    return slot.book(slot_id, db, current_user)
+
+
+@router.post(
+    "/{site}/{year}/{month}/{day}/book",
+    response_model=ShowReservation,
+    status_code=status.HTTP_201_CREATED,
+    responses={
+        status.HTTP_401_UNAUTHORIZED: {
+            "model": UnauthorizedResponse,
+            "description": "Send a request but not authenticated",
+        },
+        status.HTTP_409_CONFLICT: {
+            "model": FullyBookedResponse,
+            "description": "Every slot of the day is fully booked",
+        },
+    },
+    dependencies=[Depends(pin_reads_to_primary)],
+)
+def book_any_slot(
+    site: str,
+    year: int,
+    month: int,
+    day: int,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(oauth2.get_current_user),
+):
+    """
+    Reserve a seat in the earliest slot of the day that still has one (need to authorize):
+    ### Parameters:
+    - **site**: the name of the Service Site as a string e.g., "Bang Sue Grand Station"
+    - **year**: the year as an integer e.g., 2021
+    - **month**: the month as an integer e.g., 10
+    - **day**: the day as an integer e.g., 22
+    """
+    return slot.book_any(site, year, month, day, db, current_user)
@@ -1,18 +1,22 @@
 from fastapi import APIRouter, Depends, status
-from ..database import get_db
-from ..schemas import ShowUser, User, NotFoundResponse
-from ..hashing import Hash
-from .. import models
+from ..database import get_db, get_read_db, pin_reads_to_primary
+from ..schemas import ShowUser, User, NotFoundResponse, ServiceUnavailableResponse
+from ..hashing import hash_executor
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from ..repository import user
+from ..cache import cached, user_detail
+from ..idempotency import IdempotentRoute, idempotent
 
 router = APIRouter(
     prefix="/user",
-    tags=['Users']
+    tags=['Users'],
+    route_class=IdempotentRoute
 )
 
-@router.post('/', response_model=ShowUser, status_code=status.HTTP_201_CREATED, responses={status.HTTP_201_CREATED: {"model": ShowUser, "description": "Create Successful"}})
-def create_user(request: User, db: Session=Depends(get_db)):
+@router.post('/', response_model=ShowUser, status_code=status.HTTP_201_CREATED, responses={status.HTTP_201_CREATED: {"model": ShowUser, "description": "Create Successful"}, status.HTTP_503_SERVICE_UNAVAILABLE: {"model": ServiceUnavailableResponse, "description": "Too many password requests in flight, retry after the Retry-After header"}}, dependencies=[Depends(pin_reads_to_primary)])
+@idempotent
+async def create_user(request: User, db: Session=Depends(get_db)):
     """
     Create a user with these information:
     ### Request Body:
@@ -23,11 +27,15 @@ def create_user(request: User, db: Session=Depends(get_db)):
     - **occupation**: the occupation of the user as a string e.g., "Doctor"
     - **address**: the address of the user as a string e.g., "Bangkok"
     - **password**: the password of the user as a string e.g., "Verystrongpassword"
+    ### Headers:
+    - **Idempotency-Key** (optional): a unique string per registration attempt e.g., a UUID; a retry with the same key gets the first response back without hashing the password again
     """
-    return user.create(request, db)
+    hashed_password = await hash_executor.bcrypt(request.password)
+    return await run_in_threadpool(user.create, request, db, hashed_password)
 
 @router.get('/{citizen_id}', response_model=ShowUser, responses={status.HTTP_404_NOT_FOUND: {"model": NotFoundResponse, "description": "Send a request but no object was found"}})
-def get_user(citizen_id: str, db: Session=Depends(get_db)):
+@cached(user_detail)
+def get_user(citizen_id: str, db: Session=Depends(get_read_db)):
     """
     Get the specific user's detail from the citizen id:
     ### Parameters:
@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Depends, status
+from ..database import get_async_db, get_async_read_db
+from ..schemas import ShowUser, User
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..repository import user_async as user
+from ..cache import cached, user_detail
+from ..idempotency import IdempotentRoute, idempotent
+
+# `async def` handlers for DATABASE_ASYNC mode, see routers/reservation_async.py
+router = APIRouter(
+    prefix="/user",
+    tags=['Users'],
+    route_class=IdempotentRoute
+)
+
+@router.post('/', response_model=ShowUser, status_code=status.HTTP_201_CREATED)
+@idempotent
+async def create_user(request: User, db: AsyncSession=Depends(get_async_db)):
+    return await user.create(request, db)
+
+@router.get('/{citizen_id}', response_model=ShowUser)
+@cached(user_detail)
+async def get_user(citizen_id: str, db: AsyncSession=Depends(get_async_read_db)):
+    return await user.get(citizen_id, db)
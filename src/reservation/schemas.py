@@ -12,6 +12,26 @@ class Reservation(ReservationBase):
         orm_mode = True
 
 
+class BulkReservation(ReservationBase):
+    citizen_id: str
+
+
+class BulkReservationResult(BaseModel):
+    index: int
+    citizen_id: str
+    reservation_id: Optional[int] = None
+    detail: Optional[str] = None
+
+
+class ReportTaken(BaseModel):
+    reservation_ids: List[int]
+
+
+class ReportTakenResult(BaseModel):
+    updated: List[int]
+    missing: List[int]
+
+
 class ReservationForUser(BaseModel):
     reservation_id: int
     register_timestamp: datetime
@@ -67,12 +87,29 @@ class ShowReservation(BaseModel):
     reservation_id: int
     register_timestamp: datetime
     vaccinated: bool
+    priority: int
     owner: ShowUserInfo
 
     class Config:
         orm_mode = True
 
 
+class ReservationChange(BaseModel):
+    # "insert", "update", "vaccinated" or "delete"
+    op: str
+    reservation_id: int
+    site: Optional[str] = None
+    changed_at: Optional[datetime] = None
+    # the reservation as it is now; null once deleted
+    reservation: Optional[ShowReservation] = None
+
+
+class ChangePage(BaseModel):
+    changes: List[ReservationChange]
+    next_cursor: str
+    has_more: bool
+
+
 class Login(BaseModel):
     citizen_id: str
     password: str
@@ -85,6 +122,57 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     citizen_id: Optional[str] = None
+    user_id: Optional[int] = None
+    token_version: Optional[int] = None
+    expires_at: Optional[float] = None
+
+
+class Priority(BaseModel):
+    priority: int
+
+
+class BulkPriority(Priority):
+    min_age: Optional[int] = None
+    occupations: List[str] = []
+    day: Optional[date] = None
+
+
+class BulkPriorityResult(BaseModel):
+    updated: int
+
+
+class DailyReport(BaseModel):
+    day: date
+    site: Optional[str] = None
+    booked: int
+    vaccinated: int
+    cancelled: int
+
+
+class Slot(BaseModel):
+    site: str
+    start: datetime
+    capacity: int
+
+    @validator("capacity")
+    def check_capacity(cls, value: int):
+        if value < 1:
+            raise ValueError("capacity must be at least 1")
+        return value
+
+
+class ShowSlot(Slot):
+    slot_id: int
+    booked: int
+
+    class Config:
+        orm_mode = True
+
+
+class Principal(BaseModel):
+    user_id: int
+    citizen_id: str
+    token_version: int = 0
 
 
 class UnauthorizedResponse(BaseModel):
@@ -97,3 +185,11 @@ class NotFoundResponse(BaseModel):
 
 class NoPermissionResponse(BaseModel):
     detail: Optional[str] = "No permission"
+
+
+class ServiceUnavailableResponse(BaseModel):
+    detail: Optional[str] = "Too many password requests, try again later"
+
+
+class FullyBookedResponse(BaseModel):
+    detail: Optional[str] = "This slot is fully booked"
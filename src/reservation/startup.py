@@ -0,0 +1,76 @@
+import logging
+import time
+from sqlalchemy import exc, text
+from starlette.concurrency import run_in_threadpool
+
+from . import database, journal, token
+from .config import settings
+from .hashing import hash_executor
+from .repository import reservation
+
+# Work every worker does once before it takes traffic, so that the first
+# requests do not pay for it. /ready answers 503 until it is done.
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness():
+    def __init__(self):
+        self.ready = False
+        self.warm_up_seconds = None
+
+
+readiness = Readiness()
+
+
+def warm_pool(engine, connections: int):
+    """Open `connections` connections at once and hand them back to the pool."""
+    opened = []
+    try:
+        for _ in range(max(connections, 1)):
+            opened.append(engine.connect())
+    finally:
+        for connection in opened:
+            connection.close()
+
+
+async def warm_async_pool(engine, connections: int):
+    opened = []
+    try:
+        for _ in range(max(connections, 1)):
+            opened.append(await engine.connect())
+    finally:
+        for connection in opened:
+            await connection.close()
+
+
+def warm_jwt():
+    # the first encode and decode load jose's algorithm backends
+    token.verify_token(token.create_access_token({"sub": "warm-up"}), ValueError())
+
+
+async def warm_up():
+    started = time.perf_counter()
+    try:
+        await run_in_threadpool(warm_pool, database.engine, settings.db_pool_warm)
+        if database.async_engine is not None:
+            await warm_async_pool(database.async_engine, settings.db_pool_warm)
+    except exc.DBAPIError as error:
+        # not fatal: /ready keeps checking the database and reports it
+        logger.warning("could not open database connections at startup: %s", error)
+    warm_jwt()
+    await hash_executor.warm_up()
+    if settings.report_write_behind:
+        # replays the journals of crashed workers before taking their reports
+        await run_in_threadpool(journal.start, reservation.report_taken_many)
+    readiness.warm_up_seconds = time.perf_counter() - started
+    readiness.ready = True
+
+
+def database_answers():
+    try:
+        with database.engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        return True
+    except exc.DBAPIError:
+        return False
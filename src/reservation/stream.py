@@ -0,0 +1,176 @@
+import asyncio
+import logging
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from . import pagination
+from .broker import get_broker
+from .config import settings
+from .database import SessionLocal
+from .repository import changes
+
+# GET /reservation/stream as Server-Sent Events. Every event is a change of
+# the change feed and its id is the feed cursor after it, so a client that
+# reconnects with Last-Event-ID gets exactly what it missed, read from the
+# feed, before the live events. Live events come from one Hub per worker:
+# when the broker says something changed it reads the feed once and hands
+# each change to the streams subscribed to its site, so the database sees
+# one reader per worker however many sites are connected.
+
+# the event names of the feed's ops
+EVENTS = {"insert": "create", "update": "update", "vaccinated": "vaccinated", "delete": "delete"}
+
+# milliseconds a client waits before reconnecting
+RETRY_MS = 3000
+
+# changes read from the feed at a time
+READ_BATCH = 500
+
+# put on a subscription's queue when it fell too far behind
+OVERFLOW = object()
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription():
+    def __init__(self, site: Optional[str]):
+        self.site = site
+        self.queue = asyncio.Queue(maxsize=settings.stream_queue_size)
+
+    def wants(self, change):
+        return self.site is None or change.site == self.site
+
+
+class Hub():
+    """Reads the change feed for this worker's streams when the broker wakes it."""
+
+    def __init__(self, broker=None, sessions=SessionLocal):
+        self.broker = broker
+        self.sessions = sessions
+        self.subscriptions = set()
+        self.position = None
+        self._loop = None
+        self._task = None
+        self._ready = None
+
+    def read(self, cursor, limit: int = READ_BATCH):
+        db = self.sessions()
+        try:
+            return changes.read(db, limit, cursor)
+        finally:
+            db.close()
+
+    def latest(self):
+        db = self.sessions()
+        try:
+            return changes.latest(db)
+        finally:
+            db.close()
+
+    async def start(self):
+        """Start reading the feed, from its current end, unless already started."""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._ready = loop.create_future()
+            self._task = loop.create_task(self._run())
+        await asyncio.shield(self._ready)
+
+    async def _run(self):
+        try:
+            self.position = await run_in_threadpool(self.latest)
+        except Exception as error:
+            self._ready.set_exception(error)
+            raise
+        self._ready.set_result(None)
+        async for _ in (self.broker or get_broker()).listen():
+            try:
+                await self.pump()
+            except Exception:
+                # the next wake-up reads on from the same position
+                logger.exception("Reading the change feed failed")
+
+    async def pump(self):
+        while True:
+            page, has_more = await run_in_threadpool(self.read, self.position)
+            for key, change in page:
+                for subscription in list(self.subscriptions):
+                    if subscription.wants(change):
+                        self._put(subscription, (key, change))
+                self.position = key
+            if not has_more:
+                return
+
+    def _put(self, subscription: Subscription, item):
+        try:
+            subscription.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # too slow: its stream ends and the client resumes from the feed
+            self.subscriptions.discard(subscription)
+            while not subscription.queue.empty():
+                subscription.queue.get_nowait()
+            subscription.queue.put_nowait(OVERFLOW)
+
+    def subscribe(self, site: Optional[str] = None):
+        subscription = Subscription(site)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+
+hub = Hub()
+
+
+def event(key, change):
+    data = change.json()
+    return f"id: {pagination.encode_cursor(*key)}\nevent: {EVENTS[change.op]}\ndata: {data}\n\n"
+
+
+async def events(hub: Hub, site: Optional[str] = None, since: Optional[tuple] = None):
+    """
+    The stream of one client: the changes after the feed key `since`, or
+    only the new ones without it, with a heartbeat comment after
+    STREAM_HEARTBEAT quiet seconds.
+    """
+    await hub.start()
+    position = since if since is not None else hub.position
+    # subscribed before catching up, so nothing falls between the two; the
+    # live events already caught up with are skipped by their key
+    subscription = hub.subscribe(site)
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+        while True:
+            page, has_more = await run_in_threadpool(hub.read, position)
+            for key, change in page:
+                position = key
+                if subscription.wants(change):
+                    yield event(key, change)
+            if not has_more:
+                break
+        while True:
+            try:
+                item = await asyncio.wait_for(subscription.queue.get(), settings.stream_heartbeat)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            if item is OVERFLOW:
+                return
+            key, change = item
+            if key <= position:
+                continue
+            position = key
+            yield event(key, change)
+    finally:
+        hub.unsubscribe(subscription)
@@ -16,7 +16,12 @@ def verify_token(token: str, credentials_exception):
         citizen_id: str = payload.get("sub")
         if citizen_id is None:
             raise credentials_exception
-        token_data = schemas.TokenData(citizen_id=citizen_id)
+        token_data = schemas.TokenData(
+            citizen_id=citizen_id,
+            user_id=payload.get("uid"),
+            token_version=payload.get("ver"),
+            expires_at=payload.get("exp"),
+        )
         return token_data
     except JWTError:
-        raise credentials_exception
\ No newline at end of file
+        raise credentials_exception
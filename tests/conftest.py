@@ -0,0 +1,35 @@
+import os
+import pytest
+from uuid import uuid4
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+from src.reservation.cache import response_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_response_cache():
+    # every test starts from a fresh database, so nothing cached may carry over
+    response_cache.clear()
+
+
+@pytest.fixture()
+def postgres_url():
+    """
+    TEST_POSTGRES_URL pointed at a schema of its own, dropped after the test,
+    so the tables of the database it names are never touched.
+    """
+    url = os.environ.get("TEST_POSTGRES_URL")
+    if not url:
+        pytest.skip("TEST_POSTGRES_URL is not set")
+    schema = f"test_{uuid4().hex}"
+    admin = create_engine(url)
+    with admin.begin() as connection:
+        connection.exec_driver_sql(f'CREATE SCHEMA "{schema}"')
+    try:
+        yield make_url(url).update_query_dict({"options": f"-csearch_path={schema}"})
+    finally:
+        with admin.begin() as connection:
+            connection.exec_driver_sql(f'DROP SCHEMA "{schema}" CASCADE')
+        admin.dispose()
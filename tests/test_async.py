@@ -0,0 +1,180 @@
+import pytest
+from datetime import datetime
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from src.reservation import database
+from src.reservation.main import use_async_routes
+from src.reservation.database import Base, ReplicaSet, get_db, get_async_db
+from src.reservation.oauth2 import get_current_user
+from src.reservation.models import Reservation, User
+from src.reservation.routers import reservation, user, reservation_async, user_async
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# every TestClient request runs on a fresh event loop, so do not pool async connections
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingAsyncSessionLocal = sessionmaker(
+    async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
+def override_get_current_user():
+    return User(user_id=1, citizen_id="1152347583215")
+
+
+@pytest.fixture()
+def test_db():
+    Base.metadata.create_all(bind=engine)
+    yield
+    Base.metadata.drop_all(bind=engine)
+
+
+app = FastAPI()
+app.include_router(reservation.router)
+app.include_router(user.router)
+use_async_routes(app, reservation_async.router, user_async.router)
+app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
+app.dependency_overrides[get_current_user] = override_get_current_user
+
+client = TestClient(app)
+
+user_data = {
+    "name": "foo",
+    "surname": "rock",
+    "citizen_id": "1152347583215",
+    "birth_date": "2021-10-12",
+    "occupation": "doctor",
+    "address": "1145 bangkok",
+    "password": "strong_password",
+}
+
+
+def create_reservation(timestamp):
+    return client.post("/reservation/", json={"register_timestamp": timestamp})
+
+
+class TestAsyncRoutes:
+    def test_async_handlers_replace_sync_handlers_in_place(self):
+        endpoints = {route.endpoint for route in app.routes}
+        assert reservation_async.get_reservation in endpoints
+        assert reservation.get_reservation not in endpoints
+        # paths without an async handler keep the sync one
+        assert reservation.export_reservations in endpoints
+
+    def test_async_route_keeps_sync_documentation(self):
+        route = next(r for r in app.routes if r.endpoint is reservation_async.get_reservation)
+        assert "reservation's id" in route.description
+
+    def test_create_and_get_user(self, test_db):
+        response = client.post("/user/", json=user_data)
+        assert response.status_code == 201
+        assert response.json()["reservations"] == []
+        response = client.get("/user/1152347583215")
+        assert response.status_code == 200
+        assert response.json()["citizen_id"] == "1152347583215"
+
+    def test_reservation_crud(self, test_db):
+        client.post("/user/", json=user_data)
+        response = create_reservation("2021-10-12T22:02:14.760Z")
+        assert response.status_code == 201
+        assert response.json()["owner"]["citizen_id"] == "1152347583215"
+        response = client.put(
+            "/reservation/1", json={"register_timestamp": "2021-11-12T22:01:14.760Z"}
+        )
+        assert response.status_code == 200
+        assert response.json()["register_timestamp"] == "2021-11-12T22:01:14.760000"
+        response = client.put("/reservation/report-taken/1")
+        assert response.json()["vaccinated"] is True
+        assert client.get("/reservation/1").status_code == 200
+        assert client.delete("/reservation/1").status_code == 200
+        response = client.get("/reservation/1")
+        assert response.status_code == 404
+        assert response.json()["detail"] == "No reservation with this id"
+
+    def test_list_reservations_with_pagination(self, test_db):
+        client.post("/user/", json=user_data)
+        create_reservation("2021-10-12T22:02:14.760Z")
+        create_reservation("2021-10-12T22:03:14.760Z")
+        create_reservation("2021-10-13T22:02:14.760Z")
+        first_page = client.get("/reservation/?limit=2")
+        assert [r["reservation_id"] for r in first_page.json()] == [1, 2]
+        cursor = first_page.headers["X-Next-Cursor"]
+        response = client.get(f"/reservation/?limit=2&after={cursor}")
+        assert [r["reservation_id"] for r in response.json()] == [3]
+        response = client.get("/reservation/2021/10/12")
+        assert [r["reservation_id"] for r in response.json()] == [1, 2]
+        response = client.get("/reservation/2021/10/40")
+        assert response.status_code == 422
+
+
+REPLICA_URL = "sqlite:///./test_replica_1.db"
+
+
+@pytest.fixture()
+def replica(test_db, monkeypatch):
+    """A replica whose only reservation belongs to user 11."""
+    replica_set = ReplicaSet([REPLICA_URL], retry_after=30)
+    replica_engine = replica_set.replicas[0].engine
+    Base.metadata.create_all(bind=replica_engine)
+    db = sessionmaker(bind=replica_engine)()
+    db.add(User(
+        user_id=11, name="foo", surname="rock", citizen_id="1152347583226",
+        birth_date=datetime(2021, 10, 12).date(), occupation="doctor", address="1145 bangkok",
+        password="strong_password",
+    ))
+    db.add(Reservation(register_timestamp=datetime(2021, 10, 12, 22, 2, 14), user_id=11))
+    db.commit()
+    db.close()
+    monkeypatch.setattr(database, "replicas", replica_set)
+    client.cookies.clear()
+    yield replica_set
+    client.cookies.clear()
+    Base.metadata.drop_all(bind=replica_engine)
+    replica_engine.dispose()
+
+
+def owner_ids():
+    return [r["owner"]["citizen_id"] for r in client.get("/reservation/").json()]
+
+
+class TestAsyncReplicas:
+    def test_async_reads_go_to_the_replica(self, replica):
+        assert owner_ids() == ["1152347583226"]
+        assert client.get("/reservation/1").json()["owner"]["citizen_id"] == "1152347583226"
+        assert client.get("/user/1152347583226").status_code == 200
+
+    def test_async_writes_pin_reads_to_the_primary(self, replica):
+        response = client.post("/user/", json=user_data)
+        assert database.READ_PRIMARY_COOKIE in response.cookies
+        response = create_reservation("2021-10-12T22:02:14.760Z")
+        assert response.status_code == 201
+        assert database.READ_PRIMARY_COOKIE in response.cookies
+        assert owner_ids() == ["1152347583215"]
+
+    def test_swapped_routes_keep_their_dependencies(self):
+        route = next(r for r in app.routes if r.endpoint is reservation_async.update_report_taken)
+        assert [depends.dependency for depends in route.dependencies] == [database.pin_reads_to_primary]
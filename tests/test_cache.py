@@ -0,0 +1,79 @@
+import time
+from datetime import datetime, timezone
+
+from src.reservation.cache import ResponseCache, day_tag, etag_matches, today_listing, written_tags
+from src.reservation.repository import reservation
+
+
+def store(cache, key, tags=(), body=b"[]"):
+    return cache.put(key, body, {"content-type": "application/json"}, tags, cache.generation)
+
+
+class TestResponseCache:
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ResponseCache(max_entries=2, ttl=60)
+        store(cache, "a")
+        store(cache, "b")
+        cache.get("a")
+        store(cache, "c")
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.get("c") is not None
+
+    def test_expired_entry_is_a_miss(self):
+        cache = ResponseCache(max_entries=2, ttl=0.01)
+        store(cache, "a")
+        time.sleep(0.02)
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+    def test_invalidate_drops_only_tagged_entries(self):
+        cache = ResponseCache(max_entries=10, ttl=60)
+        store(cache, "day", ["day:2021-10-12", "reservation:1"])
+        store(cache, "user", ["user:1", "reservation:1"])
+        store(cache, "other", ["day:2021-10-13"])
+        cache.invalidate("reservation:1")
+        assert cache.get("day") is None
+        assert cache.get("user") is None
+        assert cache.get("other") is not None
+
+    def test_response_computed_before_invalidation_is_not_stored(self):
+        cache = ResponseCache(max_entries=10, ttl=60)
+        generation = cache.generation
+        cache.invalidate("day:2021-10-12")
+        entry = cache.put("day", b"[]", {}, ["day:2021-10-12"], generation)
+        assert entry.etag.startswith('W/"')
+        assert cache.get("day") is None
+
+    def test_same_body_same_etag(self):
+        cache = ResponseCache(max_entries=10, ttl=60)
+        assert store(cache, "a").etag == store(cache, "b").etag
+        assert store(cache, "c", body=b"[1]").etag != store(cache, "a").etag
+
+    def test_disabled_without_size_or_ttl(self):
+        assert not ResponseCache(max_entries=0, ttl=60).enabled
+        assert not ResponseCache(max_entries=10, ttl=0).enabled
+
+
+class TestEtagMatches:
+    def test_weak_comparison(self):
+        assert etag_matches('W/"abc"', 'W/"abc"')
+        assert etag_matches('"abc"', 'W/"abc"')
+        assert etag_matches('"x", W/"abc"', 'W/"abc"')
+        assert etag_matches("*", 'W/"abc"')
+        assert not etag_matches('W/"abd"', 'W/"abc"')
+        assert not etag_matches(None, 'W/"abc"')
+
+
+class TestToday:
+    def test_today_is_the_utc_day_whatever_the_local_time_zone(self, monkeypatch):
+        # local dates 14 hours ahead of and 12 behind UTC: at any moment one differs from it
+        for zone in ("Etc/GMT-14", "Etc/GMT+12"):
+            monkeypatch.setenv("TZ", zone)
+            time.tzset()
+            today = datetime.utcnow().date()
+            written = written_tags(1, 1, datetime.now(timezone.utc))[0]
+            assert today_listing(None, []) == [day_tag(today)] == [written]
+            assert reservation.today_bounds()[0].date() == today
+        monkeypatch.undo()
+        time.tzset()
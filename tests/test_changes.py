@@ -0,0 +1,183 @@
+import os
+import pytest
+from datetime import date
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from src.reservation import bootstrap
+from src.reservation.main import app
+from src.reservation.database import Base, get_db
+from src.reservation.oauth2 import get_current_user
+from src.reservation.models import Reservation, User
+from src.reservation.repository import changes as changes_repository
+from src.reservation.schemas import Principal
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30}
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+
+def override_get_current_user():
+    return Principal(user_id=1, citizen_id="1152347583215")
+
+
+@pytest.fixture()
+def test_db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    db.add(User(
+        user_id=1,
+        name="foo",
+        surname="rock",
+        citizen_id="1152347583215",
+        birth_date=date(2021, 10, 12),
+        occupation="doctor",
+        address="1145 bangkok",
+        password="strong_password",
+    ))
+    db.commit()
+    db.close()
+    overridden = {
+        dependency: app.dependency_overrides.get(dependency)
+        for dependency in (get_db, get_current_user)
+    }
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_current_user] = override_get_current_user
+    yield
+    for dependency, previous in overridden.items():
+        if previous is None:
+            app.dependency_overrides.pop(dependency, None)
+        else:
+            app.dependency_overrides[dependency] = previous
+    Base.metadata.drop_all(bind=engine)
+
+
+client = TestClient(app)
+
+
+def create_reservation(timestamp="2021-10-22T09:00:00"):
+    return client.post("/reservation/", json={"register_timestamp": timestamp})
+
+
+def changes(since=None, limit=100):
+    params = {"limit": limit}
+    if since is not None:
+        params["since"] = since
+    response = client.get("/reservation/changes", params=params)
+    assert response.status_code == 200
+    return response.json()
+
+
+def ops(page):
+    return [(change["op"], change["reservation_id"]) for change in page["changes"]]
+
+
+class TestChangeFeed:
+    def test_empty_feed_gives_a_cursor(self, test_db):
+        page = changes()
+        assert page["changes"] == []
+        assert page["has_more"] is False
+        create_reservation()
+        assert ops(changes(page["next_cursor"])) == [("insert", 1)]
+
+    def test_inserts_in_order(self, test_db):
+        create_reservation()
+        create_reservation()
+        page = changes()
+        assert ops(page) == [("insert", 1), ("insert", 2)]
+        assert page["changes"][0]["reservation"]["owner"]["citizen_id"] == "1152347583215"
+        assert changes(page["next_cursor"])["changes"] == []
+
+    def test_only_what_changed_since_the_cursor(self, test_db):
+        for _ in range(3):
+            create_reservation()
+        cursor = changes()["next_cursor"]
+        client.put("/reservation/report-taken/2")
+        client.delete("/reservation/3")
+        page = changes(cursor)
+        assert ops(page) == [("vaccinated", 2), ("delete", 3)]
+        assert page["changes"][0]["reservation"]["vaccinated"] is True
+        assert page["changes"][1]["reservation"] is None
+
+    def test_site_of_the_change(self, test_db):
+        client.post("/slot/", json={"site": "Bang Sue", "start": "2021-10-22T09:00:00", "capacity": 5})
+        client.post("/slot/1/book")
+        client.delete("/reservation/1")
+        assert [change["site"] for change in changes()["changes"]] == ["Bang Sue"]
+
+    def test_a_row_written_again_moves_to_its_latest_change(self, test_db):
+        create_reservation()
+        create_reservation()
+        client.put("/reservation/1", json={"register_timestamp": "2021-10-23T09:00:00"})
+        assert ops(changes()) == [("insert", 2), ("update", 1)]
+
+    def test_bulk_writes_are_in_the_feed(self, test_db):
+        client.post("/reservation/bulk", json=[
+            {"citizen_id": "1152347583215", "register_timestamp": "2021-10-22T09:00:00"},
+            {"citizen_id": "1152347583215", "register_timestamp": "2021-10-22T10:00:00"},
+        ])
+        cursor = changes()["next_cursor"]
+        client.put("/reservation/priority", json={"priority": 5, "occupations": ["doctor"]})
+        # a statement writing many rows gives them one number; the id breaks the tie
+        assert ops(changes(cursor)) == [("update", 1), ("update", 2)]
+        client.put("/reservation/report-taken", json={"reservation_ids": [1, 2]})
+        assert ops(changes(cursor)) == [("vaccinated", 1), ("vaccinated", 2)]
+
+    def test_pages(self, test_db):
+        for _ in range(3):
+            create_reservation()
+        client.delete("/reservation/1")
+        first = changes(limit=2)
+        assert ops(first) == [("insert", 2), ("insert", 3)]
+        assert first["has_more"] is True
+        second = changes(first["next_cursor"], limit=2)
+        assert ops(second) == [("delete", 1)]
+        assert second["has_more"] is False
+
+    def test_invalid_cursor(self, test_db):
+        assert client.get("/reservation/changes", params={"since": "nope"}).status_code == 422
+
+
+class TestSequencing:
+    def test_nothing_to_number_on_sqlite(self, test_db):
+        create_reservation()
+        db = TestingSessionLocal()
+        try:
+            assert changes_repository.sequence_pending(db) == 0
+        finally:
+            db.close()
+
+    @pytest.mark.skipif(
+        not os.environ.get("TEST_POSTGRES_URL"), reason="TEST_POSTGRES_URL is not set"
+    )
+    def test_numbered_in_bounded_batches_on_postgres(self, postgres_url, monkeypatch):
+        monkeypatch.setattr(changes_repository, "SEQUENCE_BATCH", 2)
+        postgres_engine = create_engine(postgres_url)
+        try:
+            bootstrap.upgrade(postgres_engine)
+            db = sessionmaker(bind=postgres_engine)()
+            owner = User(
+                name="foo", surname="rock", citizen_id="1152347583215",
+                birth_date=date(2021, 10, 12), occupation="doctor", address="1145 bangkok",
+            )
+            db.add(owner)
+            db.flush()
+            db.add_all(Reservation(user_id=owner.user_id) for _ in range(5))
+            db.commit()
+            assert [changes_repository.sequence_pending(db) for _ in range(4)] == [2, 2, 1, 0]
+            assert db.query(Reservation).filter(Reservation.change_seq.is_(None)).count() == 0
+            db.close()
+        finally:
+            postgres_engine.dispose()
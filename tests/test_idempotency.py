@@ -0,0 +1,254 @@
+import hashlib
+import pytest
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+from fastapi import Request
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from src.reservation import idempotency
+from src.reservation.main import app
+from src.reservation.config import settings
+from src.reservation.database import Base, get_db
+from src.reservation.hashing import hash_executor
+from src.reservation.oauth2 import get_current_user
+from src.reservation.models import IdempotencyKey, Reservation, User
+from src.reservation.schemas import Principal
+from src.reservation.repository import reservation as reservation_repository
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30}
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+
+def override_get_current_user():
+    return Principal(user_id=1, citizen_id="1152347583215")
+
+
+@pytest.fixture()
+def test_db():
+    Base.metadata.create_all(bind=engine)
+    # the owner of the reservations created as override_get_current_user
+    db = TestingSessionLocal()
+    db.add(User(
+        user_id=1, **{**USER, "citizen_id": "1152347583215", "birth_date": date(2021, 10, 12)}
+    ))
+    db.commit()
+    db.close()
+    overridden = {
+        dependency: app.dependency_overrides.get(dependency)
+        for dependency in (get_db, get_current_user)
+    }
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_current_user] = override_get_current_user
+    yield
+    for dependency, previous in overridden.items():
+        if previous is None:
+            app.dependency_overrides.pop(dependency, None)
+        else:
+            app.dependency_overrides[dependency] = previous
+    Base.metadata.drop_all(bind=engine)
+
+
+client = TestClient(app)
+
+USER = {
+    "name": "foo",
+    "surname": "rock",
+    "citizen_id": "1152347583216",
+    "birth_date": "2021-10-12",
+    "occupation": "doctor",
+    "address": "1145 bangkok",
+    "password": "strong_password",
+}
+
+
+def create_reservation(key=None, timestamp="2021-10-12T22:02:14.760Z", token="a"):
+    headers = {"Authorization": f"Bearer {token}"}
+    if key is not None:
+        headers["Idempotency-Key"] = key
+    return client.post("/reservation/", json={"register_timestamp": timestamp}, headers=headers)
+
+
+def count(model):
+    db = TestingSessionLocal()
+    try:
+        return db.query(model).count()
+    finally:
+        db.close()
+
+
+class TestIdempotentReservation:
+    def test_retry_replays_the_first_response(self, test_db):
+        first = create_reservation("key-1")
+        retry = create_reservation("key-1")
+        assert first.status_code == retry.status_code == 201
+        assert retry.json() == first.json()
+        assert retry.headers["idempotent-replayed"] == "true"
+        assert "idempotent-replayed" not in first.headers
+        assert count(Reservation) == 1
+
+    def test_requests_without_a_key_are_not_deduplicated(self, test_db):
+        create_reservation()
+        create_reservation()
+        assert count(Reservation) == 2
+
+    def test_key_reused_for_a_different_request(self, test_db):
+        create_reservation("key-1")
+        response = create_reservation("key-1", timestamp="2021-10-13T08:00:00Z")
+        assert response.status_code == 422
+        assert count(Reservation) == 1
+
+    def test_keys_of_different_callers_do_not_collide(self, test_db):
+        create_reservation("key-1", token="a")
+        response = create_reservation("key-1", token="b")
+        assert "idempotent-replayed" not in response.headers
+        assert count(Reservation) == 2
+
+    def test_overlong_key_is_refused(self, test_db):
+        assert create_reservation("k" * 256).status_code == 422
+
+    def test_concurrent_duplicate_waits_for_the_first(self, test_db, monkeypatch):
+        create = reservation_repository.create
+
+        def slow_create(*args):
+            time.sleep(0.3)
+            return create(*args)
+
+        monkeypatch.setattr(reservation_repository, "create", slow_create)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            first = pool.submit(create_reservation, "key-1")
+            time.sleep(0.1)
+            duplicate = pool.submit(create_reservation, "key-1")
+            responses = [first.result(), duplicate.result()]
+        assert [response.status_code for response in responses] == [201, 201]
+        assert responses[0].json() == responses[1].json()
+        assert responses[1].headers["idempotent-replayed"] == "true"
+        assert count(Reservation) == 1
+
+    def test_duplicate_gives_up_after_the_wait(self, test_db, monkeypatch):
+        monkeypatch.setattr(settings, "idempotency_wait", 0)
+        body = b'{"register_timestamp": "2021-10-12T22:02:14.760Z"}'
+        # another worker is still handling the first request with this key
+        db = TestingSessionLocal()
+        scope = f"POST /reservation/ {hashlib.sha256(b'Bearer a').hexdigest()[:32]}"
+        assert idempotency.claim(db, scope, "key-1", hashlib.sha256(body).hexdigest()) is None
+        db.close()
+        response = client.post("/reservation/", data=body, headers={
+            "Authorization": "Bearer a",
+            "Content-Type": "application/json",
+            "Idempotency-Key": "key-1",
+        })
+        assert response.status_code == 409
+        assert "retry-after" in response.headers
+        assert count(Reservation) == 0
+
+
+class TestIdempotentRegistration:
+    def test_retry_does_not_hash_the_password_again(self, test_db, monkeypatch):
+        calls = []
+        bcrypt = hash_executor.bcrypt
+
+        async def counting_bcrypt(password):
+            calls.append(password)
+            return await bcrypt(password)
+
+        monkeypatch.setattr(hash_executor, "bcrypt", counting_bcrypt)
+        first = client.post("/user/", json=USER, headers={"Idempotency-Key": "signup"})
+        retry = client.post("/user/", json=USER, headers={"Idempotency-Key": "signup"})
+        assert first.status_code == retry.status_code == 201
+        assert retry.json() == first.json()
+        assert len(calls) == 1
+        assert count(User) == 2
+
+    def test_keys_of_different_citizens_do_not_collide(self, test_db):
+        other = {**USER, "citizen_id": "1152347583217"}
+        first = client.post("/user/", json=USER, headers={"Idempotency-Key": "signup"})
+        second = client.post("/user/", json=other, headers={"Idempotency-Key": "signup"})
+        assert first.status_code == second.status_code == 201
+        assert "idempotent-replayed" not in second.headers
+        assert second.json()["citizen_id"] == "1152347583217"
+        assert count(User) == 3
+
+    def test_failed_request_releases_its_key(self, test_db):
+        client.post("/user/", json=USER)
+        # the citizen id is taken, so the INSERT fails
+        failed = TestClient(app, raise_server_exceptions=False).post(
+            "/user/", json=USER, headers={"Idempotency-Key": "signup"}
+        )
+        assert failed.status_code == 500
+        assert count(IdempotencyKey) == 0
+
+
+class TestRequestCaller:
+    def request(self, headers=None):
+        return Request({"type": "http", "method": "POST", "headers": [
+            (name.lower().encode(), value.encode()) for name, value in (headers or {}).items()
+        ]})
+
+    def test_credentials_stand_for_the_caller(self):
+        caller = idempotency.request_caller(self.request({"Authorization": "Bearer a"}), b"{}")
+        assert caller == hashlib.sha256(b"Bearer a").hexdigest()[:32]
+
+    def test_anonymous_caller_is_the_citizen(self):
+        callers = {
+            idempotency.request_caller(self.request(), f'{{"citizen_id": "{citizen_id}"}}'.encode())
+            for citizen_id in ("1152347583216", "1152347583217")
+        }
+        assert len(callers) == 2 and None not in callers
+
+    def test_unknown_anonymous_caller(self):
+        for body in (b"", b"[]", b'{"citizen_id": 5}', b"not json"):
+            assert idempotency.request_caller(self.request(), body) is None
+
+    def test_anonymous_keys_must_be_uuids(self):
+        assert idempotency.is_uuid("9b2c1f0e-6a47-4d1b-8f0e-2b7f7c1e5a3d")
+        assert not idempotency.is_uuid("signup")
+
+
+class TestClaim:
+    def test_held_key_is_returned(self, test_db):
+        db = TestingSessionLocal()
+        assert idempotency.claim(db, "scope", "key", "a") is None
+        held = idempotency.claim(db, "scope", "key", "a")
+        assert held.status_code is None
+        db.close()
+
+    def test_expired_key_is_claimed_again(self, test_db):
+        db = TestingSessionLocal()
+        now = datetime(2021, 10, 12)
+        assert idempotency.claim(db, "scope", "key", "a", now) is None
+        later = now + timedelta(seconds=settings.idempotency_ttl + 1)
+        assert idempotency.claim(db, "scope", "key", "b", later) is None
+        db.close()
+
+    def test_abandoned_key_is_taken_over(self, test_db):
+        db = TestingSessionLocal()
+        now = datetime(2021, 10, 12)
+        assert idempotency.claim(db, "scope", "key", "a", now) is None
+        soon = now + timedelta(seconds=1)
+        assert idempotency.claim(db, "scope", "key", "a", soon) is not None
+        later = now + timedelta(seconds=settings.idempotency_lock_timeout + 1)
+        assert idempotency.claim(db, "scope", "key", "a", later) is None
+        db.close()
+
+    def test_purge_expired(self, test_db):
+        db = TestingSessionLocal()
+        now = datetime(2021, 10, 12)
+        idempotency.claim(db, "scope", "old", "a", now)
+        idempotency.claim(db, "scope", "new", "a", now + timedelta(days=2))
+        assert idempotency.purge_expired(db, now + timedelta(seconds=settings.idempotency_ttl)) == 1
+        db.close()
@@ -0,0 +1,368 @@
+import fcntl
+import logging
+import os
+import pytest
+import threading
+import time
+from datetime import date
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from src.reservation import journal
+from src.reservation.config import settings
+from src.reservation.main import app
+from src.reservation.database import Base, get_db
+from src.reservation.oauth2 import get_current_user
+from src.reservation.models import Reservation, User
+from src.reservation.schemas import Principal
+from src.reservation.repository import reservation as reservation_repository
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30}
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+
+def override_get_current_user():
+    return Principal(user_id=1, citizen_id="1152347583215")
+
+
+@pytest.fixture()
+def test_db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    db.add(User(
+        user_id=1,
+        name="foo",
+        surname="rock",
+        citizen_id="1152347583215",
+        birth_date=date(2021, 10, 12),
+        occupation="doctor",
+        address="1145 bangkok",
+        password="strong_password",
+    ))
+    db.commit()
+    db.close()
+    overridden = {
+        dependency: app.dependency_overrides.get(dependency)
+        for dependency in (get_db, get_current_user)
+    }
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_current_user] = override_get_current_user
+    yield
+    for dependency, previous in overridden.items():
+        if previous is None:
+            app.dependency_overrides.pop(dependency, None)
+        else:
+            app.dependency_overrides[dependency] = previous
+    Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture()
+def journal_dir(tmp_path, monkeypatch):
+    # no flush unless a test asks for one
+    monkeypatch.setattr(settings, "report_flush_interval_ms", 60_000)
+    yield str(tmp_path)
+    journal.stop()
+
+
+def start_journal(directory):
+    journal.start(reservation_repository.report_taken_many, TestingSessionLocal, directory)
+    return journal.write_behind
+
+
+client = TestClient(app)
+
+
+def create_reservation(timestamp="2021-10-22T09:00:00"):
+    return client.post("/reservation/", json={"register_timestamp": timestamp})
+
+
+def vaccinated_in_database():
+    db = TestingSessionLocal()
+    try:
+        return {
+            reservation.reservation_id: reservation.vaccinated
+            for reservation in db.query(Reservation)
+        }
+    finally:
+        db.close()
+
+
+def eventually(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def write_orphan(directory, pid, journal_lines=b"", flushing_lines=None):
+    name = os.path.join(directory, f"{journal.PREFIX}{pid}")
+    open(name + ".lock", "w").close()
+    with open(name + ".journal", "wb") as orphan:
+        orphan.write(journal_lines)
+    if flushing_lines is not None:
+        with open(name + ".journal.flushing", "wb") as orphan:
+            orphan.write(flushing_lines)
+    return name
+
+
+class TestWriteBehind():
+    def test_acknowledged_before_the_database_is_written(self, test_db, journal_dir):
+        create_reservation()
+        writer = start_journal(journal_dir)
+        response = client.put("/reservation/report-taken/1")
+        assert response.status_code == 200
+        assert response.json()["vaccinated"] is True
+        assert vaccinated_in_database() == {1: False}
+        with open(writer.path, "rb") as journaled:
+            assert journaled.read() == b"1\n"
+
+    def test_reads_show_the_pending_report(self, test_db, journal_dir):
+        create_reservation()
+        create_reservation("2021-10-23T09:00:00")
+        start_journal(journal_dir)
+        client.put("/reservation/report-taken/1")
+        assert client.get("/reservation/1").json()["vaccinated"] is True
+        assert client.get("/reservation/2").json()["vaccinated"] is False
+
+    def test_unknown_reservation(self, test_db, journal_dir):
+        writer = start_journal(journal_dir)
+        assert client.put("/reservation/report-taken/1").status_code == 404
+        assert not writer.is_pending(1)
+        assert os.path.getsize(writer.path) == 0
+
+    def test_flush(self, test_db, journal_dir):
+        create_reservation()
+        create_reservation("2021-10-22T15:00:00")
+        create_reservation("2021-10-23T09:00:00")
+        writer = start_journal(journal_dir)
+        client.put("/reservation/report-taken/1")
+        client.put("/reservation/report-taken/2")
+        writer.flush()
+        assert vaccinated_in_database() == {1: True, 2: True, 3: False}
+        assert not writer.is_pending(1)
+        assert not os.path.exists(writer.flushing_path)
+        assert os.path.getsize(writer.path) == 0
+        # counted in the report and in the change feed like any other report
+        assert client.get("/report/daily", params={"day": "2021-10-22"}).json()[0]["vaccinated"] == 2
+        ops = [change["op"] for change in client.get("/reservation/changes").json()["changes"]]
+        assert ops == ["insert", "vaccinated", "vaccinated"]
+
+    def test_failed_flush_is_retried(self, test_db, journal_dir):
+        create_reservation()
+        writer = start_journal(journal_dir)
+        client.put("/reservation/report-taken/1")
+        apply = writer.apply
+
+        def failing(ids, db):
+            raise RuntimeError("database unavailable")
+
+        writer.apply = failing
+        with pytest.raises(RuntimeError):
+            writer.flush()
+        # still on disk and still shown while it waits
+        assert writer.is_pending(1)
+        assert os.path.exists(writer.flushing_path)
+        writer.apply = apply
+        writer.flush()
+        assert vaccinated_in_database() == {1: True}
+        assert not os.path.exists(writer.flushing_path)
+
+    def test_failing_flushes_back_off(self, test_db, journal_dir, monkeypatch, caplog):
+        monkeypatch.setattr(settings, "report_flush_interval_ms", 5)
+        create_reservation()
+        writer = start_journal(journal_dir)
+        attempts = []
+
+        def failing(ids, db):
+            attempts.append(time.monotonic())
+            raise RuntimeError("database unavailable")
+
+        writer.apply = failing
+        with caplog.at_level(logging.ERROR, logger=journal.__name__):
+            client.put("/reservation/report-taken/1")
+            time.sleep(0.5)
+            # 5, 10, 20, ... 320 ms apart, instead of a retry every 5 ms
+            assert 3 <= len(attempts) <= 8
+            assert len(caplog.records) == 1
+        assert attempts[-1] - attempts[-2] > 2 * (attempts[1] - attempts[0])
+        writer.apply = reservation_repository.report_taken_many
+        journal.stop()
+        assert vaccinated_in_database() == {1: True}
+
+    def test_retry_delay(self):
+        assert journal.retry_delay(0.005, 1) == 0.01
+        assert journal.retry_delay(0.005, 3) == 0.04
+        assert journal.retry_delay(0.005, 10_000) == journal.MAX_RETRY_SECONDS
+
+    def test_flushed_after_the_interval(self, test_db, journal_dir, monkeypatch):
+        monkeypatch.setattr(settings, "report_flush_interval_ms", 5)
+        create_reservation()
+        start_journal(journal_dir)
+        client.put("/reservation/report-taken/1")
+        eventually(lambda: vaccinated_in_database() == {1: True})
+
+    def test_flushed_when_the_batch_is_full(self, test_db, journal_dir, monkeypatch):
+        monkeypatch.setattr(settings, "report_flush_batch", 2)
+        create_reservation()
+        create_reservation("2021-10-23T09:00:00")
+        start_journal(journal_dir)
+        client.put("/reservation/report-taken/1")
+        client.put("/reservation/report-taken/2")
+        eventually(lambda: vaccinated_in_database() == {1: True, 2: True})
+
+    def test_stop_flushes_and_cleans_up(self, test_db, journal_dir):
+        create_reservation()
+        writer = start_journal(journal_dir)
+        client.put("/reservation/report-taken/1")
+        journal.stop()
+        assert vaccinated_in_database() == {1: True}
+        assert os.listdir(journal_dir) == []
+        # back to writing straight away
+        assert journal.write_behind is None
+        assert not writer.is_pending(1)
+
+    def test_without_write_behind(self, test_db):
+        create_reservation()
+        assert client.put("/reservation/report-taken/1").json()["vaccinated"] is True
+        assert vaccinated_in_database() == {1: True}
+
+
+class TestWorkers():
+    def test_reads_show_another_workers_pending_report(self, test_db, journal_dir):
+        create_reservation()
+        create_reservation("2021-10-23T09:00:00")
+        # two workers of one deployment; the requests below reach "serving"
+        workers = [
+            journal.WriteBehind(
+                journal_dir, reservation_repository.report_taken_many, TestingSessionLocal,
+                interval=60, worker=worker,
+            )
+            for worker in ("reporting", "serving")
+        ]
+        reporting, serving = workers
+        for worker in workers:
+            worker.start()
+        journal.write_behind = serving
+        try:
+            reporting.append(1)
+            assert vaccinated_in_database() == {1: False, 2: False}
+            assert client.get("/reservation/1").json()["vaccinated"] is True
+            assert client.get("/reservation/2").json()["vaccinated"] is False
+            # still shown while its flush is in progress, and from the database after it
+            reporting._rotate()
+            assert client.get("/reservation/1").json()["vaccinated"] is True
+            reporting.flush()
+            assert not serving.is_pending(1)
+            assert client.get("/reservation/1").json()["vaccinated"] is True
+        finally:
+            for worker in workers:
+                worker.stop()
+            journal.write_behind = None
+
+    def test_a_live_workers_journal_is_not_replayed(self, test_db, journal_dir):
+        create_reservation()
+        reporting = journal.WriteBehind(
+            journal_dir, reservation_repository.report_taken_many, TestingSessionLocal,
+            interval=60, worker="reporting",
+        )
+        reporting.start()
+        try:
+            reporting.append(1)
+            start_journal(journal_dir)
+            assert vaccinated_in_database() == {1: False}
+        finally:
+            journal.stop()
+            reporting.stop()
+        assert vaccinated_in_database() == {1: True}
+
+
+class TestLocks():
+    def test_a_lock_file_recovered_meanwhile_is_not_kept(self, test_db, journal_dir):
+        name = write_orphan(journal_dir, "serving")
+        started = threading.Event()
+        worker = journal.WriteBehind(
+            journal_dir, reservation_repository.report_taken_many, TestingSessionLocal,
+            interval=60, worker="serving",
+        )
+        # another worker recovers the file "serving" finds at its name
+        with open(name + ".lock") as recovering:
+            fcntl.flock(recovering, fcntl.LOCK_EX)
+            thread = threading.Thread(target=lambda: (worker.start(), started.set()))
+            thread.start()
+            assert not started.wait(0.1)
+            os.remove(name + ".journal")
+            os.remove(name + ".lock")
+        thread.join(5)
+        try:
+            assert started.is_set()
+            # locked under its name, so nobody else can take it for a dead worker's
+            assert os.path.samestat(os.fstat(worker._lock_file.fileno()), os.stat(worker.lock_path))
+            worker.append(1)
+            start_journal(journal_dir)
+            assert os.path.exists(worker.path)
+            assert journal.is_pending(1)
+        finally:
+            journal.stop()
+            worker.stop()
+
+    def test_lock_of_a_removed_file(self, journal_dir):
+        assert journal.lock(os.path.join(journal_dir, "missing.lock"), create=False) is None
+
+
+class TestRecovery():
+    def test_replays_a_crashed_workers_journal(self, test_db, journal_dir):
+        for hour in range(9, 13):
+            create_reservation(f"2021-10-22T{hour:02}:00:00")
+        # 4 was being written when the worker died: never acknowledged
+        write_orphan(journal_dir, 999_999, b"2\n3\n2\n4", flushing_lines=b"1\n")
+        start_journal(journal_dir)
+        assert vaccinated_in_database() == {1: True, 2: True, 3: True, 4: False}
+        assert sorted(os.listdir(journal_dir)) == [
+            f"{journal.PREFIX}{os.getpid()}.journal", f"{journal.PREFIX}{os.getpid()}.lock",
+        ]
+
+    def test_replays_its_own_process_id(self, test_db, journal_dir):
+        create_reservation()
+        # a worker that had this process id before
+        write_orphan(journal_dir, os.getpid(), b"1\n")
+        writer = start_journal(journal_dir)
+        assert vaccinated_in_database() == {1: True}
+        assert os.path.getsize(writer.path) == 0
+
+    def test_leaves_a_live_workers_journal_alone(self, test_db, journal_dir):
+        create_reservation()
+        name = write_orphan(journal_dir, 999_999, b"1\n")
+        with open(name + ".lock") as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            start_journal(journal_dir)
+        assert vaccinated_in_database() == {1: False}
+        assert os.path.exists(name + ".journal")
+
+    def test_restart_after_a_crash(self, test_db, journal_dir):
+        create_reservation()
+        writer = start_journal(journal_dir)
+        client.put("/reservation/report-taken/1")
+        # the worker dies: its lock is released and nothing is flushed
+        writer._lock_file.close()
+        journal.write_behind = None
+        assert vaccinated_in_database() == {1: False}
+        start_journal(journal_dir)
+        assert vaccinated_in_database() == {1: True}
+        # end the dead worker's flusher without it touching the files
+        writer._pending.clear()
+        writer._closing = True
+        writer._wake.set()
+        writer._thread.join()
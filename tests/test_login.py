@@ -2,12 +2,15 @@ import pytest
 import os
 
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from jose import jwt
 from dotenv import load_dotenv
 from src.reservation.main import app
 from src.reservation.database import Base, get_db
+from src.reservation import token
+from src.reservation.hashing import hash_executor
+from src.reservation.oauth2 import get_current_user, token_cache
 
 load_dotenv()
 
@@ -32,6 +35,31 @@ def test_db():
     yield
     Base.metadata.drop_all(bind=engine)
 
+@pytest.fixture()
+def real_current_user():
+    # other test modules replace authentication on the shared app
+    override = app.dependency_overrides.pop(get_current_user, None)
+    token_cache.clear()
+    yield
+    if override is not None:
+        app.dependency_overrides[get_current_user] = override
+
+def register():
+    user_data = {
+        "name": "foo",
+        "surname": "rock",
+        "citizen_id": "1152347583215",
+        "birth_date": "2021-10-12",
+        "occupation": "doctor",
+        "address": "1145 bangkok",
+        "password": "strong_password"
+    }
+    client.post("/user/", json=user_data, headers={'Content-Type': 'application/json'})
+
+def login():
+    response = client.post('/login', data={"username": "1152347583215", "password": "strong_password"})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
 app.dependency_overrides[get_db] = override_get_db
 
 client = TestClient(app)
@@ -98,4 +126,81 @@ class TestLogin:
         response = client.post('/login', data=login_data)
         assert response.status_code == 404
         assert response.json()["detail"] == "Cannot found real username citizen id"
-        
\ No newline at end of file
+
+    def test_login_when_password_queue_is_full(self, test_db, monkeypatch):
+        user_data = {
+            "name": "foo",
+            "surname": "rock",
+            "citizen_id": "1152347583215",
+            "birth_date": "2021-10-12",
+            "occupation": "doctor",
+            "address": "1145 bangkok",
+            "password": "strong_password"
+        }
+        client.post("/user/", json=user_data, headers={'Content-Type': 'application/json'})
+        monkeypatch.setattr(hash_executor, "workers", 0)
+        monkeypatch.setattr(hash_executor, "queue_limit", 0)
+        login_data = {
+            "username": "1152347583215",
+            "password": "strong_password"
+        }
+        response = client.post('/login', data=login_data)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+
+class TestPrincipal:
+
+    def test_token_carries_user_id_and_version(self, test_db):
+        register()
+        headers = login()
+        credential = jwt.decode(headers["Authorization"].split()[1], SECRET_KEY, algorithms=[ALGORITHM])
+        assert credential["uid"] == 1
+        assert credential["ver"] == 0
+
+    def test_authenticated_request_does_not_select_user(self, test_db, real_current_user):
+        register()
+        headers = login()
+        client.post("/reservation/", json={"register_timestamp": "2021-10-12T22:02:14.760Z"}, headers=headers)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            response = client.delete("/reservation/1", headers=headers)
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        assert response.status_code == 200
+        assert not any("FROM users" in statement for statement in statements)
+
+    def test_logout_revokes_token(self, test_db, real_current_user):
+        register()
+        headers = login()
+        response = client.post("/logout", headers=headers)
+        assert response.status_code == 204
+        response = client.post("/reservation/", json={"register_timestamp": "2021-10-12T22:02:14.760Z"}, headers=headers)
+        assert response.status_code == 401
+        assert response.json()["detail"] == "Could not validate credentials"
+
+    def test_login_again_after_logout(self, test_db, real_current_user):
+        register()
+        client.post("/logout", headers=login())
+        headers = login()
+        response = client.post("/reservation/", json={"register_timestamp": "2021-10-12T22:02:14.760Z"}, headers=headers)
+        assert response.status_code == 201
+
+    def test_logout_revokes_tokens_issued_before_versions(self, test_db, real_current_user):
+        register()
+        legacy = [
+            {"Authorization": f"Bearer {token.create_access_token(claims)}"}
+            for claims in ({"sub": "1152347583215"}, {"sub": "1152347583215", "uid": 1})
+        ]
+        for headers in legacy:
+            response = client.post("/reservation/", json={"register_timestamp": "2021-10-12T22:02:14.760Z"}, headers=headers)
+            assert response.status_code == 201
+        client.post("/logout", headers=login())
+        for headers in legacy:
+            response = client.post("/reservation/", json={"register_timestamp": "2021-10-12T22:02:14.760Z"}, headers=headers)
+            assert response.status_code == 401
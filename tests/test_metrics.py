@@ -0,0 +1,93 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from src.reservation import metrics
+from src.reservation.database import Base, get_db
+from src.reservation.main import app
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+
+@pytest.fixture(autouse=True)
+def test_db():
+    Base.metadata.create_all(bind=engine)
+    previous = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_get_db
+    yield
+    if previous is not None:
+        app.dependency_overrides[get_db] = previous
+    Base.metadata.drop_all(bind=engine)
+
+client = TestClient(app)
+
+
+def request_count(method, route, status):
+    value = REGISTRY.get_sample_value(
+        "http_request_duration_seconds_count",
+        {"method": method, "route": route, "status": str(status)},
+    )
+    return value or 0
+
+
+class TestMetrics:
+    def test_requests_are_labelled_by_route_template(self):
+        before = request_count("GET", "/user/{citizen_id}", 404)
+        response = client.get("/user/0000000000000")
+        assert response.status_code == 404
+        assert request_count("GET", "/user/{citizen_id}", 404) == before + 1
+
+    def test_unmatched_paths_share_one_label(self):
+        before = request_count("GET", "<unmatched>", 404)
+        client.get("/no/such/path")
+        client.get("/no/other/path")
+        assert request_count("GET", "<unmatched>", 404) == before + 2
+
+    def test_db_time_is_recorded(self):
+        labels = {"method": "GET", "route": "/user/{citizen_id}"}
+        before = REGISTRY.get_sample_value("http_request_db_seconds_sum", labels) or 0
+        client.get("/user/0000000000000")
+        assert REGISTRY.get_sample_value("http_request_db_seconds_sum", labels) > before
+
+    def test_db_time_outside_requests_is_ignored(self):
+        assert metrics._request_db_seconds.get() is None
+
+    def test_failed_statements_are_timed_without_leaking(self):
+        total = [0.0]
+        token = metrics._request_db_seconds.set(total)
+        try:
+            with engine.connect() as connection:
+                for _ in range(3):
+                    with pytest.raises(OperationalError):
+                        connection.execute(text("SELECT * FROM no_such_table"))
+                assert "statement_started" not in connection.info
+                failed = total[0]
+                assert failed > 0
+                connection.execute(text("SELECT 1"))
+                assert total[0] > failed
+        finally:
+            metrics._request_db_seconds.reset(token)
+
+    def test_get_metrics(self):
+        client.get("/user/0000000000000")
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert 'http_request_duration_seconds_bucket{le="0.005",method="GET",route="/user/{citizen_id}",status="404"}' in response.text
+        assert "password_hash_seconds" in response.text
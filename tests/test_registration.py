@@ -5,6 +5,7 @@ from sqlalchemy import create_engine, exc
 from sqlalchemy.orm import sessionmaker
 from src.reservation.main import app
 from src.reservation.database import Base, get_db
+from src.reservation.hashing import hash_executor
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
 
@@ -106,6 +107,23 @@ class TestRegistration:
         assert response.status_code == 422
         assert response.json()["detail"][0]["msg"] == "citizen id must be a digit"
 
+    def test_registration_when_password_queue_is_full(self, test_db, monkeypatch):
+        monkeypatch.setattr(hash_executor, "workers", 0)
+        monkeypatch.setattr(hash_executor, "queue_limit", 0)
+        user_data = {
+            "name": "foo",
+            "surname": "rock",
+            "citizen_id": "1152347583215",
+            "birth_date": "2021-10-12",
+            "occupation": "doctor",
+            "address": "1145 bangkok",
+            "password": "strong_password"
+        }
+        response = client.post("/user/", json=user_data, headers={'Content-Type': 'application/json'})
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        assert client.get("/user/1152347583215").status_code == 404
+
 class TestGetUser:
     def test_get_user_and_user_is_exist_in_db(self, test_db):
         user_data = {
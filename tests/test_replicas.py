@@ -0,0 +1,115 @@
+import pytest
+from datetime import datetime
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from src.reservation import database
+from src.reservation.database import Base, ReplicaSet, get_db
+from src.reservation.main import app
+from src.reservation.models import Reservation, User
+
+PRIMARY_URL = "sqlite:///./test.db"
+REPLICA_URLS = ["sqlite:///./test_replica_1.db", "sqlite:///./test_replica_2.db"]
+# the directory does not exist, so connecting fails
+UNREACHABLE_URL = "sqlite:///./no/such/dir/replica.db"
+
+engine = create_engine(PRIMARY_URL, connect_args={"check_same_thread": False})
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+
+def store_reservation(bind, user_id, timestamp=datetime(2021, 10, 12, 22, 2, 14)):
+    db = sessionmaker(bind=bind)()
+    db.add(User(
+        user_id=user_id,
+        name="foo",
+        surname="rock",
+        citizen_id=str(1152347583215 + user_id),
+        birth_date=datetime(2021, 10, 12).date(),
+        occupation="doctor",
+        address="1145 bangkok",
+        password="strong_password",
+    ))
+    db.add(Reservation(register_timestamp=timestamp, user_id=user_id))
+    db.commit()
+    db.close()
+
+
+@pytest.fixture()
+def replicas(monkeypatch):
+    """Two replicas whose only reservation belongs to user 11 and user 12 respectively."""
+    replica_set = ReplicaSet(REPLICA_URLS, retry_after=30)
+    for user_id, replica in enumerate(replica_set.replicas, start=11):
+        Base.metadata.create_all(bind=replica.engine)
+        store_reservation(replica.engine, user_id)
+    Base.metadata.create_all(bind=engine)
+    previous = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_get_db
+    monkeypatch.setattr(database, "replicas", replica_set)
+    client.cookies.clear()
+    replicas = list(replica_set.replicas)
+    yield replica_set
+    if previous is not None:
+        app.dependency_overrides[get_db] = previous
+    Base.metadata.drop_all(bind=engine)
+    for replica in replicas:
+        Base.metadata.drop_all(bind=replica.engine)
+        replica.engine.dispose()
+
+
+client = TestClient(app)
+
+
+def owner_id(reservation):
+    return int(reservation["owner"]["citizen_id"]) - 1152347583215
+
+
+def served_by():
+    return [owner_id(r) for r in client.get("/reservation/").json()]
+
+
+class TestReadReplicas:
+    def test_reads_rotate_over_replicas(self, replicas):
+        assert sorted([served_by(), served_by()]) == [[11], [12]]
+
+    def test_unreachable_replica_is_skipped(self, replicas):
+        replicas.replicas.append(database.Replica(UNREACHABLE_URL))
+        assert all(served_by() in ([11], [12]) for _ in range(3))
+        assert replicas.replicas[-1].down_until > 0
+        status = client.get("/monitoring/pool").json()["replicas"]
+        assert [replica["healthy"] for replica in status] == [True, True, False]
+
+    def test_falls_back_to_primary_without_healthy_replica(self, replicas):
+        for replica in replicas.replicas:
+            replica.down_until = float("inf")
+        store_reservation(engine, 1)
+        assert served_by() == [1]
+
+    def test_client_reads_its_own_write_from_primary(self, replicas):
+        store_reservation(engine, 1)
+        response = client.post("/reservation/", json={"register_timestamp": "2021-10-12T22:02:14.760Z"})
+        assert response.status_code == 201
+        assert database.READ_PRIMARY_COOKIE in response.cookies
+        reservation_id = response.json()["reservation_id"]
+        assert client.get(f"/reservation/{reservation_id}").status_code == 200
+        assert len(client.get("/reservation/2021/10/12").json()) == 2
+
+    def test_other_clients_keep_reading_replicas(self, replicas):
+        store_reservation(engine, 1)
+        client.post("/reservation/", json={"register_timestamp": "2021-10-12T22:02:14.760Z"})
+        other_client = TestClient(app)
+        assert owner_id(other_client.get("/reservation/").json()[0]) in (11, 12)
+
+    def test_pin_expires(self, replicas, monkeypatch):
+        monkeypatch.setattr(database.settings, "read_your_writes_seconds", -1)
+        store_reservation(engine, 1)
+        client.post("/reservation/", json={"register_timestamp": "2021-10-12T22:02:14.760Z"})
+        assert served_by() in ([11], [12])
@@ -0,0 +1,176 @@
+import pytest
+from datetime import date, datetime
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from src.reservation.main import app
+from src.reservation.database import Base, get_db
+from src.reservation.oauth2 import get_current_user
+from src.reservation.models import DailyReport, Reservation, User
+from src.reservation.schemas import Principal
+from src.reservation.repository import report as report_repository
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30}
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+
+def override_get_current_user():
+    return Principal(user_id=1, citizen_id="1152347583215")
+
+
+@pytest.fixture()
+def test_db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    db.add(User(
+        user_id=1,
+        name="foo",
+        surname="rock",
+        citizen_id="1152347583215",
+        birth_date=date(2021, 10, 12),
+        occupation="doctor",
+        address="1145 bangkok",
+        password="strong_password",
+    ))
+    db.commit()
+    db.close()
+    overridden = {
+        dependency: app.dependency_overrides.get(dependency)
+        for dependency in (get_db, get_current_user)
+    }
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_current_user] = override_get_current_user
+    yield
+    for dependency, previous in overridden.items():
+        if previous is None:
+            app.dependency_overrides.pop(dependency, None)
+        else:
+            app.dependency_overrides[dependency] = previous
+    Base.metadata.drop_all(bind=engine)
+
+
+client = TestClient(app)
+
+
+def create_reservation(timestamp="2021-10-22T09:00:00"):
+    return client.post("/reservation/", json={"register_timestamp": timestamp})
+
+
+def daily(day="2021-10-22", **params):
+    response = client.get("/report/daily", params={"day": day, **params})
+    assert response.status_code == 200
+    return response.json()
+
+
+def counts(day="2021-10-22", site=None):
+    return {
+        (row["site"], row["booked"], row["vaccinated"], row["cancelled"])
+        for row in daily(day)
+        if row["site"] == site
+    }
+
+
+class TestDailyReport:
+    def test_empty_day(self, test_db):
+        assert daily() == []
+
+    def test_created_reservations_are_booked(self, test_db):
+        create_reservation()
+        create_reservation("2021-10-22T15:00:00")
+        create_reservation("2021-10-23T09:00:00")
+        assert daily() == [
+            {"day": "2021-10-22", "site": None, "booked": 2, "vaccinated": 0, "cancelled": 0}
+        ]
+        assert counts("2021-10-23") == {(None, 1, 0, 0)}
+
+    def test_day_is_the_utc_day(self, test_db):
+        create_reservation("2021-10-23T02:00:00+07:00")
+        assert counts("2021-10-22") == {(None, 1, 0, 0)}
+
+    def test_report_taken_counts_once(self, test_db):
+        create_reservation()
+        client.put("/reservation/report-taken/1")
+        client.put("/reservation/report-taken/1")
+        assert counts() == {(None, 1, 1, 0)}
+
+    def test_report_taken_many_counts_only_new_vaccinations(self, test_db):
+        for _ in range(3):
+            create_reservation()
+        client.put("/reservation/report-taken/1")
+        response = client.put("/reservation/report-taken", json={"reservation_ids": [1, 2, 3, 4]})
+        assert response.json()["updated"] == [1, 2, 3]
+        assert counts() == {(None, 3, 3, 0)}
+
+    def test_delete_moves_booked_to_cancelled(self, test_db):
+        create_reservation()
+        create_reservation()
+        client.put("/reservation/report-taken/1")
+        client.delete("/reservation/1")
+        assert counts() == {(None, 1, 0, 1)}
+
+    def test_new_timestamp_moves_the_reservation_to_its_day(self, test_db):
+        create_reservation()
+        client.put("/reservation/report-taken/1")
+        client.put("/reservation/1", json={"register_timestamp": "2021-10-24T09:00:00"})
+        assert counts() == {(None, 0, 0, 0)}
+        assert counts("2021-10-24") == {(None, 1, 1, 0)}
+
+    def test_bulk_created_reservations_are_booked(self, test_db):
+        client.post("/reservation/bulk", json=[
+            {"citizen_id": "1152347583215", "register_timestamp": "2021-10-22T09:00:00"},
+            {"citizen_id": "1152347583215", "register_timestamp": "2021-10-22T10:00:00"},
+            {"citizen_id": "0000000000000", "register_timestamp": "2021-10-22T10:00:00"},
+        ])
+        assert counts() == {(None, 2, 0, 0)}
+
+    def test_slot_bookings_are_counted_per_site(self, test_db):
+        for site in ("Bang Sue", "Central Ladprao"):
+            client.post("/slot/", json={"site": site, "start": "2021-10-22T09:00:00", "capacity": 5})
+        client.post("/slot/1/book")
+        client.post("/slot/1/book")
+        client.post("/slot/2/book")
+        create_reservation()
+        assert [(row["site"], row["booked"]) for row in daily()] == [
+            (None, 1), ("Bang Sue", 2), ("Central Ladprao", 1)
+        ]
+        assert [row["site"] for row in daily(site="Bang Sue")] == ["Bang Sue"]
+
+
+class TestReconcile:
+    def test_rebuilds_the_counts_from_the_reservations(self, test_db):
+        create_reservation()
+        create_reservation()
+        client.delete("/reservation/2")
+        db = TestingSessionLocal()
+        # a reservation written behind the app's back and a drifted count
+        db.add(Reservation(register_timestamp=datetime(2021, 10, 22, 11), user_id=1, vaccinated=True))
+        db.query(DailyReport).update({"booked": 7})
+        db.commit()
+        report_repository.reconcile(db)
+        db.close()
+        # deleted reservations are gone from the source, so cancelled is kept
+        assert counts() == {(None, 2, 1, 1)}
+
+    def test_one_day_leaves_the_others_alone(self, test_db):
+        create_reservation()
+        create_reservation("2021-10-23T09:00:00")
+        db = TestingSessionLocal()
+        db.query(DailyReport).update({"booked": 7})
+        db.commit()
+        report_repository.reconcile(db, date(2021, 10, 22))
+        db.close()
+        assert counts() == {(None, 1, 0, 0)}
+        assert counts("2021-10-23") == {(None, 7, 0, 0)}
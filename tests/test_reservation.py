@@ -1,14 +1,24 @@
+import csv
+import io
+import json
+import os
 import pytest
-from datetime import datetime
+from datetime import date, datetime
 
+from fastapi.encoders import jsonable_encoder
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine, exc
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.orm import sessionmaker
 from starlette.routing import request_response
 from src.reservation.main import app
+from src.reservation.cache import response_cache
 from src.reservation.database import Base, get_db
+from src.reservation.config import settings
 from src.reservation.oauth2 import get_current_user
-from src.reservation.models import User
+from src.reservation.models import User, Reservation
+from src.reservation.schemas import ShowReservation
+from src.reservation.repository import reservation as reservation_repository
+from src.reservation.repository import queue as queue_repository
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
 
@@ -104,6 +114,107 @@ class TestGetAllReservation:
         assert len(response.json()) == 3
 
 
+class TestReservationPagination:
+    def test_get_all_reservation_first_page_has_next_cursor(
+        self, test_db, store_user_in_db
+    ):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        create_reservation("2021-10-12T22:03:14.760Z")
+        create_reservation("2021-10-12T22:04:14.760Z")
+        response = client.get("/reservation/?limit=2")
+        assert response.status_code == 200
+        assert [r["reservation_id"] for r in response.json()] == [1, 2]
+        assert "X-Next-Cursor" in response.headers
+
+    def test_get_all_reservation_follow_next_cursor_to_last_page(
+        self, test_db, store_user_in_db
+    ):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        create_reservation("2021-10-12T22:03:14.760Z")
+        create_reservation("2021-10-12T22:04:14.760Z")
+        first_page = client.get("/reservation/?limit=2")
+        cursor = first_page.headers["X-Next-Cursor"]
+        response = client.get(f"/reservation/?limit=2&after={cursor}")
+        assert response.status_code == 200
+        assert [r["reservation_id"] for r in response.json()] == [3]
+        assert "X-Next-Cursor" not in response.headers
+
+    def test_get_all_reservation_limit_is_capped_by_max_page_size(
+        self, test_db, store_user_in_db, monkeypatch
+    ):
+        monkeypatch.setattr(settings, "max_page_size", 2)
+        create_reservation("2021-10-12T22:02:14.760Z")
+        create_reservation("2021-10-12T22:03:14.760Z")
+        create_reservation("2021-10-12T22:04:14.760Z")
+        response = client.get("/reservation/?limit=1000")
+        assert response.status_code == 200
+        assert len(response.json()) == 2
+
+    def test_get_all_reservation_with_invalid_cursor(self, test_db, store_user_in_db):
+        response = client.get("/reservation/?after=not-a-cursor")
+        assert response.status_code == 422
+        assert response.json()["detail"] == "Invalid cursor"
+
+    def test_get_reservation_on_specific_date_follow_next_cursor(
+        self, test_db, store_user_in_db
+    ):
+        create_reservation("2021-10-12T22:04:14.760Z")
+        create_reservation("2021-10-12T22:02:14.760Z")
+        create_reservation("2021-10-12T22:03:14.760Z")
+        first_page = client.get("/reservation/2021/10/12?limit=2")
+        assert [r["reservation_id"] for r in first_page.json()] == [2, 3]
+        cursor = first_page.headers["X-Next-Cursor"]
+        response = client.get(f"/reservation/2021/10/12?limit=2&after={cursor}")
+        assert [r["reservation_id"] for r in response.json()] == [1]
+        assert "X-Next-Cursor" not in response.headers
+
+
+class TestBulkCreateReservation:
+    def test_bulk_create_reservation(self, test_db, store_user_in_db):
+        store_reservations_with_owners(1, datetime(2021, 10, 12, 22, 2, 14))
+        create_reservation("2021-10-12T22:02:14.760Z")
+        request_body = [
+            {"citizen_id": "1152347583215", "register_timestamp": "2021-10-12T22:02:14.760Z"},
+            {"citizen_id": "1152347583216", "register_timestamp": "2021-10-13T22:02:14.760Z"},
+            {"citizen_id": "1152347583215", "register_timestamp": "2021-10-14T22:02:14.760Z"},
+        ]
+        response = client.post("/reservation/bulk", json=request_body)
+        assert response.status_code == 200
+        assert [r["reservation_id"] for r in response.json()] == [3, 4, 5]
+        owner = client.get("/reservation/4").json()["owner"]
+        assert owner["citizen_id"] == "1152347583216"
+        assert client.get("/reservation/5").json()["register_timestamp"] == "2021-10-14T22:02:14.760000"
+
+    def test_bulk_create_reservation_reports_unknown_citizen(self, test_db, store_user_in_db):
+        request_body = [
+            {"citizen_id": "9999999999999", "register_timestamp": "2021-10-12T22:02:14.760Z"},
+            {"citizen_id": "1152347583215", "register_timestamp": "2021-10-13T22:02:14.760Z"},
+        ]
+        response = client.post("/reservation/bulk", json=request_body)
+        assert response.status_code == 200
+        assert response.json() == [
+            {
+                "index": 0,
+                "citizen_id": "9999999999999",
+                "reservation_id": None,
+                "detail": "No user with this citizen id",
+            },
+            {"index": 1, "citizen_id": "1152347583215", "reservation_id": 1, "detail": None},
+        ]
+
+    def test_bulk_create_reservation_with_too_many_items(
+        self, test_db, store_user_in_db, monkeypatch
+    ):
+        monkeypatch.setattr(settings, "max_bulk_size", 1)
+        request_body = [
+            {"citizen_id": "1152347583215", "register_timestamp": "2021-10-12T22:02:14.760Z"},
+            {"citizen_id": "1152347583215", "register_timestamp": "2021-10-13T22:02:14.760Z"},
+        ]
+        response = client.post("/reservation/bulk", json=request_body)
+        assert response.status_code == 422
+        assert client.get("/reservation/").json() == []
+
+
 class TestCreateReservation:
     def test_create_reservation_with_valid_request_body(
         self, test_db, store_user_in_db
@@ -121,6 +232,7 @@ class TestCreateReservation:
                 "address": "1145 bangkok",
             },
             "vaccinated": False,
+            "priority": 0,
         }
         response = client.post(
             "/reservation/",
@@ -160,6 +272,7 @@ class TestGetReservationInSpecificId:
                 "address": "1145 bangkok",
             },
             "vaccinated": False,
+            "priority": 0,
         }
         response = client.get("/reservation/1")
         assert response.status_code == 200
@@ -303,6 +416,7 @@ class TestGetReservationOnSpecificDate:
                     "address": "1145 bangkok",
                 },
                 "vaccinated": False,
+                "priority": 0,
             },
             {
                 "reservation_id": 2,
@@ -316,6 +430,7 @@ class TestGetReservationOnSpecificDate:
                     "address": "1145 bangkok",
                 },
                 "vaccinated": False,
+                "priority": 0,
             },
         ]
         # create reservation 2
@@ -400,6 +515,7 @@ class TestReportTaken:
                 "address": "1145 bangkok",
             },
             "vaccinated": True,
+            "priority": 0,
         }
         # store user info in database
         client.post("/user/", json=user_data,
@@ -425,3 +541,489 @@ class TestReportTaken:
         assert response.status_code == 422
         assert response.json()[
             "detail"][0]["msg"] == "value is not a valid integer"
+
+
+class TestReportTakenInBulk:
+    def test_update_many_reservations_report_taken(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:01:14.760Z")
+        create_reservation("2021-10-12T22:02:14.760Z")
+        create_reservation("2021-10-12T22:03:14.760Z")
+        response = client.put("/reservation/report-taken", json={"reservation_ids": [3, 1, 7, 1]})
+        assert response.status_code == 200
+        assert response.json() == {"updated": [1, 3], "missing": [7]}
+        vaccinated = [r["vaccinated"] for r in client.get("/reservation/").json()]
+        assert vaccinated == [True, False, True]
+
+    def test_update_many_reservations_report_taken_with_no_reservation(self, test_db):
+        response = client.put("/reservation/report-taken", json={"reservation_ids": [1, 2]})
+        assert response.status_code == 200
+        assert response.json() == {"updated": [], "missing": [1, 2]}
+
+    def test_update_many_reservations_report_taken_with_string_id(self, test_db):
+        response = client.put("/reservation/report-taken", json={"reservation_ids": ["one"]})
+        assert response.status_code == 422
+
+
+class TestExportReservation:
+    def test_export_reservation_as_ndjson(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        create_reservation("2021-10-13T22:02:14.760Z")
+        response = client.get("/reservation/export")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [row["reservation_id"] for row in rows] == [1, 2]
+        assert rows[0] == {
+            "reservation_id": 1,
+            "register_timestamp": "2021-10-12T22:02:14.760000",
+            "vaccinated": False,
+            "citizen_id": "1152347583215",
+            "name": "foo",
+            "surname": "rock",
+            "birth_date": "2021-10-12",
+            "occupation": "doctor",
+            "address": "1145 bangkok",
+        }
+
+    def test_export_reservation_as_csv(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        response = client.get("/reservation/export?format=csv")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        rows = list(csv.reader(io.StringIO(response.text)))
+        assert rows[0][:3] == ["reservation_id", "register_timestamp", "vaccinated"]
+        assert rows[1][:4] == ["1", "2021-10-12T22:02:14.760000", "False", "1152347583215"]
+
+    def test_export_reservation_with_gzip(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        response = client.get("/reservation/export?compress=true")
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert json.loads(response.text)["reservation_id"] == 1
+
+    def test_export_reservation_when_no_reservation_in_db(self, test_db):
+        response = client.get("/reservation/export")
+        assert response.status_code == 200
+        assert response.text == ""
+
+
+class TestGetReservationInRange:
+    def test_get_reservation_in_range_is_half_open(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T00:00:00")
+        create_reservation("2021-10-12T23:59:59.999999")
+        create_reservation("2021-10-13T00:00:00")
+        response = client.get(
+            "/reservation/range?from=2021-10-12T00:00:00&to=2021-10-13T00:00:00"
+        )
+        assert response.status_code == 200
+        assert [r["reservation_id"] for r in response.json()] == [1, 2]
+
+    def test_get_reservation_in_range_follow_next_cursor(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T10:00:00")
+        create_reservation("2021-10-12T11:00:00")
+        create_reservation("2021-10-12T12:00:00")
+        url = "/reservation/range?from=2021-10-12T00:00:00&to=2021-10-13T00:00:00&limit=2"
+        first_page = client.get(url)
+        cursor = first_page.headers["X-Next-Cursor"]
+        response = client.get(f"{url}&after={cursor}")
+        assert [r["reservation_id"] for r in response.json()] == [3]
+
+    def test_get_reservation_in_range_with_empty_range(self, test_db, store_user_in_db):
+        response = client.get(
+            "/reservation/range?from=2021-10-13T00:00:00&to=2021-10-12T00:00:00"
+        )
+        assert response.status_code == 422
+        assert response.json()["detail"] == "Invalid date range"
+
+    def test_get_reservation_in_range_without_from(self, test_db, store_user_in_db):
+        response = client.get("/reservation/range?to=2021-10-12T00:00:00")
+        assert response.status_code == 422
+
+
+def explain_range_query(bind, explain):
+    statement = reservation_repository.range_query(
+        datetime(2021, 10, 12), datetime(2021, 10, 13)
+    ).order_by(Reservation.register_timestamp, Reservation.reservation_id)
+    return explain_statement(bind, statement, explain)
+
+
+def explain_statement(bind, statement, explain):
+    db = sessionmaker(bind=bind)()
+    try:
+        compiled = statement.compile(dialect=bind.dialect)
+        params = compiled.construct_params()
+        if compiled.positiontup is not None:
+            params = tuple(params[name] for name in compiled.positiontup)
+        with bind.connect() as connection:
+            if bind.dialect.name == "postgresql":
+                # the planner prefers a scan on a tiny table; ask whether the index can serve it
+                connection.exec_driver_sql("SET enable_seqscan = off")
+            rows = connection.exec_driver_sql(f"{explain} {compiled}", params).fetchall()
+        return " ".join(str(column) for row in rows for column in row)
+    finally:
+        db.close()
+
+
+class TestRangeQueryPlan:
+    def test_range_query_uses_index_on_sqlite(self, test_db):
+        plan = explain_range_query(engine, "EXPLAIN QUERY PLAN")
+        assert "USING INDEX ix_reservations_register_timestamp" in plan
+
+    @pytest.mark.skipif(
+        not os.environ.get("TEST_POSTGRES_URL"), reason="TEST_POSTGRES_URL is not set"
+    )
+    def test_range_query_uses_index_on_postgres(self, postgres_url):
+        postgres_engine = create_engine(postgres_url)
+        try:
+            Base.metadata.create_all(bind=postgres_engine)
+            plan = explain_range_query(postgres_engine, "EXPLAIN")
+            assert "ix_reservations_register_timestamp" in plan
+        finally:
+            postgres_engine.dispose()
+
+
+def store_queued_reservation(timestamp, birth_date=date(1990, 1, 1), occupation="doctor", site=None):
+    db = TestingSessionLocal()
+    owner = User(
+        name="foo",
+        surname="rock",
+        citizen_id=str(1152347583215 + db.query(User).count()),
+        birth_date=birth_date,
+        occupation=occupation,
+        address="1145 bangkok",
+        password="strong_password",
+    )
+    db.add(owner)
+    db.flush()
+    reservation = Reservation(register_timestamp=timestamp, user_id=owner.user_id, site=site)
+    db.add(reservation)
+    db.commit()
+    reservation_id = reservation.reservation_id
+    db.close()
+    return reservation_id
+
+
+def queue_ids(url="/reservation/queue/2021/10/12", **params):
+    response = client.get(url, params=params)
+    assert response.status_code == 200
+    return [item["reservation_id"] for item in response.json()]
+
+
+class TestPriorityQueue:
+    def test_queue_serves_higher_priority_first_then_first_registered(self, test_db):
+        first = store_queued_reservation(datetime(2021, 10, 12, 9))
+        second = store_queued_reservation(datetime(2021, 10, 12, 10))
+        third = store_queued_reservation(datetime(2021, 10, 12, 11))
+        store_queued_reservation(datetime(2021, 10, 13, 9))
+        response = client.put(f"/reservation/{third}/priority", json={"priority": 5})
+        assert response.status_code == 200
+        assert response.json()["priority"] == 5
+        assert queue_ids() == [third, first, second]
+        assert queue_ids(limit=2) == [third, first]
+
+    def test_vaccinated_reservations_leave_the_queue(self, test_db):
+        first = store_queued_reservation(datetime(2021, 10, 12, 9))
+        second = store_queued_reservation(datetime(2021, 10, 12, 10))
+        client.put(f"/reservation/report-taken/{first}")
+        assert queue_ids() == [second]
+
+    def test_queue_of_a_site(self, test_db):
+        store_queued_reservation(datetime(2021, 10, 12, 9), site="Bang Sue")
+        central = store_queued_reservation(datetime(2021, 10, 12, 10), site="Central")
+        assert queue_ids(site="Central") == [central]
+
+    def test_moving_a_reservation_moves_it_to_the_new_day(self, test_db, store_user_in_db):
+        reservation_id = create_reservation("2021-10-12T22:02:14.760Z").json()["reservation_id"]
+        assert queue_ids() == [reservation_id]
+        client.put(f"/reservation/{reservation_id}", json={"register_timestamp": "2021-11-12T08:00:00Z"})
+        assert queue_ids() == []
+        assert queue_ids("/reservation/queue/2021/11/12") == [reservation_id]
+
+    def test_reprioritize_unknown_reservation(self, test_db):
+        assert client.put("/reservation/99/priority", json={"priority": 1}).status_code == 404
+
+    def test_bump_by_age_or_occupation(self, test_db):
+        elderly = store_queued_reservation(datetime(2021, 10, 12, 9), birth_date=date(1940, 1, 1), occupation="farmer")
+        nurse = store_queued_reservation(datetime(2021, 10, 12, 10), occupation="Nurse")
+        other = store_queued_reservation(datetime(2021, 10, 12, 8), occupation="farmer")
+        request = {"priority": 10, "min_age": 60, "occupations": ["doctor", "nurse"]}
+        response = client.put("/reservation/priority", json=request)
+        assert response.json() == {"updated": 2}
+        assert queue_ids() == [elderly, nurse, other]
+        # already at that priority, so nothing is written again
+        assert client.put("/reservation/priority", json=request).json() == {"updated": 0}
+
+    def test_bump_drops_only_the_cached_listings_it_changes(self, test_db):
+        nurse = store_queued_reservation(datetime(2021, 10, 12, 9), occupation="nurse")
+        store_queued_reservation(datetime(2021, 10, 13, 9), occupation="farmer")
+        response_cache.clear()
+        for day in (12, 13):
+            client.get(f"/reservation/2021/10/{day}")
+        assert len(response_cache) == 2
+        client.put("/reservation/priority", json={"priority": 5, "occupations": ["nurse"]})
+        assert len(response_cache) == 1
+        assert client.get("/reservation/2021/10/12").json()[0]["priority"] == 5
+        assert client.get(f"/reservation/{nurse}").json()["priority"] == 5
+
+    def test_changing_priority_needs_authentication(self, test_db):
+        reservation_id = store_queued_reservation(datetime(2021, 10, 12, 9))
+        override = app.dependency_overrides.pop(get_current_user)
+        try:
+            single = client.put(f"/reservation/{reservation_id}/priority", json={"priority": 5})
+            bulk = client.put("/reservation/priority", json={"priority": 5, "occupations": ["doctor"]})
+        finally:
+            app.dependency_overrides[get_current_user] = override
+        assert single.status_code == bulk.status_code == 401
+        assert queue_ids() == [reservation_id]
+        assert client.get(f"/reservation/{reservation_id}").json()["priority"] == 0
+
+    def test_bump_needs_a_criterion(self, test_db):
+        assert client.put("/reservation/priority", json={"priority": 10}).status_code == 422
+
+    def test_next_batch_is_read_from_the_queue_index(self, test_db):
+        statement = (
+            reservation_repository.listing()
+            .where(Reservation.reservation_date == date(2021, 10, 12), queue_repository.pending())
+            .order_by(*queue_repository.queue_order())
+            .limit(100)
+        )
+        plan = explain_statement(engine, statement, "EXPLAIN QUERY PLAN")
+        assert "USING INDEX ix_reservations_queue" in plan
+        assert "TEMP B-TREE" not in plan
+        plan = explain_statement(engine, statement.where(Reservation.site == "Bang Sue"), "EXPLAIN QUERY PLAN")
+        assert "USING INDEX ix_reservations_site_queue" in plan
+        assert "TEMP B-TREE" not in plan
+
+
+def store_reservations_with_owners(count, timestamp):
+    db = TestingSessionLocal()
+    first_citizen_id = 1152347583215 + db.query(User).count()
+    for index in range(count):
+        owner = User(
+            name="foo",
+            surname="rock",
+            citizen_id=str(first_citizen_id + index),
+            birth_date=datetime(2021, 10, 12).date(),
+            occupation="doctor",
+            address="1145 bangkok",
+            password="strong_password",
+        )
+        db.add(owner)
+        db.flush()
+        db.add(Reservation(register_timestamp=timestamp, user_id=owner.user_id))
+    db.commit()
+    db.close()
+
+
+def count_queries(url, method="get", status_code=200):
+    return len(captured_statements(url, method, status_code))
+
+
+def captured_statements(url, method="get", status_code=200):
+    # the statements of a cache miss
+    response_cache.clear()
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        if method == "put":
+            response = client.put(url, json={"register_timestamp": "2021-11-12T22:01:14.760Z"})
+        else:
+            response = getattr(client, method)(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    assert response.status_code == status_code
+    return statements
+
+
+class TestQueryCount:
+    @pytest.mark.parametrize(
+        "url", ["/reservation/", "/reservation/2021/10/12", "/reservation/new/"]
+    )
+    def test_list_reservation_query_count_does_not_grow_with_rows(self, test_db, url):
+        timestamp = datetime(2021, 10, 12, 22, 2, 14)
+        if url == "/reservation/new/":
+            timestamp = datetime.now()
+        store_reservations_with_owners(1, timestamp)
+        one_row = count_queries(url)
+        store_reservations_with_owners(5, timestamp)
+        assert count_queries(url) == one_row == 1
+
+    def test_get_user_query_count_does_not_grow_with_reservations(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        one_row = count_queries("/user/1152347583215")
+        for _ in range(5):
+            create_reservation("2021-10-12T22:02:14.760Z")
+        assert count_queries("/user/1152347583215") == one_row == 2
+
+    @pytest.mark.parametrize(
+        "method, url, queries",
+        [
+            ("get", "/reservation/1", 1),
+            # the DELETE, then the daily report's counts and the change feed's
+            # tombstone (and the slot's seat, if any); one statement on PostgreSQL
+            ("delete", "/reservation/1", 3),
+            # UPDATE then the joined SELECT, around which the daily report's
+            # counts move from the old day to the new
+            ("put", "/reservation/1", 4),
+            # the daily report's count, then the UPDATE and the joined SELECT
+            ("put", "/reservation/report-taken/1", 3),
+        ],
+    )
+    def test_single_reservation_query_count(
+        self, test_db, store_user_in_db, method, url, queries
+    ):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        assert count_queries(url, method) == queries
+
+    def test_deleting_a_missing_reservation_is_one_statement(self, test_db):
+        assert count_queries("/reservation/99", "delete", status_code=404) == 1
+
+    @pytest.mark.skipif(
+        not os.environ.get("TEST_POSTGRES_URL"), reason="TEST_POSTGRES_URL is not set"
+    )
+    def test_single_reservation_writes_are_one_statement_on_postgres(self, postgres_url):
+        from benchmarks import round_trips
+
+        overridden = dict(app.dependency_overrides)
+        try:
+            results = round_trips.measure(postgres_url)
+        finally:
+            app.dependency_overrides.update(overridden)
+        counts = {name: (status_code, statements, commits) for name, status_code, statements, commits in results}
+        # the report's counts, the slot's seat and the tombstone ride in the same statement
+        assert counts["PUT /reservation/{id}"] == (200, 1, 1)
+        assert counts["PUT /reservation/report-taken/{id}"] == (200, 1, 1)
+        assert counts["DELETE /reservation/{id}"] == (200, 1, 1)
+
+
+class TestListingProjection:
+    @pytest.mark.parametrize(
+        "url",
+        [
+            "/reservation/",
+            "/reservation/2021/10/12",
+            "/reservation/new/",
+            "/reservation/range?from=2021-10-12T00:00:00&to=2021-10-13T00:00:00",
+        ],
+    )
+    def test_list_endpoints_never_load_the_password_hash(self, test_db, url):
+        store_reservations_with_owners(2, datetime(2021, 10, 12, 22, 2, 14))
+        statements = captured_statements(url)
+        assert statements
+        assert not any("password" in statement for statement in statements)
+
+    def test_listing_matches_show_reservation(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        create_reservation("2021-10-12T23:00:00Z")
+        client.put("/reservation/report-taken/2")
+        db = TestingSessionLocal()
+        expected = jsonable_encoder([
+            ShowReservation.from_orm(reservation_repository.get(reservation_id, db))
+            for reservation_id in (1, 2)
+        ])
+        db.close()
+        for url in ("/reservation/", "/reservation/2021/10/12"):
+            response = client.get(url)
+            assert response.headers["content-type"] == "application/json"
+            assert response.json() == expected
+            assert list(response.json()[0]) == list(expected[0])
+            assert list(response.json()[0]["owner"]) == list(expected[0]["owner"])
+
+    def test_next_cursor_header_is_kept(self, test_db):
+        store_reservations_with_owners(3, datetime(2021, 10, 12, 22, 2, 14))
+        response = client.get("/reservation/", params={"limit": 2})
+        assert len(response.json()) == 2
+        assert "x-next-cursor" in response.headers
+
+
+class TestResponseCache:
+    def test_repeated_get_is_served_from_cache(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        assert len(client.get("/reservation/2021/10/12").json()) == 1
+        # written behind the repository's back, so the cached page is still served
+        store_reservations_with_owners(1, datetime(2021, 10, 12, 23))
+        assert count_cached_queries("/reservation/2021/10/12") == 0
+        assert len(client.get("/reservation/2021/10/12").json()) == 1
+
+    def test_pagination_parameters_are_part_of_the_key(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        create_reservation("2021-10-12T22:03:14.760Z")
+        assert len(client.get("/reservation/2021/10/12?limit=1").json()) == 1
+        assert len(client.get("/reservation/2021/10/12?limit=2").json()) == 2
+
+    def test_if_none_match_gets_not_modified(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        response = client.get("/user/1152347583215")
+        etag = response.headers["ETag"]
+        assert etag.startswith('W/"')
+        not_modified = client.get("/user/1152347583215", headers={"If-None-Match": etag})
+        assert not_modified.status_code == 304
+        assert not_modified.content == b""
+        assert not_modified.headers["ETag"] == etag
+
+    def test_stale_etag_gets_the_new_body(self, test_db, store_user_in_db):
+        etag = client.get("/user/1152347583215").headers["ETag"]
+        create_reservation("2021-10-12T22:02:14.760Z")
+        response = client.get("/user/1152347583215", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert len(response.json()["reservations"]) == 1
+        assert response.headers["ETag"] != etag
+
+    def test_not_found_is_not_cached(self, test_db):
+        assert client.get("/user/1152347583215").status_code == 404
+        assert count_cached_queries("/user/1152347583215", 404) > 0
+
+    def test_create_invalidates_day_and_owner(self, test_db, store_user_in_db):
+        client.get("/reservation/new/")
+        client.get("/user/1152347583215")
+        create_reservation(datetime.now().isoformat())
+        assert len(client.get("/reservation/new/").json()) == 1
+        assert len(client.get("/user/1152347583215").json()["reservations"]) == 1
+
+    def test_update_invalidates_old_and_new_day(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        client.get("/reservation/2021/10/12")
+        client.get("/reservation/2021/11/12")
+        client.put("/reservation/1", json={"register_timestamp": "2021-11-12T22:01:14.760Z"})
+        assert client.get("/reservation/2021/10/12").json() == []
+        assert len(client.get("/reservation/2021/11/12").json()) == 1
+
+    def test_report_taken_invalidates_listings(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        create_reservation("2021-10-12T22:02:14.760Z")
+        client.get("/reservation/2021/10/12")
+        client.put("/reservation/report-taken/1")
+        assert [r["vaccinated"] for r in client.get("/reservation/2021/10/12").json()] == [True, False]
+        client.put("/reservation/report-taken", json={"reservation_ids": [2]})
+        assert [r["vaccinated"] for r in client.get("/reservation/2021/10/12").json()] == [True, True]
+
+    def test_delete_invalidates_owner(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        client.get("/user/1152347583215")
+        client.delete("/reservation/1")
+        assert client.get("/user/1152347583215").json()["reservations"] == []
+
+    def test_unrelated_write_keeps_entry(self, test_db, store_user_in_db):
+        create_reservation("2021-10-12T22:02:14.760Z")
+        client.get("/reservation/2021/10/12")
+        create_reservation("2021-11-12T22:02:14.760Z")
+        assert count_cached_queries("/reservation/2021/10/12") == 0
+
+
+def count_cached_queries(url, status_code=200):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    assert response.status_code == status_code
+    return len(statements)
@@ -0,0 +1,206 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, exc
+from sqlalchemy.orm import sessionmaker
+from src.reservation.main import app
+from src.reservation.database import Base, get_db
+from src.reservation.oauth2 import get_current_user
+from src.reservation.models import Reservation, Slot, User
+from src.reservation.schemas import Principal
+from src.reservation.repository import slot as slot_repository
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30}
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+
+def override_get_current_user():
+    return Principal(user_id=1, citizen_id="1152347583215")
+
+
+def store_users(count):
+    db = TestingSessionLocal()
+    for user_id in range(1, count + 1):
+        db.add(User(
+            user_id=user_id,
+            name="foo",
+            surname="rock",
+            citizen_id=str(1152347583214 + user_id),
+            birth_date=datetime(2021, 10, 12).date(),
+            occupation="doctor",
+            address="1145 bangkok",
+            password="strong_password",
+        ))
+    db.commit()
+    db.close()
+
+
+@pytest.fixture()
+def test_db():
+    Base.metadata.create_all(bind=engine)
+    store_users(1)
+    overridden = {
+        dependency: app.dependency_overrides.get(dependency)
+        for dependency in (get_db, get_current_user)
+    }
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_current_user] = override_get_current_user
+    yield
+    for dependency, previous in overridden.items():
+        if previous is None:
+            app.dependency_overrides.pop(dependency, None)
+        else:
+            app.dependency_overrides[dependency] = previous
+    Base.metadata.drop_all(bind=engine)
+
+
+client = TestClient(app)
+
+
+def create_slot(start="2021-10-22T09:00:00", capacity=2, site="Bang Sue"):
+    return client.post("/slot/", json={"site": site, "start": start, "capacity": capacity})
+
+
+def booked(slot_id):
+    db = TestingSessionLocal()
+    try:
+        return db.get(Slot, slot_id).booked
+    finally:
+        db.close()
+
+
+class TestCreateSlot:
+    def test_create_slot(self, test_db):
+        response = create_slot()
+        assert response.status_code == 201
+        assert response.json()["booked"] == 0
+        assert response.json()["capacity"] == 2
+
+    def test_same_site_and_start_twice_is_a_conflict(self, test_db):
+        create_slot()
+        assert create_slot().status_code == 409
+        assert create_slot(site="Central Ladprao").status_code == 201
+
+    def test_capacity_must_be_positive(self, test_db):
+        assert create_slot(capacity=0).status_code == 422
+
+    def test_get_slots_of_a_day(self, test_db):
+        create_slot("2021-10-22T13:00:00")
+        create_slot("2021-10-22T09:00:00")
+        create_slot("2021-10-23T09:00:00")
+        response = client.get("/slot/Bang Sue/2021/10/22")
+        assert response.status_code == 200
+        assert [slot["start"] for slot in response.json()] == [
+            "2021-10-22T09:00:00", "2021-10-22T13:00:00"
+        ]
+
+
+class TestBookSlot:
+    def test_booking_takes_a_seat(self, test_db):
+        slot_id = create_slot().json()["slot_id"]
+        response = client.post(f"/slot/{slot_id}/book")
+        assert response.status_code == 201
+        assert response.json()["register_timestamp"] == "2021-10-22T09:00:00"
+        assert response.json()["owner"]["citizen_id"] == "1152347583215"
+        assert booked(slot_id) == 1
+
+    def test_full_slot_is_a_conflict(self, test_db):
+        slot_id = create_slot(capacity=1).json()["slot_id"]
+        assert client.post(f"/slot/{slot_id}/book").status_code == 201
+        response = client.post(f"/slot/{slot_id}/book")
+        assert response.status_code == 409
+        assert response.json() == {"detail": "This slot is fully booked"}
+        assert booked(slot_id) == 1
+
+    def test_unknown_slot(self, test_db):
+        response = client.post("/slot/99/book")
+        assert response.status_code == 404
+        assert response.json() == {"detail": "No slot with this id"}
+
+    def test_deleting_the_reservation_frees_the_seat(self, test_db):
+        slot_id = create_slot(capacity=1).json()["slot_id"]
+        reservation_id = client.post(f"/slot/{slot_id}/book").json()["reservation_id"]
+        assert client.delete(f"/reservation/{reservation_id}").status_code == 200
+        assert booked(slot_id) == 0
+        assert client.post(f"/slot/{slot_id}/book").status_code == 201
+
+
+class TestBookAnySlot:
+    def test_earliest_slot_with_a_seat_is_booked(self, test_db):
+        late = create_slot("2021-10-22T13:00:00", capacity=1).json()["slot_id"]
+        early = create_slot("2021-10-22T09:00:00", capacity=1).json()["slot_id"]
+        first = client.post("/slot/Bang Sue/2021/10/22/book")
+        second = client.post("/slot/Bang Sue/2021/10/22/book")
+        assert first.json()["register_timestamp"] == "2021-10-22T09:00:00"
+        assert second.json()["register_timestamp"] == "2021-10-22T13:00:00"
+        assert booked(early) == booked(late) == 1
+
+    def test_full_day_is_a_conflict(self, test_db):
+        create_slot(capacity=1)
+        client.post("/slot/Bang Sue/2021/10/22/book")
+        response = client.post("/slot/Bang Sue/2021/10/22/book")
+        assert response.status_code == 409
+        assert response.json() == {"detail": "No slot with a free seat on this day"}
+
+
+def book_concurrently(book, users):
+    def attempt(user_id):
+        db = TestingSessionLocal()
+        try:
+            book(db, Principal(user_id=user_id, citizen_id=str(user_id)))
+            return True
+        except HTTPException as error:
+            assert error.status_code == 409
+            return False
+        finally:
+            db.close()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        return sum(pool.map(attempt, range(1, users + 1)))
+
+
+class TestContention:
+    def test_concurrent_bookings_never_overbook_a_slot(self, test_db):
+        slot_id = create_slot(capacity=5).json()["slot_id"]
+        successes = book_concurrently(
+            lambda db, user: slot_repository.book(slot_id, db, user), users=40
+        )
+        assert successes == booked(slot_id) == 5
+
+    def test_concurrent_bookings_of_a_day_fill_every_slot_exactly(self, test_db):
+        slot_ids = [
+            create_slot(f"2021-10-22T{hour:02d}:00:00", capacity=3).json()["slot_id"]
+            for hour in (9, 10, 11)
+        ]
+        successes = book_concurrently(
+            lambda db, user: slot_repository.book_any("Bang Sue", 2021, 10, 22, db, user), users=30
+        )
+        assert successes == 9
+        assert [booked(slot_id) for slot_id in slot_ids] == [3, 3, 3]
+        db = TestingSessionLocal()
+        assert db.query(Reservation).filter(Reservation.slot_id.isnot(None)).count() == 9
+        db.close()
+
+    def test_database_refuses_overbooking(self, test_db):
+        slot_id = create_slot(capacity=1).json()["slot_id"]
+        db = TestingSessionLocal()
+        try:
+            with pytest.raises(exc.IntegrityError):
+                db.query(Slot).filter(Slot.slot_id == slot_id).update({"booked": 2})
+        finally:
+            db.close()
@@ -0,0 +1,291 @@
+import asyncio
+import json
+import pytest
+from datetime import date
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from src.reservation import stream
+from src.reservation.broker import MemoryBroker, PollingBroker, create_broker
+from src.reservation.config import settings
+from src.reservation.main import app
+from src.reservation.database import Base, get_db
+from src.reservation.oauth2 import get_current_user
+from src.reservation.models import User
+from src.reservation.schemas import Principal
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30}
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+
+def override_get_current_user():
+    return Principal(user_id=1, citizen_id="1152347583215")
+
+
+@pytest.fixture()
+def test_db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    db.add(User(
+        user_id=1,
+        name="foo",
+        surname="rock",
+        citizen_id="1152347583215",
+        birth_date=date(2021, 10, 12),
+        occupation="doctor",
+        address="1145 bangkok",
+        password="strong_password",
+    ))
+    db.commit()
+    db.close()
+    overridden = {
+        dependency: app.dependency_overrides.get(dependency)
+        for dependency in (get_db, get_current_user)
+    }
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_current_user] = override_get_current_user
+    yield
+    for dependency, previous in overridden.items():
+        if previous is None:
+            app.dependency_overrides.pop(dependency, None)
+        else:
+            app.dependency_overrides[dependency] = previous
+    Base.metadata.drop_all(bind=engine)
+
+
+client = TestClient(app)
+
+
+def create_reservation(timestamp="2021-10-22T09:00:00"):
+    return client.post("/reservation/", json={"register_timestamp": timestamp})
+
+
+def book_at(site, start="2021-10-22T09:00:00"):
+    slot = client.post("/slot/", json={"site": site, "start": start, "capacity": 5}).json()
+    return client.post(f"/slot/{slot['slot_id']}/book")
+
+
+def parse(message):
+    fields = {}
+    for line in message.strip().split("\n"):
+        name, _, value = line.partition(": ")
+        fields[name] = value
+    if "data" in fields:
+        fields["data"] = json.loads(fields["data"])
+    return fields
+
+
+async def next_message(messages):
+    return await asyncio.wait_for(messages.__anext__(), 5)
+
+
+async def write(action, *args):
+    # the app's writes are blocking; keep the stream's loop running meanwhile
+    return await asyncio.get_running_loop().run_in_executor(None, action, *args)
+
+
+def run(scenario):
+    async def main():
+        hub = stream.Hub(MemoryBroker(), TestingSessionLocal)
+        try:
+            return await scenario(hub)
+        finally:
+            await hub.stop()
+    return asyncio.run(main())
+
+
+class TestEvents():
+    def test_event_format(self, test_db):
+        create_reservation()
+        hub = stream.Hub(MemoryBroker(), TestingSessionLocal)
+        [(key, change)], _ = hub.read(None)
+        message = parse(stream.event(key, change))
+        assert message["event"] == "create"
+        assert message["id"] == client.get("/reservation/changes").json()["next_cursor"]
+        assert message["data"]["reservation_id"] == 1
+        assert message["data"]["reservation"]["owner"]["name"] == "foo"
+
+    def test_event_names(self):
+        assert stream.EVENTS == {
+            "insert": "create", "update": "update", "vaccinated": "vaccinated", "delete": "delete",
+        }
+
+
+class TestStream():
+    def test_starts_with_the_retry_interval(self, test_db):
+        async def scenario(hub):
+            messages = stream.events(hub)
+            first = await next_message(messages)
+            await messages.aclose()
+            return first
+
+        assert run(scenario) == f"retry: {stream.RETRY_MS}\n\n"
+
+    def test_live_events(self, test_db, monkeypatch):
+        monkeypatch.setattr(settings, "stream_heartbeat", 0.01)
+        create_reservation()
+
+        async def scenario(hub):
+            messages = stream.events(hub)
+            await next_message(messages)
+            # caught up: from here on the events are the hub's
+            assert await next_message(messages) == ": heartbeat\n\n"
+            received = []
+            for action, *args in (
+                (create_reservation, "2021-10-23T09:00:00"),
+                (client.put, "/reservation/report-taken/2"),
+                (client.delete, "/reservation/1"),
+            ):
+                await write(action, *args)
+                hub.broker.publish()
+                message = await next_message(messages)
+                while message == ": heartbeat\n\n":
+                    message = await next_message(messages)
+                received.append(parse(message))
+            await messages.aclose()
+            return received
+
+        received = run(scenario)
+        # the reservation made before the stream opened is not replayed
+        assert [(message["event"], message["data"]["reservation_id"]) for message in received] == [
+            ("create", 2), ("vaccinated", 2), ("delete", 1),
+        ]
+        assert received[2]["data"]["reservation"] is None
+
+    def test_catches_up_from_the_cursor(self, test_db):
+        create_reservation()
+        since = client.get("/reservation/changes").json()["next_cursor"]
+        create_reservation("2021-10-23T09:00:00")
+        client.delete("/reservation/1")
+
+        async def scenario(hub):
+            messages = stream.events(hub, since=stream.pagination.decode_cursor(since, int, int))
+            await next_message(messages)
+            received = [parse(await next_message(messages)) for _ in range(2)]
+            await messages.aclose()
+            return received
+
+        assert [message["event"] for message in run(scenario)] == ["create", "delete"]
+
+    def test_a_change_caught_up_with_is_not_sent_again(self, test_db):
+        create_reservation()
+
+        async def scenario(hub):
+            messages = stream.events(hub, since=(0, 0))
+            await next_message(messages)
+            caught_up = parse(await next_message(messages))
+            # rewound, the hub hands the change caught up with to the stream again
+            hub.position = (0, 0)
+            hub.broker.publish()
+            await write(create_reservation, "2021-10-23T09:00:00")
+            hub.broker.publish()
+            live = parse(await next_message(messages))
+            await messages.aclose()
+            return caught_up, live
+
+        caught_up, live = run(scenario)
+        assert caught_up["data"]["reservation_id"] == 1
+        assert live["data"]["reservation_id"] == 2
+
+    def test_site_filter(self, test_db):
+        async def scenario(hub):
+            messages = stream.events(hub, site="Bang Sue")
+            await next_message(messages)
+            await write(create_reservation)
+            await write(book_at, "Siam", "2021-10-23T09:00:00")
+            await write(book_at, "Bang Sue", "2021-10-24T09:00:00")
+            hub.broker.publish()
+            received = parse(await next_message(messages))
+            await messages.aclose()
+            return received
+
+        received = run(scenario)
+        assert received["data"]["site"] == "Bang Sue"
+        assert received["data"]["reservation_id"] == 3
+
+    def test_heartbeat(self, test_db, monkeypatch):
+        monkeypatch.setattr(settings, "stream_heartbeat", 0.01)
+
+        async def scenario(hub):
+            messages = stream.events(hub)
+            await next_message(messages)
+            heartbeat = await next_message(messages)
+            await messages.aclose()
+            return heartbeat
+
+        assert run(scenario) == ": heartbeat\n\n"
+
+    def test_a_stream_too_far_behind_ends(self, test_db, monkeypatch):
+        monkeypatch.setattr(settings, "stream_queue_size", 1)
+        monkeypatch.setattr(settings, "stream_heartbeat", 0.01)
+
+        async def scenario(hub):
+            messages = stream.events(hub)
+            await next_message(messages)
+            assert await next_message(messages) == ": heartbeat\n\n"
+            await write(create_reservation)
+            await write(create_reservation, "2021-10-23T09:00:00")
+            hub.broker.publish()
+            # let the hub fill the queue before the stream reads it
+            while hub.subscriptions:
+                await asyncio.sleep(0.01)
+            with pytest.raises(StopAsyncIteration):
+                await next_message(messages)
+
+        run(scenario)
+
+    def test_subscription_ends_with_the_stream(self, test_db):
+        async def scenario(hub):
+            messages = stream.events(hub)
+            await next_message(messages)
+            subscribed = len(hub.subscriptions)
+            await messages.aclose()
+            return subscribed, len(hub.subscriptions)
+
+        assert run(scenario) == (1, 0)
+
+
+class TestBroker():
+    def test_publish_wakes_every_listener(self):
+        async def scenario():
+            broker = MemoryBroker()
+            listeners = [broker.listen(), broker.listen()]
+            waiting = [asyncio.ensure_future(listener.__anext__()) for listener in listeners]
+            await asyncio.sleep(0)
+            broker.publish()
+            await asyncio.wait_for(asyncio.gather(*waiting), 5)
+            for listener in listeners:
+                await listener.aclose()
+
+        asyncio.run(scenario())
+
+    def test_polling_wakes_without_publish(self):
+        async def scenario():
+            listener = PollingBroker(0.01).listen()
+            await asyncio.wait_for(listener.__anext__(), 5)
+            await listener.aclose()
+
+        asyncio.run(scenario())
+
+    def test_unknown_broker(self):
+        with pytest.raises(ValueError):
+            create_broker("redis")
+
+
+class TestEndpoint():
+    def test_invalid_last_event_id(self, test_db):
+        response = client.get("/reservation/stream", headers={"Last-Event-ID": "not-a-cursor"})
+        assert response.status_code == 422